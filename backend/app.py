@@ -1,4 +1,4 @@
-from flask import Flask, jsonify, Blueprint, current_app
+from flask import Flask, jsonify, Blueprint, current_app, Response, request
 from flask_cors import CORS
 import logging
 import urllib.parse
@@ -6,24 +6,39 @@ from typing import Dict, Any
 from src.utils.config import load_secrets
 from flask_jwt_extended import JWTManager, get_jwt_identity, jwt_required
 from flask_jwt_extended import create_access_token
-# --- Set up logging for the Flask app ---
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 # --- Import your modularized backend logic and routes ---
 from src.utils.config import load_secrets
-from src.backend.database.mongo_utils import get_mongo_db_connection
+from src.backend.resources import init_resources, start_background_tasks, env_flag
+from src.backend.database.message_migration import migrate_message_store_command
+from models.indexes import ensure_indexes_command, index_report_command
+from src.services.config_deletion_service import reap_deleted_configs_command
+from src.services.transcript_export_service import export_transcripts_command
+from src.services.batch_eval_service import batch_eval_command
+from src.backend.embedding_factory import default_embedding_model
+from models.vector_stores import embedding_report_command
+from src.services.reembed_service import reembed_config_command
+from src.services.admission_service import admission_limits_command
+from src.utils.metrics import REGISTRY
+from src.utils.logging_setup import configure_logging, set_request_id, get_request_id
 # from src.backend.aws_s3_manager import get_s3_client
-from langchain_openai.embeddings import OpenAIEmbeddings
 from datetime import timedelta
+from flask_mail import Mail
+
+# Defined before the blueprints are imported: routes/auth.py does `from app import mail`,
+# which only works during `import app` (wsgi.py, asgi.py) if `mail` already exists.
+mail = Mail()
+
 # --- NEW: Import the Blueprints from the routes folder ---
 from routes.auth import auth_bp
 from routes.config_routes import config_bp
 from routes.chat_routes import chat_bp
 from routes.edit_config_routes import edit_config_bp
-from flask_mail import Mail
-
-mail = Mail()
+from routes.export_routes import export_bp
+from routes.profile_routes import profile_bp
+from routes.batch_routes import batch_bp
+from routes.usage_routes import usage_bp
 import os
 from dotenv import load_dotenv
 
@@ -31,6 +46,9 @@ load_dotenv()
 # --- Initialize Flask App ---
 def create_app():
     """Factory function to create and configure the Flask application."""
+    # --- Set up logging for the Flask app ---
+    # Queue-based, JSON by default; the writer thread is started per process by init_resources
+    configure_logging()
     app = Flask(__name__)
     CORS(app, resources={r"/api/*": {"origins": ["*"], "supports_credentials": True, "methods": ["GET", "POST", "PUT", "DELETE", "OPTIONS"]}})
 
@@ -72,19 +90,16 @@ def create_app():
     app.config.from_mapping(load_secrets())
 
     app.config["JWT_SECRET_KEY"]=os.getenv('JWT_SECRET_KEY')
+    app.config['EMBEDDING_MODEL'] = default_embedding_model()
     jwt = JWTManager(app)
 
 
-    # We only need the collection for the config service, so we can get it from the connection
-    client, db, mongo_collection = get_mongo_db_connection(
-        mongo_uri=app.config["MONGO_URI"],
-        db_name=app.config["MONGO_DB_NAME"],
-        collection_name=app.config["USER"]
-    )
-    app.config['MONGO_COLLECTION'] = mongo_collection
-    app.config['MONGO_DB'] = db
-    # Cache the embedding model as it's a resource
-    app.config['EMBEDDINGS'] = OpenAIEmbeddings(model="text-embedding-3-large", api_key=app.config["OPENAI_API_KEY"])
+    # Mongo, embedding and chat model clients plus background threads are per process.
+    # Under gunicorn with preload_app (RAG_DEFER_WORKER_INIT=true, set by gunicorn.conf.py)
+    # they are created in each worker by the post_fork hook instead of here.
+    if not env_flag('RAG_DEFER_WORKER_INIT', 'false'):
+        init_resources(app)
+        start_background_tasks(app)
 
     # --- NEW: Application-level cache for RAG chains ---
     # This dictionary will be stored on the app object for access in routes.
@@ -99,12 +114,48 @@ def create_app():
     app.register_blueprint(auth_bp, url_prefix='/api/auth') 
     app.register_blueprint(config_bp, url_prefix='/api')
     app.register_blueprint(edit_config_bp, url_prefix='/api')
+    app.register_blueprint(export_bp, url_prefix='/api')
+    app.register_blueprint(profile_bp, url_prefix='/api')
+    app.register_blueprint(batch_bp, url_prefix='/api')
+    app.register_blueprint(usage_bp, url_prefix='/api')
+
+    # --- Register CLI commands (run with `flask --app app <command>`) ---
+    app.cli.add_command(migrate_message_store_command)
+    app.cli.add_command(ensure_indexes_command)
+    app.cli.add_command(index_report_command)
+    app.cli.add_command(reap_deleted_configs_command)
+    app.cli.add_command(export_transcripts_command)
+    app.cli.add_command(batch_eval_command)
+    app.cli.add_command(embedding_report_command)
+    app.cli.add_command(reembed_config_command)
+    app.cli.add_command(admission_limits_command)
 
     
+    # Correlate every log record of a request; a caller-provided X-Request-ID is kept
+    @app.before_request
+    def assign_request_id():
+        set_request_id(request.headers.get('X-Request-ID'))
+
+    @app.after_request
+    def return_request_id(response):
+        request_id = get_request_id()
+        if request_id:
+            response.headers['X-Request-ID'] = request_id
+        return response
+
     # A simple health check endpoint
     @app.route('/health', methods=['GET'])
     def health_check():
         return jsonify({"status": "healthy", "message": "Backend is running!"})
+
+    # Stage latencies and request counters in the Prometheus text format (src/utils/metrics.py).
+    # Set METRICS_TOKEN to require "Authorization: Bearer <token>" from the scraper.
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        token = os.getenv('METRICS_TOKEN')
+        if token and request.headers.get('Authorization') != f"Bearer {token}":
+            return jsonify({"message": "Unauthorized"}), 401
+        return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
     @app.route('/api/refresh', methods=['POST'])
     @jwt_required(refresh=True) # This decorator requires a valid REFRESH token
     def refresh():
@@ -119,6 +170,8 @@ def create_app():
     return app
 
 # --- Entry point for running the application ---
+# This runs Flask's development server. In production the app is served by gunicorn:
+#   gunicorn -c gunicorn.conf.py wsgi:app
 if __name__ == '__main__':
     # Create the app instance using the factory function
     app = create_app()
@@ -0,0 +1,33 @@
+# ASGI entry point: the async chat endpoint (routes/async_chat_routes.py) in front of the Flask app.
+#   GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker gunicorn -c gunicorn.conf.py asgi:app
+# Requests the async routes do not handle are passed to Flask, which runs on a thread pool.
+import contextlib
+import os
+from a2wsgi import WSGIMiddleware
+from pymongo import AsyncMongoClient
+from starlette.applications import Starlette
+from starlette.routing import Mount
+
+from app import create_app
+from routes.async_chat_routes import async_chat_routes
+
+flask_app = create_app()
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    # The async client is bound to the worker's event loop, so it is created when the loop starts
+    client = AsyncMongoClient(flask_app.config["MONGO_URI"], serverSelectionTimeoutMS=5000)
+    app.state.async_db = client[flask_app.config["MONGO_DB_NAME"]]
+    try:
+        yield
+    finally:
+        await client.close()
+
+app = Starlette(
+    routes=[
+        *async_chat_routes,
+        Mount("/", app=WSGIMiddleware(flask_app, workers=int(os.getenv("ASGI_WSGI_THREADS", 8)))),
+    ],
+    lifespan=lifespan,
+)
+app.state.flask_app = flask_app
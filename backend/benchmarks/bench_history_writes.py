@@ -0,0 +1,112 @@
+"""
+Benchmark: MongoDbChatMessageHistory write paths.
+
+Compares, against a local mongod:
+  legacy  - the previous add_message: base-class insert of a JSON string, then an
+            update_one matching "History.data.content" to attach the survey metadata
+  single  - the current add_message: one insert carrying the metadata
+  bulk    - add_messages: one insert_many per turn (human + ai message)
+
+Reports wall time, server round trips per message and how many stored messages
+actually carry the survey metadata.
+
+Run from backend/:
+    python -m benchmarks.bench_history_writes --mongo-uri mongodb://localhost:27017 --turns 500
+"""
+import argparse
+import json
+import time
+import uuid
+from pymongo import monitoring
+from langchain_core.messages import AIMessage, HumanMessage, message_to_dict
+
+
+class CommandCounter(monitoring.CommandListener):
+    """Counts the commands sent to the server (one per round trip)."""
+
+    def __init__(self):
+        self.count = 0
+
+    def started(self, event):
+        if event.command_name in ("insert", "update", "find", "delete"):
+            self.count += 1
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+
+def legacy_add_message(history, message):
+    """The add_message implementation this benchmark compares against."""
+    history.collection.insert_one({"SessionId": history.session_id, "History": json.dumps(message_to_dict(message))})
+    history.collection.update_one(
+        {"SessionId": history.session_id, "History.data.content": message.content},
+        {"$set": {"ResponseId": history.response_id, "AgentId": history.agent_id, "SurveyId": history.survey_id}},
+        upsert=False
+    )
+
+
+def run_variant(name, args, counter):
+    from src.backend.database.mongo_utils import MongoDbChatMessageHistory
+
+    session_id = f"bench-{name}-{uuid.uuid4()}"
+    history = MongoDbChatMessageHistory(
+        connection_string=args.mongo_uri,
+        session_id=session_id,
+        response_id="response-1",
+        agent_id="agent-1",
+        survey_id="survey-1",
+        database_name=args.db_name,
+        collection_name=args.collection,
+        config_id="bench-config"
+    )
+    turns = [(HumanMessage(content=f"question {i}"), AIMessage(content=f"answer {i}")) for i in range(args.turns)]
+
+    counter.count = 0
+    started = time.perf_counter()
+    for human, ai in turns:
+        if name == "legacy":
+            legacy_add_message(history, human)
+            legacy_add_message(history, ai)
+        elif name == "single":
+            history.add_message(human)
+            history.add_message(ai)
+        else:
+            history.add_messages([human, ai])
+    elapsed = time.perf_counter() - started
+    round_trips = counter.count
+
+    messages = args.turns * 2
+    tagged = history.collection.count_documents({"SessionId": session_id, "SurveyId": "survey-1"})
+    history.collection.delete_many({"SessionId": session_id})
+    history.close()
+    return {
+        "variant": name,
+        "messages": messages,
+        "seconds": round(elapsed, 4),
+        "messages_per_second": round(messages / elapsed, 1) if elapsed else None,
+        "round_trips_per_message": round(round_trips / messages, 2),
+        "messages_with_metadata": tagged,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mongo-uri", default="mongodb://localhost:27017")
+    parser.add_argument("--db-name", default="bench_history_writes")
+    parser.add_argument("--collection", default="message_store")
+    parser.add_argument("--turns", type=int, default=500)
+    args = parser.parse_args()
+
+    # Must be registered before any client is created
+    counter = CommandCounter()
+    monitoring.register(counter)
+
+    results = [run_variant(name, args, counter) for name in ("legacy", "single", "bulk")]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""
+Benchmark: retrieval quality against prompt size and latency, over chunking, k and embedding dimension.
+
+Ingests the fixture corpus (benchmarks/fixtures/retrieval/corpus) through the real
+process_files_and_create_vector_store code path once per chunk size / overlap / dimension
+setting, then runs the labelled query set (fixtures/retrieval/queries.json) against it.
+A chunk is relevant to a query when it comes from the labelled source file and contains the
+query's evidence sentence whole, so a fact split across a chunk boundary counts as a miss.
+
+Reports for every setting and k, as JSON:
+  recall_at_k        share of queries with a relevant chunk in the top k
+  mrr                mean reciprocal rank of the first relevant chunk (0 beyond k)
+  evidence_coverage  share of queries whose evidence survives chunking at all (recall ceiling)
+  context_tokens     mean/p95 tokens of the context sent to the model (tiktoken cl100k_base,
+                     or characters / 4 when the encoding is unavailable)
+  retrieval_ms       p50/p95 of query embedding + vector search
+and recommends the setting with the fewest context tokens whose recall meets --min-recall.
+
+Runs offline on mongomock with the hashing embeddings and brute-force cosine search of
+benchmarks/local_backends.py (Atlas $vectorSearch is not available locally), so the absolute
+quality is that of a lexical model; compare settings against each other, and rerun with the
+production embeddings before changing defaults.
+
+Run from backend/:
+    python -m benchmarks.bench_retrieval --chunk-sizes 250,500,1000 --overlaps 0,20,100 --k 1,3,5 --dimensions 256,1024
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import statistics
+import tempfile
+import time
+
+from benchmarks.load_test import git_commit, percentile, set_offline_environment
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "retrieval")
+
+
+def parse_ints(value: str):
+    return [int(item) for item in value.split(",") if item]
+
+
+def normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+def token_counter():
+    """Returns a function counting the prompt tokens of a text."""
+    try:
+        import tiktoken
+        encoding = tiktoken.get_encoding("cl100k_base")
+        return lambda text: len(encoding.encode(text)), "cl100k_base"
+    except Exception:
+        # The encoding file is downloaded on first use; fall back to the usual 4 characters per token
+        return lambda text: (len(text) + 3) // 4, "chars/4"
+
+
+def load_queries(path: str) -> list:
+    with open(path) as f:
+        queries = json.load(f)
+    for query in queries:
+        query["evidence_normalized"] = normalize(query["evidence"])
+    return queries
+
+
+def is_relevant(doc, query) -> bool:
+    return doc.metadata.get("original_file") == query["source"] and query["evidence_normalized"] in normalize(doc.page_content)
+
+
+def build_app(args):
+    from app import create_app
+    from benchmarks.local_backends import patch_mongomock_bulk_write
+    from src.utils.logging_setup import start_log_listener
+
+    app = create_app()
+    if args.mongo_uri:
+        import pymongo
+        client = pymongo.MongoClient(args.mongo_uri)
+    else:
+        import mongomock
+        patch_mongomock_bulk_write()
+        client = mongomock.MongoClient()
+    client.drop_database(args.db_name)
+    app.config["MONGO_CLIENT"] = client
+    app.config["MONGO_DB"] = client[args.db_name]
+    start_log_listener()
+    return app
+
+
+def ingest(app, corpus_dir: str, chunk_size: int, chunk_overlap: int):
+    """Runs the upload path on copies of the corpus files (it deletes the files it is given). Returns (config_id, seconds)."""
+    from bson import ObjectId
+    from src.utils.vector_stores.store_vector_stores import process_files_and_create_vector_store
+
+    config_id = str(ObjectId())
+    workdir = tempfile.mkdtemp(prefix="bench-retrieval-")
+    try:
+        paths = []
+        for name in sorted(os.listdir(corpus_dir)):
+            paths.append(shutil.copy(os.path.join(corpus_dir, name), os.path.join(workdir, name)))
+        started = time.perf_counter()
+        with app.app_context():
+            process_files_and_create_vector_store(
+                paths, "bench-user", f"bench-{chunk_size}-{chunk_overlap}", config_id,
+                chunk_size=chunk_size, chunk_overlap=chunk_overlap
+            )
+        return config_id, time.perf_counter() - started
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def evaluate(app, args, queries, count_tokens, chunk_size, chunk_overlap, dimensions):
+    """Ingests the corpus with one setting and scores every k of the sweep. Returns one row per k."""
+    from benchmarks.local_backends import HashingEmbeddings, local_vector_search
+    from models.vector_stores import VectorChunks
+    from src.services.chat_service import documents_from_search, format_docs
+
+    embeddings = HashingEmbeddings(dimensions=dimensions, latency=args.embedding_latency)
+    app.config["EMBEDDINGS"] = embeddings
+    config_id, ingest_seconds = ingest(app, args.corpus, chunk_size, chunk_overlap)
+    collection = app.config["MONGO_DB"][VectorChunks.COLLECTION_NAME]
+    chunks = [documents_from_search([doc])[0] for doc in collection.find({"config_id": config_id}, {"embedding": 0})]
+    covered = sum(1 for query in queries if any(is_relevant(doc, query) for doc in chunks))
+
+    max_k = max(args.k)
+    ranked, latencies = [], []
+    for query in queries:
+        started = time.perf_counter()
+        query_vector = embeddings.embed_query(query["query"])
+        docs = documents_from_search(local_vector_search(collection, query_vector, config_id, max_k))
+        latencies.append(time.perf_counter() - started)
+        ranked.append(docs)
+    latencies.sort()
+
+    rows = []
+    for k in args.k:
+        hits, reciprocal_ranks, context_tokens = 0, [], []
+        for query, docs in zip(queries, ranked):
+            top = docs[:k]
+            rank = next((position for position, doc in enumerate(top, 1) if is_relevant(doc, query)), None)
+            hits += rank is not None
+            reciprocal_ranks.append(1 / rank if rank else 0.0)
+            context_tokens.append(count_tokens(format_docs(top)))
+        context_tokens.sort()
+        rows.append({
+            "chunk_size": chunk_size,
+            "chunk_overlap": chunk_overlap,
+            "dimensions": dimensions,
+            "k": k,
+            "chunks": len(chunks),
+            "recall_at_k": round(hits / len(queries), 3),
+            "mrr": round(statistics.mean(reciprocal_ranks), 3),
+            "evidence_coverage": round(covered / len(queries), 3),
+            "context_tokens_mean": round(statistics.mean(context_tokens), 1),
+            "context_tokens_p95": percentile(context_tokens, 0.95),
+            "retrieval_ms_p50": round(percentile(latencies, 0.50) * 1000, 3),
+            "retrieval_ms_p95": round(percentile(latencies, 0.95) * 1000, 3),
+            "ingest_seconds": round(ingest_seconds, 3),
+        })
+    return rows
+
+
+def recommend(results: list, min_recall: float):
+    """The cheapest setting in prompt tokens that still reaches min_recall (ties: higher MRR)."""
+    acceptable = [row for row in results if row["recall_at_k"] >= min_recall]
+    if not acceptable:
+        return None
+    return min(acceptable, key=lambda row: (row["context_tokens_mean"], -row["mrr"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus", default=os.path.join(FIXTURES, "corpus"), help="Directory of documents to ingest.")
+    parser.add_argument("--queries", default=os.path.join(FIXTURES, "queries.json"), help="Labelled queries: query, source, evidence.")
+    parser.add_argument("--chunk-sizes", default="250,500,1000")
+    parser.add_argument("--overlaps", default="0,20,100")
+    parser.add_argument("--k", default="1,3,5")
+    parser.add_argument("--dimensions", default="256,1024", help="Hashing embedding dimensions.")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Simulated embedding call latency (s).")
+    parser.add_argument("--min-recall", type=float, default=0.9, help="Recall the recommended setting must reach.")
+    parser.add_argument("--mongo-uri", default=None, help="Local mongod to store the chunks in instead of mongomock.")
+    parser.add_argument("--db-name", default="rag_bench_retrieval")
+    parser.add_argument("--output", default=None, help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args()
+    args.k = parse_ints(args.k)
+
+    set_offline_environment()
+    app = build_app(args)
+    queries = load_queries(args.queries)
+    count_tokens, tokenizer = token_counter()
+
+    results = []
+    for dimensions in parse_ints(args.dimensions):
+        for chunk_size in parse_ints(args.chunk_sizes):
+            for chunk_overlap in parse_ints(args.overlaps):
+                if chunk_overlap >= chunk_size:
+                    continue
+                results.extend(evaluate(app, args, queries, count_tokens, chunk_size, chunk_overlap, dimensions))
+
+    report = {
+        "commit": git_commit(),
+        "backend": "mongod" if args.mongo_uri else "mongomock",
+        "queries": len(queries),
+        "tokenizer": tokenizer,
+        "settings": {key: value for key, value in vars(args).items() if key != "output"},
+        "recommended": recommend(results, args.min_recall),
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""
+Benchmark: the outbound LLM scheduler (src/backend/llm_scheduler.py) against a provider that
+enforces its own rate limits.
+
+Runs the same mixed workload twice against a RateLimitedProvider (benchmarks/local_backends.py),
+whose chat and embedding calls share one request and token budget:
+  chat    interactive turns arriving one every --chat-interval seconds
+  batch   --batch-size batch evaluation questions submitted at once, --batch-concurrency at a time
+  ingest  --ingest-calls embedding calls of --ingest-tokens tokens each, 4 at a time
+In "direct" mode every call goes straight to the provider and retries 429s with backoff
+(--retries, honoring Retry-After, like the provider SDKs). In "scheduled" mode the calls go
+through ScheduledChatModel / ScheduledEmbeddings with --budget-share of the provider's limits and the
+chat, batch and ingest priorities.
+
+Reports per mode and traffic class, as JSON: completed and failed calls, p50/p95/max latency,
+plus the 429s the provider returned. The limits are per --window seconds so a run takes seconds;
+the behavior is the same with per-minute limits.
+
+Run from backend/:
+    python -m benchmarks.bench_scheduler --rpm 40 --tpm 20000 --window 2 --chat-turns 30
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.load_test import git_commit, percentile
+
+
+def with_retries(call, retries: int):
+    """Calls `call`, retrying provider 429s with exponential backoff and the server's Retry-After."""
+    from src.backend.llm_scheduler import provider_status, retry_after_of
+    attempt = 0
+    while True:
+        try:
+            return call()
+        except Exception as e:
+            if provider_status(e) != 429 or attempt >= retries:
+                raise
+            time.sleep(max(retry_after_of(e, 0.0), 0.5 * 2 ** attempt) * random.uniform(1.0, 1.25))
+            attempt += 1
+
+
+def run_mode(args, mode: str) -> dict:
+    from langchain_core.messages import HumanMessage
+    from benchmarks.local_backends import RateLimitedChatModel, RateLimitedEmbeddings, RateLimitedProvider
+    from src.backend.llm_scheduler import BATCH, CHAT, INGEST, LLMScheduler, ScheduledChatModel, ScheduledEmbeddings, set_llm_scheduler
+
+    provider = RateLimitedProvider(args.rpm, args.tpm, args.window)
+    chat_model = RateLimitedChatModel(provider=provider, latency=args.llm_latency, answer_tokens=args.answer_tokens)
+    embeddings = RateLimitedEmbeddings(provider)
+    set_llm_scheduler(LLMScheduler({"fake": {"rpm": args.rpm * args.budget_share, "tpm": args.tpm * args.budget_share}}, period=args.window))
+
+    def client(priority):
+        if mode == "direct":
+            return lambda messages: with_retries(lambda: chat_model.invoke(messages), args.retries)
+        scheduled = ScheduledChatModel(model=chat_model, provider="fake", api_key="bench", priority=priority)
+        return scheduled.invoke
+
+    def embedder(priority):
+        if mode == "direct":
+            return lambda texts: with_retries(lambda: embeddings.embed_documents(texts), args.retries)
+        return ScheduledEmbeddings(embeddings, "fake", "bench", priority).embed_documents
+
+    results = {"chat": [], "batch": [], "ingest": []}
+    lock = threading.Lock()
+
+    def timed(kind, call):
+        started = time.perf_counter()
+        try:
+            call()
+            ok = True
+        except Exception:
+            ok = False
+        with lock:
+            results[kind].append((time.perf_counter() - started, ok))
+
+    prompt = [HumanMessage(content="context " * args.prompt_words + "question?")]
+    ingest_text = "chunk " * (args.ingest_tokens * 4 // 6)
+    batch_call, chat_call, ingest_call = client(BATCH), client(CHAT), embedder(INGEST)
+
+    def batch():
+        with ThreadPoolExecutor(max_workers=args.batch_concurrency) as pool:
+            list(pool.map(lambda _: timed("batch", lambda: batch_call(prompt)), range(args.batch_size)))
+
+    def ingest():
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            list(pool.map(lambda _: timed("ingest", lambda: ingest_call([ingest_text])), range(args.ingest_calls)))
+
+    started = time.perf_counter()
+    background = [threading.Thread(target=batch), threading.Thread(target=ingest)]
+    for thread in background:
+        thread.start()
+    chats = []
+    for _ in range(args.chat_turns):
+        thread = threading.Thread(target=timed, args=("chat", lambda: chat_call(prompt)))
+        thread.start()
+        chats.append(thread)
+        time.sleep(args.chat_interval)
+    for thread in chats + background:
+        thread.join()
+
+    report = {"mode": mode, "seconds": round(time.perf_counter() - started, 2), "provider_429s": provider.rejected, "provider_served": provider.served}
+    for kind, timings in results.items():
+        latencies = sorted(latency for latency, ok in timings if ok)
+        report[kind] = {
+            "completed": len(latencies),
+            "failed": sum(1 for _, ok in timings if not ok),
+            "p50_s": round(percentile(latencies, 0.50), 3) if latencies else None,
+            "p95_s": round(percentile(latencies, 0.95), 3) if latencies else None,
+            "max_s": round(latencies[-1], 3) if latencies else None,
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rpm", type=float, default=40, help="Provider requests per window.")
+    parser.add_argument("--tpm", type=float, default=20000, help="Provider tokens per window.")
+    parser.add_argument("--window", type=float, default=2.0, help="Seconds the limits apply to (60 for real RPM/TPM).")
+    parser.add_argument("--budget-share", type=float, default=0.95, help="Share of the provider limits given to the scheduler.")
+    parser.add_argument("--chat-turns", type=int, default=30)
+    parser.add_argument("--chat-interval", type=float, default=0.2, help="Seconds between chat turns.")
+    parser.add_argument("--batch-size", type=int, default=120)
+    parser.add_argument("--batch-concurrency", type=int, default=16)
+    parser.add_argument("--ingest-calls", type=int, default=20)
+    parser.add_argument("--ingest-tokens", type=int, default=1500)
+    parser.add_argument("--prompt-words", type=int, default=300)
+    parser.add_argument("--answer-tokens", type=int, default=60)
+    parser.add_argument("--llm-latency", type=float, default=0.05)
+    parser.add_argument("--retries", type=int, default=2, help="429 retries of the direct client.")
+    parser.add_argument("--modes", default="direct,scheduled")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default=None, help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    report = {
+        "commit": git_commit(),
+        "settings": {key: value for key, value in vars(args).items() if key != "output"},
+        "results": [run_mode(args, mode) for mode in args.modes.split(",")],
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark: serving throughput and latency at increasing concurrency.
+
+Sends requests to a running backend at each concurrency level of the sweep and
+reports throughput and p50/p95/p99 latency per level. Used to size the gunicorn
+workers and threads (gunicorn.conf.py, see DEPLOYMENT.md "Production serving").
+
+Cheap endpoints (/health) measure the serving stack itself; pointing it at
+/api/chat/<config_id>/<chat_id> with a real config measures the I/O-bound path the thread count is sized for.
+
+Run from backend/ against a server started with the settings under test:
+    WEB_CONCURRENCY=2 GUNICORN_THREADS=8 gunicorn -c gunicorn.conf.py wsgi:app
+    python -m benchmarks.bench_serving --url http://localhost:5000/health --concurrency 1,4,16,64
+    python -m benchmarks.bench_serving --url http://localhost:5000/api/chat/<config_id>/bench --token $JWT \\
+        --body '{"input": "What is this about?"}'
+"""
+import argparse
+import json
+import statistics
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def send_request(url, body, token, timeout):
+    """Sends one request and returns (latency_seconds, ok). The full response body is read."""
+    headers = {"Content-Type": "application/json"}
+    if token:
+        headers["Authorization"] = f"Bearer {token}"
+    data = body.encode("utf-8") if body else None
+    request = urllib.request.Request(url, data=data, headers=headers, method="POST" if data else "GET")
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            response.read()
+            ok = 200 <= response.status < 300
+    except (urllib.error.URLError, TimeoutError, ConnectionError):
+        ok = False
+    return time.perf_counter() - started, ok
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def run_level(args, concurrency):
+    requests_total = max(args.requests_per_worker * concurrency, concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        started = time.perf_counter()
+        results = list(pool.map(lambda _: send_request(args.url, args.body, args.token, args.timeout), range(requests_total)))
+        elapsed = time.perf_counter() - started
+
+    latencies = sorted(latency for latency, ok in results if ok)
+    errors = sum(1 for _, ok in results if not ok)
+    to_ms = lambda value: round(value * 1000, 1) if value is not None else None
+    return {
+        "concurrency": concurrency,
+        "requests": requests_total,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "requests_per_second": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": to_ms(percentile(latencies, 0.50)),
+        "p95_ms": to_ms(percentile(latencies, 0.95)),
+        "p99_ms": to_ms(percentile(latencies, 0.99)),
+        "mean_ms": to_ms(statistics.mean(latencies)) if latencies else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:5000/health")
+    parser.add_argument("--concurrency", default="1,2,4,8,16,32", help="Comma-separated concurrency levels to sweep.")
+    parser.add_argument("--requests-per-worker", type=int, default=20, help="Requests per concurrent client at each level.")
+    parser.add_argument("--body", default=None, help="JSON body; when given the requests are POSTs.")
+    parser.add_argument("--token", default=None, help="JWT access token for protected endpoints.")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    # One request first so connection setup and lazy initialization are not measured
+    send_request(args.url, args.body, args.token, args.timeout)
+
+    results = [run_level(args, int(level)) for level in args.concurrency.split(",")]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Offline end-to-end load test of the chat, session list, history and config upload APIs.
+
+Boots create_app() in-process against local stand-ins (benchmarks/local_backends.py):
+mongomock, or a local mongod with --mongo-uri, fake deterministic chat models behind the
+OpenAI/Qwen/DeepSeek branches, hashing embeddings and a brute-force vector search. Every
+scenario is run at each concurrency level through Flask test clients on a thread pool.
+
+Reports per scenario and concurrency level, as JSON:
+throughput, p50/p95/p99 latency, errors, 429 rejections, Mongo operations per request and peak RSS.
+Save the output per commit and diff it to spot regressions. Every chat goes to one config, whose
+admission limits follow GUNICORN_THREADS (src/services/admission_service.py); raise it, e.g.
+GUNICORN_THREADS=16, to measure the pipeline rather than the 429s at higher concurrency.
+
+Run from backend/:
+    python -m benchmarks.load_test --concurrency 1,8,32 --requests 200 --output load.json
+    python -m benchmarks.load_test --mongo-uri mongodb://localhost:27017 --scenarios chat,history
+"""
+import argparse
+import io
+import json
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+SCENARIOS = ("chat", "list", "history", "ingest")
+WORDS = (
+    "retrieval augmented generation vector index chunk overlap embedding model prompt context "
+    "session history survey response agent latency throughput config upload document page "
+    "mongo atlas search query answer source token stream worker cache batch"
+).split()
+
+
+def set_offline_environment():
+    """Fills in the secrets create_app() requires and turns off the background workers."""
+    for key in [
+        "OPENAI_API_KEY", "QWEN_API_KEY", "DEEPSEEK_API_KEY", "MONGO_COLLECTION_NAME", "USERNAME",
+        "PASSWORD", "CHAT", "HOST", "PORT", "AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "AWS_REGION",
+        "AWS_S3_BUCKET_NAME", "NAME", "MAIL_SERVER", "MAIL_USERNAME", "MAIL_PASSWORD",
+        "MAIL_DEFAULT_SENDER", "SECRET_KEY", "FRONTEND_URL"
+    ]:
+        os.environ.setdefault(key, "offline")
+    os.environ.setdefault("MONGO_URI", "mongodb://localhost:27017")
+    os.environ.setdefault("MONGO_DB_NAME", "rag_load_test")
+    os.environ.setdefault("CONFIG", "configs")
+    os.environ.setdefault("USER", "users")
+    os.environ.setdefault("JWT_SECRET_KEY", "load-test-secret-key-of-sufficient-length")
+    os.environ.setdefault("JWT_TOKEN_LOCATION", "headers")
+    os.environ.setdefault("JWT_HEADER_NAME", "Authorization")
+    os.environ.setdefault("JWT_HEADER_TYPE", "Bearer")
+    os.environ.setdefault("MAIL_PORT", "587")
+    os.environ.setdefault("MAIL_USE_TLS", "true")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ["RAG_DEFER_WORKER_INIT"] = "true"
+    os.environ["ENSURE_INDEXES"] = "false"
+    os.environ["CONFIG_REAPER_ENABLED"] = "false"
+    os.environ["REEMBED_WORKER_ENABLED"] = "false"
+    # The shared cache tier runs in-process; CACHE_ENABLED=false measures the uncached pipeline
+    os.environ.setdefault("CACHE_SHARED", "local")
+
+
+def build_app(args, counter):
+    """create_app() with the per-process resources replaced by the local stand-ins."""
+    from app import create_app
+    from benchmarks.local_backends import HashingEmbeddings, install_fake_chat_models, install_local_vector_search, configure_fake_chat_models
+    from models.indexes import ensure_indexes, index_declarations
+    from src.utils.cache import configure_cache
+    from src.utils.logging_setup import start_log_listener
+
+    app = create_app()
+    app.config["JWT_TOKEN_LOCATION"] = ["headers"]
+    if args.mongo_uri:
+        import pymongo
+        client = pymongo.MongoClient(args.mongo_uri, event_listeners=[counter], maxPoolSize=max(args.concurrency_levels) + 10)
+    else:
+        import mongomock
+        from benchmarks.local_backends import patch_mongomock_bulk_write
+        patch_mongomock_bulk_write()
+        counter.wrap_mongomock()
+        client = mongomock.MongoClient()
+    client.drop_database(args.db_name)
+    db = client[args.db_name]
+
+    app.config["MONGO_CLIENT"] = client
+    app.config["MONGO_DB"] = db
+    app.config["MONGO_COLLECTION"] = db[app.config["USER"]]
+    app.config["EMBEDDINGS"] = HashingEmbeddings(dimensions=args.dimensions, latency=args.embedding_latency)
+    if args.mongo_uri:
+        ensure_indexes(db, index_declarations(app.config))
+    start_log_listener()
+    configure_cache()
+
+    configure_fake_chat_models(args.llm_latency, args.token_latency, args.answer_tokens)
+    install_fake_chat_models()
+    install_local_vector_search()
+    return app
+
+
+def make_document(rng, words: int) -> bytes:
+    return " ".join(rng.choice(WORDS) for _ in range(words)).encode()
+
+
+def upload_form(rng, args, index: int):
+    config = {
+        "bot_name": f"load-bot-{index}",
+        "model_name": args.model,
+        "temperature": 0.2,
+        "is_public": False,
+        "instructions": "Answer from the context.",
+    }
+    files = [(io.BytesIO(make_document(rng, args.document_words)), f"doc-{index}-{n}.txt") for n in range(args.documents)]
+    return {"config": json.dumps(config), "files": files}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def peak_rss_mb():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    return round(usage / (1024 * 1024) if sys.platform == "darwin" else usage / 1024, 1)
+
+
+class LoadTest:
+    def __init__(self, app, args, counter):
+        self.app = app
+        self.args = args
+        self.counter = counter
+        self.rng = random.Random(args.seed)
+        self.local = threading.local()
+        self.headers = {}
+        self.config_id = None
+        self.history_session = "load-history"
+
+    def client(self):
+        # One test client per thread; cookies are not shared between concurrent requests
+        if not hasattr(self.local, "client"):
+            self.local.client = self.app.test_client(use_cookies=False)
+        return self.local.client
+
+    def setup(self):
+        """Creates a user, uploads one config with documents and seeds a session for the history scenario."""
+        from bson import ObjectId
+        from flask_jwt_extended import create_access_token
+
+        user_id = ObjectId()
+        with self.app.app_context():
+            self.app.config["MONGO_DB"][self.app.config["USER"]].insert_one(
+                {"_id": user_id, "email": "load@example.com", "username": "load-test"}
+            )
+            token = create_access_token(identity=str(user_id))
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+        response = self.client().post("/api/config", data=upload_form(self.rng, self.args, 0), headers=self.headers, content_type="multipart/form-data")
+        if response.status_code != 201:
+            raise SystemExit(f"Config upload failed during setup: {response.status_code} {response.get_data(as_text=True)[:500]}")
+        self.config_id = response.get_json()["data"]["_id"]
+
+        for turn in range(self.args.history_turns):
+            self.chat(self.history_session, turn)
+
+    def chat(self, session_id, index):
+        return self.client().post(
+            f"/api/chat/{self.config_id}/{session_id}",
+            json={"input": f"question {index} about {self.rng.choice(WORDS)} and {self.rng.choice(WORDS)}"},
+            headers=self.headers
+        )
+
+    def request(self, scenario, index):
+        if scenario == "chat":
+            return self.chat(f"load-{index % self.args.sessions}", index)
+        if scenario == "list":
+            return self.client().get(f"/api/chat/list/{self.config_id}", headers=self.headers)
+        if scenario == "history":
+            return self.client().get(f"/api/history/{self.history_session}?limit={self.args.history_page}", headers=self.headers)
+        return self.client().post("/api/config", data=upload_form(self.rng, self.args, index), headers=self.headers, content_type="multipart/form-data")
+
+    def timed_request(self, scenario, index):
+        started = time.perf_counter()
+        response = self.request(scenario, index)
+        response.get_data()  # drain streamed bodies
+        return time.perf_counter() - started, response.status_code
+
+    def run_level(self, scenario, concurrency):
+        requests_total = self.args.requests if scenario != "ingest" else max(concurrency, self.args.requests // 10)
+        operations_before = self.counter.count
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            started = time.perf_counter()
+            results = list(pool.map(lambda index: self.timed_request(scenario, index), range(requests_total)))
+            elapsed = time.perf_counter() - started
+
+        latencies = sorted(latency for latency, status in results if 200 <= status < 300)
+        to_ms = lambda value: round(value * 1000, 2) if value is not None else None
+        return {
+            "scenario": scenario,
+            "concurrency": concurrency,
+            "requests": requests_total,
+            "errors": sum(1 for _, status in results if not 200 <= status < 300 and status != 429),
+            # Turned away by admission control (src/services/admission_service.py)
+            "rejected": sum(1 for _, status in results if status == 429),
+            "seconds": round(elapsed, 3),
+            "requests_per_second": round(len(latencies) / elapsed, 1) if elapsed else None,
+            "p50_ms": to_ms(percentile(latencies, 0.50)),
+            "p95_ms": to_ms(percentile(latencies, 0.95)),
+            "p99_ms": to_ms(percentile(latencies, 0.99)),
+            "mean_ms": to_ms(statistics.mean(latencies)) if latencies else None,
+            "mongo_ops_per_request": round((self.counter.count - operations_before) / requests_total, 2),
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,4,16", help="Comma-separated concurrency levels.")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per scenario and level (ingest runs a tenth).")
+    parser.add_argument("--mongo-uri", default=None, help="Local mongod to use instead of mongomock.")
+    parser.add_argument("--db-name", default="rag_load_test")
+    parser.add_argument("--model", default="gpt-4o-mini", help="Config model_name; picks the provider branch.")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="Fake model time to first token (s).")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Fake model delay per streamed token (s).")
+    parser.add_argument("--answer-tokens", type=int, default=40)
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Fake embedding call latency (s).")
+    parser.add_argument("--dimensions", type=int, default=256, help="Fake embedding dimensions.")
+    parser.add_argument("--documents", type=int, default=2, help="Files per config upload.")
+    parser.add_argument("--document-words", type=int, default=2000)
+    parser.add_argument("--sessions", type=int, default=20, help="Distinct chat sessions used by the chat scenario.")
+    parser.add_argument("--history-turns", type=int, default=50, help="Turns seeded into the history scenario's session.")
+    parser.add_argument("--history-page", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", default=None, help="Write the JSON report here instead of stdout.")
+    args = parser.parse_args()
+    args.concurrency_levels = [int(level) for level in args.concurrency.split(",")]
+    scenarios = [scenario for scenario in args.scenarios.split(",") if scenario]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    set_offline_environment()
+    from benchmarks.local_backends import MongoOperationCounter
+    counter = MongoOperationCounter()
+    app = build_app(args, counter)
+
+    test = LoadTest(app, args, counter)
+    test.setup()
+    results = [test.run_level(scenario, level) for scenario in scenarios for level in args.concurrency_levels]
+
+    report = {
+        "commit": git_commit(),
+        "backend": "mongod" if args.mongo_uri else "mongomock",
+        "settings": {key: value for key, value in vars(args).items() if key not in ("output", "concurrency_levels")},
+        "results": results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,302 @@
+"""
+Local stand-ins for the external services, used by the offline benchmarks.
+
+  FakeChatModel       deterministic chat model with configurable time to first token and
+                      per-token latency; swapped in for ChatOpenAI / ChatTongyi / ChatDeepSeek
+                      so the provider branches of src/backend/llm_factory.py still run
+  HashingEmbeddings   deterministic bag-of-words feature-hashing embeddings of any dimension;
+                      lexically meaningful, so retrieval quality can be measured offline
+  local_vector_search brute-force cosine search over a config's chunks, returning the same
+                      documents the $vectorSearch stage would (Atlas Search is not available
+                      on mongomock or a plain local mongod)
+  MongoOperationCounter counts the operations sent to Mongo (pymongo command monitoring for a
+                      real mongod, wrapped collection methods for mongomock)
+  RateLimitedProvider a provider that enforces its own request and token limits and answers
+                      over-limit calls with a 429, behind RateLimitedChatModel and
+                      RateLimitedEmbeddings (benchmarks/bench_scheduler.py)
+"""
+import asyncio
+import hashlib
+import math
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, List, Optional
+from pymongo import monitoring
+from langchain_core.callbacks import CallbackManagerForLLMRun, AsyncCallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Latencies applied by every FakeChatModel; set with configure_fake_chat_models()
+FAKE_CHAT_SETTINGS = {"first_token_latency": 0.05, "token_latency": 0.0, "answer_tokens": 40}
+
+def configure_fake_chat_models(first_token_latency: float, token_latency: float, answer_tokens: int):
+    FAKE_CHAT_SETTINGS.update(first_token_latency=first_token_latency, token_latency=token_latency, answer_tokens=answer_tokens)
+
+
+class FakeChatModel(BaseChatModel):
+    """Answers deterministically from the last message, after the configured latencies."""
+
+    model: str = "fake"
+    temperature: Optional[float] = None
+    api_key: Optional[Any] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-latency-chat"
+
+    def _answer_tokens(self, messages: List[BaseMessage]) -> List[str]:
+        question = messages[-1].content if messages else ""
+        seed = hashlib.sha1(f"{self.model}:{question}".encode()).hexdigest()
+        return [f"{self.model}"] + [f" w{seed[i % len(seed)]}{i}" for i in range(FAKE_CHAT_SETTINGS["answer_tokens"] - 1)]
+
+    def _generate(self, messages, stop=None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs) -> ChatResult:
+        tokens = self._answer_tokens(messages)
+        time.sleep(FAKE_CHAT_SETTINGS["first_token_latency"] + FAKE_CHAT_SETTINGS["token_latency"] * len(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    def _stream(self, messages, stop=None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs):
+        time.sleep(FAKE_CHAT_SETTINGS["first_token_latency"])
+        for index, token in enumerate(self._answer_tokens(messages)):
+            if index and FAKE_CHAT_SETTINGS["token_latency"]:
+                time.sleep(FAKE_CHAT_SETTINGS["token_latency"])
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+    async def _agenerate(self, messages, stop=None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs) -> ChatResult:
+        tokens = self._answer_tokens(messages)
+        await asyncio.sleep(FAKE_CHAT_SETTINGS["first_token_latency"] + FAKE_CHAT_SETTINGS["token_latency"] * len(tokens))
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="".join(tokens)))])
+
+    async def _astream(self, messages, stop=None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs):
+        await asyncio.sleep(FAKE_CHAT_SETTINGS["first_token_latency"])
+        for index, token in enumerate(self._answer_tokens(messages)):
+            if index and FAKE_CHAT_SETTINGS["token_latency"]:
+                await asyncio.sleep(FAKE_CHAT_SETTINGS["token_latency"])
+            yield ChatGenerationChunk(message=AIMessageChunk(content=token))
+
+
+def install_fake_chat_models():
+    """Replaces the provider classes used by llm_factory with FakeChatModel and clears the model cache."""
+    from src.backend import llm_factory
+    llm_factory.ChatOpenAI = FakeChatModel
+    llm_factory.ChatTongyi = FakeChatModel
+    llm_factory.ChatDeepSeek = FakeChatModel
+    llm_factory.reset_chat_models()
+
+
+class HashingEmbeddings(Embeddings):
+    """Feature-hashing bag-of-words embeddings: each token adds +/-1 to one of `dimensions` buckets."""
+
+    def __init__(self, dimensions: int = 256, latency: float = 0.0):
+        self.dimensions = dimensions
+        self.latency = latency
+
+    def _embed(self, text: str) -> List[float]:
+        vector = [0.0] * self.dimensions
+        for token in TOKEN_PATTERN.findall(text.lower()):
+            digest = hashlib.md5(token.encode()).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimensions
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if self.latency:
+            time.sleep(self.latency)
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.latency:
+            time.sleep(self.latency)
+        return self._embed(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self._embed(text)
+
+
+def local_vector_search(collection, query_vector: List[float], config_id: str, k: int, embedding_key: str = "embedding") -> List[dict]:
+    """Exact cosine top-k over the config's chunks, shaped like the documents $vectorSearch returns."""
+    from src.backend.embedding_factory import EMBEDDING_FIELDS
+    scored = []
+    for doc in collection.find({"config_id": config_id}):
+        vector = doc.get(embedding_key)
+        for field in EMBEDDING_FIELDS:
+            doc.pop(field, None)
+        if not vector:
+            continue
+        score = sum(a * b for a, b in zip(query_vector, vector))
+        scored.append((score, doc))
+    scored.sort(key=lambda item: item[0], reverse=True)
+    return [doc for _, doc in scored[:k]]
+
+
+def install_local_vector_search():
+    """Serves the Flask chat route's and the batch evaluation's retrieval from local_vector_search instead of Atlas $vectorSearch."""
+    from routes import chat_routes
+    from src.services import batch_eval_service, chat_service
+    from src.services.chat_service import documents_from_search
+
+    def retrieve(vector_collection, embeddings, query, config_id, timer, k=chat_service.RETRIEVAL_K, index_name=None, path=chat_service.EMBEDDING_KEY,
+                 embedding_model=None):
+        with timer.stage("embedding"):
+            query_vector = chat_service.embed_query_cached(embeddings, embedding_model, query) if embedding_model else embeddings.embed_query(query)
+        with timer.stage("vector_search"):
+            results = local_vector_search(vector_collection, query_vector, config_id, k, path)
+        return documents_from_search(results)
+
+    def search_many(vector_collection, query_vectors, config_id, k, concurrency, index_name=None, path=chat_service.EMBEDDING_KEY):
+        return [documents_from_search(local_vector_search(vector_collection, vector, config_id, k, path)) for vector in query_vectors]
+
+    chat_routes.retrieve = retrieve
+    batch_eval_service.search_many = search_many
+
+
+class ProviderRateLimitError(Exception):
+    """The 429 of a RateLimitedProvider, shaped like the OpenAI SDK's RateLimitError."""
+
+    status_code = 429
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit reached, retry after {retry_after:.2f}s")
+        self.response = SimpleNamespace(status_code=429, headers={"retry-after": f"{retry_after:.3f}"})
+
+
+class RateLimitedProvider:
+    """
+    Requests and tokens per `window` seconds, replenished continuously like OpenAI's limits.
+    A call over either limit is rejected (and counted) instead of served.
+    """
+
+    def __init__(self, rpm: float, tpm: float, window: float = 60.0):
+        self.requests = [float(rpm), float(rpm), rpm / window]
+        self.tokens = [float(tpm), float(tpm), tpm / window]
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.served = 0
+        self.rejected = 0
+
+    def admit(self, tokens: int):
+        with self.lock:
+            now = time.monotonic()
+            for bucket in (self.requests, self.tokens):
+                bucket[0] = min(bucket[1], bucket[0] + (now - self.updated) * bucket[2])
+            self.updated = now
+            short = max((1 - self.requests[0]) / self.requests[2], (tokens - self.tokens[0]) / self.tokens[2])
+            if short > 1e-6:  # float noise at the exact boundary is not a violation
+                self.rejected += 1
+                raise ProviderRateLimitError(short)
+            self.requests[0] -= 1
+            self.tokens[0] -= tokens
+            self.served += 1
+
+
+class RateLimitedChatModel(BaseChatModel):
+    """A chat model served by a RateLimitedProvider; reports its token usage like the real clients."""
+
+    provider: Any
+    latency: float = 0.05
+    answer_tokens: int = 60
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-rate-limited-chat"
+
+    def _generate(self, messages, stop=None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs) -> ChatResult:
+        prompt_tokens = sum(len(message.content) // 4 + 5 for message in messages)
+        self.provider.admit(prompt_tokens + self.answer_tokens)
+        time.sleep(self.latency)
+        usage = {"input_tokens": prompt_tokens, "output_tokens": self.answer_tokens, "total_tokens": prompt_tokens + self.answer_tokens}
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content="ok " * self.answer_tokens, usage_metadata=usage))])
+
+
+class RateLimitedEmbeddings(HashingEmbeddings):
+    """HashingEmbeddings served by a RateLimitedProvider."""
+
+    def __init__(self, provider: RateLimitedProvider, dimensions: int = 64, latency: float = 0.02):
+        super().__init__(dimensions, latency)
+        self.provider = provider
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self.provider.admit(sum(len(text) // 4 + 1 for text in texts))
+        return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        self.provider.admit(len(text) // 4 + 1)
+        return super().embed_query(text)
+
+
+class MongoOperationCounter(monitoring.CommandListener):
+    """Counts Mongo operations. Register with MongoClient(event_listeners=[counter]) or wrap_mongomock()."""
+
+    OPERATIONS = ("find", "insert", "update", "delete", "aggregate", "count", "findAndModify", "getMore", "distinct")
+    MONGOMOCK_METHODS = (
+        "find", "find_one", "insert_one", "insert_many", "update_one", "update_many", "replace_one",
+        "delete_one", "delete_many", "aggregate", "count_documents", "find_one_and_update",
+        "find_one_and_delete", "bulk_write", "distinct"
+    )
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def add(self):
+        with self._lock:
+            self.count += 1
+
+    def started(self, event):
+        if event.command_name in self.OPERATIONS:
+            self.add()
+
+    def succeeded(self, event):
+        pass
+
+    def failed(self, event):
+        pass
+
+    def wrap_mongomock(self):
+        """Counts calls of the mongomock Collection methods (one per server round trip on a real server)."""
+        import mongomock.collection
+        counter = self
+        # mongomock methods call each other (find_one -> find); only the outermost call is an operation
+        nesting = threading.local()
+        for name in self.MONGOMOCK_METHODS:
+            original = getattr(mongomock.collection.Collection, name)
+
+            def counted(collection, *args, __original=original, **kwargs):
+                depth = getattr(nesting, "depth", 0)
+                if depth == 0:
+                    counter.add()
+                nesting.depth = depth + 1
+                try:
+                    return __original(collection, *args, **kwargs)
+                finally:
+                    nesting.depth = depth
+
+            setattr(mongomock.collection.Collection, name, counted)
+
+
+def patch_mongomock_bulk_write():
+    """
+    pymongo >= 4.11 passes a `sort` argument to the bulk builder for ReplaceOne/UpdateOne, which
+    mongomock's builder does not accept yet; drop it (the ingestion upserts never sort).
+    """
+    import inspect
+    import mongomock.collection
+    builder = mongomock.collection.BulkOperationBuilder
+    for name in ("add_replace", "add_update"):
+        original = getattr(builder, name)
+        if "sort" in inspect.signature(original).parameters:
+            continue
+
+        def without_sort(self, *args, __original=original, sort=None, **kwargs):
+            return __original(self, *args, **kwargs)
+
+        setattr(builder, name, without_sort)
+
@@ -0,0 +1,55 @@
+import os
+import multiprocessing
+
+# --- Gunicorn configuration for the production backend ---
+# The app is imported once in the master (preload_app) so workers share its code pages and start fast.
+# Anything holding sockets or threads (Mongo client, embedding/LLM clients, background workers) is
+# created per worker in post_fork, as those do not survive fork(). See src/backend/resources.py.
+
+os.environ.setdefault("RAG_DEFER_WORKER_INIT", "true")
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+preload_app = True
+
+# Requests spend most of their time waiting on the LLM, the embedding API and Mongo, so each
+# worker runs several threads. Size workers to the CPU count and threads to the expected
+# concurrent in-flight LLM calls per worker (see DEPLOYMENT.md, "Production serving").
+# For the async chat endpoint serve asgi:app with GUNICORN_WORKER_CLASS=uvicorn.workers.UvicornWorker;
+# `threads` does not apply there (Flask routes use ASGI_WSGI_THREADS instead).
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+
+# Chat responses can take a while to stream
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 300))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+# Recycle workers now and then to bound memory growth
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 200))
+
+accesslog = "-"
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+def flask_app(worker):
+    """The Flask app behind the served app; asgi:app keeps it in app.state.flask_app."""
+    app = worker.app.wsgi()
+    state = getattr(app, "state", None)
+    return getattr(state, "flask_app", app)
+
+def post_fork(server, worker):
+    from src.backend.resources import init_resources, start_background_tasks
+    app = flask_app(worker)
+    init_resources(app)
+    start_background_tasks(app)
+
+def post_worker_init(worker):
+    from src.backend.resources import warm_up, env_flag
+    if env_flag("WORKER_WARMUP"):
+        warm_up(flask_app(worker))
+
+def worker_exit(server, worker):
+    from src.backend.resources import flush_remaining_usage
+    flush_remaining_usage(flask_app(worker))
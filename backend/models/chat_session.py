@@ -0,0 +1,115 @@
+from flask import current_app
+from bson import ObjectId
+from pymongo import ASCENDING, DESCENDING, IndexModel, ReturnDocument
+
+TITLE_MAX_LENGTH = 100
+
+
+class ChatSession:
+    """
+    Model for the chat_session_metadata collection.
+    One document per chat session, carrying the owner, the config it belongs to
+    and a denormalized summary (title, message count, last activity) that is
+    kept up to date as messages are written, so the session list never has to
+    touch message_store.
+    """
+
+    COLLECTION_NAME = "chat_session_metadata"
+
+    # Indexes provisioned at startup by models/indexes.py
+    INDEXES = [
+        IndexModel([("session_id", ASCENDING)], name="session_id_1", background=True),
+        IndexModel([("config_id", ASCENDING), ("user_id", ASCENDING), ("_id", DESCENDING)], name="config_id_1_user_id_1__id_-1", background=True),
+    ]
+
+    # Query shapes served by these indexes, checked by `flask index-report`
+    HOT_QUERIES = [
+        {"name": "session by id", "filter": {"session_id": "<session_id>"}},
+        {"name": "session list page", "filter": {"config_id": "<config_id>", "user_id": "<user_id>"}, "sort": [("_id", DESCENDING)]},
+        {"name": "sessions of a config", "filter": {"config_id": "<config_id>"}},
+    ]
+
+    # find_one_and_update options that return only the message count after the update, so the
+    # history cache (src/services/history_cache.py) can tell whether a session changed elsewhere
+    MESSAGE_COUNT_OPTIONS = {"projection": {"message_count": 1}, "return_document": ReturnDocument.AFTER}
+
+    @staticmethod
+    def get_collection():
+        """Returns the chat_session_metadata collection from the shared database handle."""
+        return current_app.config['MONGO_DB'][ChatSession.COLLECTION_NAME]
+
+    @staticmethod
+    def ensure_update(session_id, user_id, config_id):
+        """Filter and upsert update that create the metadata document of a session if it does not exist yet."""
+        return (
+            {"session_id": session_id},
+            {"$setOnInsert": {"user_id": user_id, "config_id": config_id, "session_id": session_id}}
+        )
+
+    @staticmethod
+    def taken_by_other(session_id, user_id, config_id) -> bool:
+        """Whether the session already exists for another user or config, and so must not be written to."""
+        session = ChatSession.get_collection().find_one({"session_id": session_id}, {"user_id": 1, "config_id": 1})
+        return session is not None and (session.get("user_id"), session.get("config_id")) != (user_id, config_id)
+
+    @staticmethod
+    def config_of(session_id):
+        """The config_id of a session, or None if the session has no metadata."""
+        session = ChatSession.get_collection().find_one({"session_id": session_id}, {"config_id": 1})
+        return session.get("config_id") if session else None
+
+    @staticmethod
+    def message_count(summary) -> int:
+        """The message count of a summary returned with MESSAGE_COUNT_OPTIONS."""
+        return (summary or {}).get("message_count", 0)
+
+    @staticmethod
+    def ensure(session_id, user_id, config_id) -> int:
+        """Creates the metadata document for a session if it does not exist yet; returns its message count."""
+        return ChatSession.message_count(ChatSession.get_collection().find_one_and_update(
+            *ChatSession.ensure_update(session_id, user_id, config_id), upsert=True, **ChatSession.MESSAGE_COUNT_OPTIONS
+        ))
+
+    @staticmethod
+    def record_message_update(session_id, content, count=1):
+        """
+        Filter and pipeline update that add `count` newly written messages to the session summary.
+        `content` is the first of them; the first message with content becomes the session's title.
+        """
+        title = content[:TITLE_MAX_LENGTH] if isinstance(content, str) and content else None
+        return (
+            {"session_id": session_id},
+            [{"$set": {
+                "title": {"$ifNull": ["$title", title]},
+                "message_count": {"$add": [{"$ifNull": ["$message_count", 0]}, count]},
+                "last_activity": "$$NOW"
+            }}]
+        )
+
+    @staticmethod
+    def record_message(session_id, content, count=1) -> int:
+        """Updates the session summary for `count` newly written messages in a single round trip; returns the new message count."""
+        return ChatSession.message_count(ChatSession.get_collection().find_one_and_update(
+            *ChatSession.record_message_update(session_id, content, count), **ChatSession.MESSAGE_COUNT_OPTIONS
+        ))
+
+    @staticmethod
+    def claim_anonymous(config_id, user_id):
+        """Assigns every anonymous session of a config to the given user."""
+        return ChatSession.get_collection().update_many(
+            {"config_id": config_id, "user_id": "anonymous"},
+            {"$set": {"user_id": user_id}}
+        )
+
+    @staticmethod
+    def list_for_user(config_id, user_id, before=None, limit=50):
+        """
+        Returns one page of a user's sessions for a config, newest first.
+        `before` is the _id of the last session of the previous page.
+        """
+        query = {"config_id": config_id, "user_id": user_id}
+        if before:
+            query["_id"] = {"$lt": ObjectId(before)}
+
+        projection = {"session_id": 1, "title": 1, "message_count": 1, "last_activity": 1}
+        return ChatSession.get_collection().find(query, projection).sort("_id", DESCENDING).limit(limit)
@@ -1,22 +1,46 @@
 from flask import current_app
-import pymongo
+from datetime import datetime, timezone
+from pymongo import ASCENDING, IndexModel
 from werkzeug.security import generate_password_hash, check_password_hash
 from bson import ObjectId  
+from src.utils.cache import BsonCodec, bump_config_version, bump_content_version, config_key, two_level_cache
+
+# Config documents read on the chat path (see src/utils/cache.py); a short local TTL bounds how long
+# another worker without the shared tier can serve a changed config
+CONFIG_CACHE = two_level_cache("config", BsonCodec, local_entries=10_000, local_ttl=30)
+
 class Config:
     """
     User model for interacting with the users collection in MongoDB.
     This class encapsulates all database logic for users.
     """
 
+    # Configs marked for deletion carry `deleted_at` until the background reaper
+    # (src/services/config_deletion_service.py) removes them; every read excludes them.
+    ACTIVE = {"deleted_at": {"$exists": False}}
+
+    # Indexes provisioned at startup by models/indexes.py
+    INDEXES = [
+        IndexModel([("user_id", ASCENDING)], name="user_id_1", background=True),
+        IndexModel([("deleted_at", ASCENDING)], name="deleted_at_1", sparse=True, background=True),
+        IndexModel([("reembed.status", ASCENDING)], name="reembed.status_1", sparse=True, background=True),
+    ]
+
+    # Query shapes served by these indexes, checked by `flask index-report`
+    HOT_QUERIES = [
+        {"name": "configs by owner", "filter": {"user_id": "<user_id>", "deleted_at": {"$exists": False}}},
+        {"name": "configs pending deletion", "filter": {"deleted_at": {"$exists": True}}},
+        {"name": "unfinished re-embeddings", "filter": {"reembed.status": {"$in": ["pending", "running", "switched"]}}},
+    ]
+
     @staticmethod
     def get_collection():
         """
-        A helper method to get the user collection object from the database.
-        It assumes you have a 'MONGO_CLIENT' in your app config.
+        A helper method to get the collection object from the database.
+        It uses the process-wide client in 'MONGO_DB' (see src/backend/resources.py)
+        instead of opening a new connection pool per call.
         """
-        mongo_client = pymongo.MongoClient(current_app.config["MONGO_URI"], serverSelectionTimeoutMS=5000)
-        # Get the database from the client
-        db = mongo_client[current_app.config["MONGO_DB_NAME"]]
+        db = current_app.config["MONGO_DB"]
         # Get the collection using the name stored in the config
         return db[current_app.config["CONFIG"]]
 
@@ -29,21 +53,56 @@ class Config:
         config_collection = Config.get_collection()
         
         # Hash the password before storing
-        current_app.logger.info(f"{obj}")
+        current_app.logger.debug(f"Creating config with fields {sorted(obj)}")
         
         
         return config_collection.insert_one(obj)
 
     @staticmethod
-    def find_by_id(id):
-        """Finds a user by their email address."""
+    def find_by_id(id, max_time_ms=None):
+        """Finds a config by its _id, ignoring configs marked for deletion."""
         
-        return Config.get_collection().find_one({"_id":ObjectId(id)})
+        return Config.get_collection().find_one({"_id":ObjectId(id), **Config.ACTIVE}, max_time_ms=max_time_ms)
+
+    @staticmethod
+    def find_by_id_cached(id, max_time_ms=None):
+        """find_by_id() through the config cache; writes to a config must call Config.invalidate()."""
+        return CONFIG_CACHE.get_or_load(config_key(id), lambda: Config.find_by_id(id, max_time_ms=max_time_ms), stage="config_lookup")
+
+    @staticmethod
+    def invalidate(id):
+        """Drops the cached config document; its cached retrievals stay valid until its chunks change."""
+        bump_config_version(id)
+
+    @staticmethod
+    def find_owned(id, user_id):
+        """Finds a config by its _id if it belongs to the given user, ignoring configs marked for deletion."""
+        return Config.get_collection().find_one({"_id": ObjectId(id), "user_id": user_id, **Config.ACTIVE})
 
     @staticmethod
     def find_by_user_id(user_id):
-        """Finds a user by their username."""
-        return Config.get_collection().find({"user_id": user_id})
+        """Finds all configs of a user, ignoring configs marked for deletion."""
+        return Config.get_collection().find({"user_id": user_id, **Config.ACTIVE})
+
+    @staticmethod
+    def mark_deleted(id, user_id):
+        """
+        Soft-deletes a config owned by the given user. The config disappears from all reads
+        immediately; its vectors, messages and session metadata are removed later by the reaper.
+        Returns True if a config was marked.
+        """
+        result = Config.get_collection().update_one(
+            {"_id": ObjectId(id), "user_id": user_id, **Config.ACTIVE},
+            {"$set": {
+                "deleted_at": datetime.now(timezone.utc),
+                "deletion": {"status": "pending", "vectors_deleted": 0, "messages_deleted": 0, "sessions_deleted": 0}
+            }}
+        )
+        if result.modified_count == 1:
+            Config.invalidate(id)
+            bump_content_version(id)
+            return True
+        return False
 
    
 
@@ -0,0 +1,115 @@
+import logging
+import sys
+import threading
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+
+from models.config import Config
+from models.user import User
+from models.chat_session import ChatSession
+from models.message_store import MessageStore
+from models.vector_stores import VectorChunks
+from models.usage_rollup import UsageRollup
+
+logger = logging.getLogger(__name__)
+
+
+def index_declarations(app_config):
+    """
+    Returns (collection_name, model) pairs for every model that declares INDEXES and HOT_QUERIES.
+    The configs and users collection names come from the app config, the rest are fixed.
+    """
+    return [
+        (app_config.get("CONFIG") or "configs", Config),
+        (app_config.get("USER") or "users", User),
+        (ChatSession.COLLECTION_NAME, ChatSession),
+        (MessageStore.COLLECTION_NAME, MessageStore),
+        (VectorChunks.COLLECTION_NAME, VectorChunks),
+        (UsageRollup.COLLECTION_NAME, UsageRollup),
+    ]
+
+def ensure_indexes(db: Database, declarations):
+    """
+    Creates every declared index that does not exist yet. Creating an index that already exists
+    with the same spec is a no-op on the server, so this is safe to run on every startup.
+    Returns the list of collections whose indexes could not be created.
+    """
+    failed = []
+    for collection_name, model in declarations:
+        try:
+            names = db[collection_name].create_indexes(model.INDEXES)
+            logger.info(f"Indexes ensured on '{collection_name}': {', '.join(names)}")
+        except OperationFailure as e:
+            # Typically an existing index with the same name but a different spec
+            logger.error(f"Failed to ensure indexes on '{collection_name}': {e}")
+            failed.append(collection_name)
+    return failed
+
+def start_index_provisioning(db: Database, app_config):
+    """Ensures the declared indexes on a daemon thread so app startup does not wait for index builds."""
+    thread = threading.Thread(
+        target=ensure_indexes,
+        args=(db, index_declarations(app_config)),
+        name="index-provisioning",
+        daemon=True
+    )
+    thread.start()
+    return thread
+
+def find_plan_stages(plan):
+    """Returns every stage name in an explain() plan tree."""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(find_plan_stages(value))
+    elif isinstance(plan, list):
+        for item in plan:
+            stages.extend(find_plan_stages(item))
+    return stages
+
+def explain_hot_queries(db: Database, declarations):
+    """
+    Runs explain() on every declared hot query and reports the stages of the winning plan.
+    A query is flagged when its winning plan contains a COLLSCAN.
+    """
+    report = []
+    for collection_name, model in declarations:
+        for query in model.HOT_QUERIES:
+            cursor = db[collection_name].find(query["filter"])
+            if query.get("sort"):
+                cursor = cursor.sort(query["sort"])
+            explanation = cursor.limit(query.get("limit", 50)).explain()
+            stages = find_plan_stages(explanation.get("queryPlanner", {}).get("winningPlan", {}))
+            report.append({
+                "collection": collection_name,
+                "query": query["name"],
+                "stages": stages,
+                "collscan": "COLLSCAN" in stages,
+            })
+    return report
+
+@click.command("ensure-indexes")
+@with_appcontext
+def ensure_indexes_command():
+    """Create all declared indexes and wait for the builds to finish."""
+    failed = ensure_indexes(current_app.config['MONGO_DB'], index_declarations(current_app.config))
+    if failed:
+        click.echo(f"Failed collections: {', '.join(failed)}")
+        sys.exit(1)
+    click.echo("All declared indexes exist.")
+
+@click.command("index-report")
+@with_appcontext
+def index_report_command():
+    """Explain every hot query pattern and flag collection scans."""
+    report = explain_hot_queries(current_app.config['MONGO_DB'], index_declarations(current_app.config))
+    for entry in report:
+        flag = "COLLSCAN" if entry["collscan"] else "ok"
+        click.echo(f"[{flag:>8}] {entry['collection']}: {entry['query']} -> {' > '.join(entry['stages'])}")
+    if any(entry["collscan"] for entry in report):
+        sys.exit(1)
@@ -0,0 +1,33 @@
+from flask import current_app
+from pymongo import ASCENDING, DESCENDING, IndexModel
+
+
+class MessageStore:
+    """
+    Model for the message_store collection, which holds every chat message as one document
+    keyed by SessionId (see src/backend/database/mongo_utils.py for the document format).
+    """
+
+    COLLECTION_NAME = "message_store"
+
+    # Indexes provisioned at startup by models/indexes.py
+    INDEXES = [
+        IndexModel([("SessionId", ASCENDING), ("_id", ASCENDING)], name="SessionId_1__id_1", background=True),
+        # Transcript exports (src/services/transcript_export_service.py)
+        IndexModel([("config_id", ASCENDING), ("_id", ASCENDING)], name="config_id_1__id_1", background=True),
+        IndexModel([("SurveyId", ASCENDING), ("_id", ASCENDING)], name="SurveyId_1__id_1",
+                   partialFilterExpression={"SurveyId": {"$exists": True}}, background=True),
+    ]
+
+    # Query shapes served by these indexes, checked by `flask index-report`
+    HOT_QUERIES = [
+        {"name": "session history", "filter": {"SessionId": "<session_id>"}, "sort": [("_id", ASCENDING)]},
+        {"name": "session history page", "filter": {"SessionId": "<session_id>"}, "sort": [("_id", DESCENDING)]},
+        {"name": "export by config", "filter": {"config_id": "<config_id>"}, "sort": [("_id", ASCENDING)]},
+        {"name": "export by survey", "filter": {"SurveyId": "<survey_id>"}, "sort": [("_id", ASCENDING)]},
+    ]
+
+    @staticmethod
+    def get_collection():
+        """Returns the message_store collection from the shared database handle."""
+        return current_app.config['MONGO_DB'][MessageStore.COLLECTION_NAME]
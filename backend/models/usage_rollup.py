@@ -0,0 +1,30 @@
+from flask import current_app
+from pymongo import ASCENDING, IndexModel
+
+
+class UsageRollup:
+    """
+    Model for the usage_rollups collection. One document per config, request kind (chat, ingest),
+    model and time bucket, holding counters that every worker adds to with $inc
+    (see src/services/usage_service.py for the fields).
+    """
+
+    COLLECTION_NAME = "usage_rollups"
+
+    # Indexes provisioned at startup by models/indexes.py
+    INDEXES = [
+        IndexModel([("config_id", ASCENDING), ("kind", ASCENDING), ("model", ASCENDING), ("bucket", ASCENDING)],
+                   name="config_id_1_kind_1_model_1_bucket_1", unique=True, background=True),
+        IndexModel([("owner_id", ASCENDING), ("bucket", ASCENDING)], name="owner_id_1_bucket_1", background=True),
+    ]
+
+    # Query shapes served by these indexes, checked by `flask index-report`
+    HOT_QUERIES = [
+        {"name": "usage of an owner", "filter": {"owner_id": "<owner_id>", "bucket": {"$gte": "<start>"}}, "sort": [("bucket", ASCENDING)]},
+        {"name": "usage of a config", "filter": {"config_id": "<config_id>"}},
+    ]
+
+    @staticmethod
+    def get_collection():
+        """Returns the usage_rollups collection from the shared database handle."""
+        return current_app.config['MONGO_DB'][UsageRollup.COLLECTION_NAME]
@@ -1,5 +1,5 @@
 from flask import current_app
-import pymongo
+from pymongo import ASCENDING, IndexModel
 from werkzeug.security import generate_password_hash, check_password_hash
 from bson import ObjectId
 
@@ -9,15 +9,26 @@ class User:
     This class encapsulates all database logic for users.
     """
 
+    # Indexes provisioned at startup by models/indexes.py
+    INDEXES = [
+        IndexModel([("email", ASCENDING)], name="email_1", background=True),
+        IndexModel([("username", ASCENDING)], name="username_1", background=True),
+    ]
+
+    # Query shapes served by these indexes, checked by `flask index-report`
+    HOT_QUERIES = [
+        {"name": "user by email", "filter": {"email": "<email>"}},
+        {"name": "user by username", "filter": {"username": "<username>"}},
+    ]
+
     @staticmethod
     def get_collection():
         """
-        A helper method to get the user collection object from the database.
-        It assumes you have a 'MONGO_CLIENT' in your app config.
+        A helper method to get the collection object from the database.
+        It uses the process-wide client in 'MONGO_DB' (see src/backend/resources.py)
+        instead of opening a new connection pool per call.
         """
-        mongo_client = pymongo.MongoClient(current_app.config["MONGO_URI"], serverSelectionTimeoutMS=5000)
-        # Get the database from the client
-        db = mongo_client[current_app.config["MONGO_DB_NAME"]]
+        db = current_app.config["MONGO_DB"]
         # Get the collection using the name stored in the config
         return db[current_app.config["USER"]]
 
@@ -30,7 +41,7 @@ class User:
         users_collection = User.get_collection()
         
         # Hash the password before storing
-        current_app.logger.info(f"{obj}")
+        current_app.logger.debug(f"Creating user with fields {sorted(obj)}")
         
         
         return users_collection.insert_one(obj)
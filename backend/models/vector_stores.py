@@ -1,7 +1,13 @@
+import sys
+import click
 from flask import current_app
-import pymongo
+from flask.cli import with_appcontext
+from pymongo import ASCENDING, IndexModel
 from werkzeug.security import generate_password_hash, check_password_hash
 from bson import ObjectId  
+
+from models.config import Config
+from src.backend.embedding_factory import LEGACY_EMBEDDING_MODEL, embedding_model_of
 class VectorStores:
     """
     User model for interacting with the users collection in MongoDB.
@@ -11,12 +17,11 @@ class VectorStores:
     @staticmethod
     def get_collection():
         """
-        A helper method to get the user collection object from the database.
-        It assumes you have a 'MONGO_CLIENT' in your app config.
+        A helper method to get the collection object from the database.
+        It uses the process-wide client in 'MONGO_DB' (see src/backend/resources.py)
+        instead of opening a new connection pool per call.
         """
-        mongo_client = pymongo.MongoClient(current_app.config["MONGO_URI"], serverSelectionTimeoutMS=5000)
-        # Get the database from the client
-        db = mongo_client[current_app.config["MONGO_DB_NAME"]]
+        db = current_app.config["MONGO_DB"]
         # Get the collection using the name stored in the config
         return db[current_app.config["VectorStores"]]
 
@@ -29,7 +34,7 @@ class VectorStores:
         vector_stores_collection = VectorStores.get_collection()
         
         # Hash the password before storing
-        current_app.logger.info(f"{obj}")
+        current_app.logger.debug(f"Creating vector store with fields {sorted(obj)}")
         
         
         return vector_stores_collection.insert_one(obj)
@@ -45,4 +50,64 @@ class VectorStores:
         """Finds a user by their username."""
         return VectorStores.get_collection().find({"user_id": user_id})
 
-   
\ No newline at end of file
+   
+
+class VectorChunks:
+    """
+    Model for vector_collection, where MongoDBAtlasVectorSearch stores one document per
+    document chunk (text, embedding and metadata such as config_id).
+    The Atlas vector search index ("vector") is managed in Atlas; the regular indexes
+    below serve the non-vector queries such as cascading deletes.
+    """
+
+    COLLECTION_NAME = "vector_collection"
+
+    # Indexes provisioned at startup by models/indexes.py
+    INDEXES = [
+        IndexModel([("config_id", ASCENDING)], name="config_id_1", background=True),
+        # Re-embedding walks a config's chunks in _id order (src/services/reembed_service.py)
+        IndexModel([("config_id", ASCENDING), ("_id", ASCENDING)], name="config_id_1__id_1", background=True),
+    ]
+
+    # Query shapes served by these indexes, checked by `flask index-report`
+    HOT_QUERIES = [
+        {"name": "chunks of a config", "filter": {"config_id": "<config_id>"}},
+        {"name": "re-embedding batch", "filter": {"config_id": "<config_id>"}, "sort": [("_id", ASCENDING)]},
+    ]
+
+    @staticmethod
+    def get_collection():
+        """Returns the vector_collection collection from the shared database handle."""
+        return current_app.config['MONGO_DB'][VectorChunks.COLLECTION_NAME]
+
+    @staticmethod
+    def embedding_models_by_config():
+        """Counts the chunks of every config per embedding model; untagged (older) chunks count as the legacy model."""
+        return VectorChunks.get_collection().aggregate([
+            {"$group": {
+                "_id": {"config_id": "$config_id", "model": {"$ifNull": ["$embedding_model", LEGACY_EMBEDDING_MODEL]}},
+                "chunks": {"$sum": 1}
+            }}
+        ])
+
+@click.command("embedding-report")
+@with_appcontext
+def embedding_report_command():
+    """List configs whose chunks were embedded with a model other than the one recorded on the config."""
+    models_by_config = {}
+    for row in VectorChunks.embedding_models_by_config():
+        models_by_config.setdefault(row["_id"]["config_id"], {})[row["_id"]["model"]] = row["chunks"]
+
+    mismatched = 0
+    configs = Config.get_collection().find({"_id": {"$in": [ObjectId(c) for c in models_by_config if ObjectId.is_valid(c)]}}, {"embedding_model": 1})
+    for config in configs:
+        config_id = str(config["_id"])
+        expected = embedding_model_of(config)
+        models = models_by_config.get(config_id, {})
+        if set(models) != {expected}:
+            mismatched += 1
+            found = ", ".join(f"{model}: {count}" for model, count in sorted(models.items()))
+            click.echo(f"[mismatch] config {config_id} expects {expected}; chunks by model: {found}")
+    click.echo(f"Checked {len(models_by_config)} configs with chunks, {mismatched} with mixed or mismatched embedding models.")
+    if mismatched:
+        sys.exit(1)
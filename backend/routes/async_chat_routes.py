@@ -0,0 +1,349 @@
+import asyncio
+import json
+import logging
+from bson import ObjectId
+from flask_jwt_extended import decode_token
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.output_parsers import StrOutputParser
+from starlette.background import BackgroundTask
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from models.config import CONFIG_CACHE, Config
+from models.chat_session import ChatSession
+from models.message_store import MessageStore
+from models.vector_stores import VectorChunks
+from src.backend.database.mongo_utils import aload_session_messages
+from src.backend.llm_factory import get_chat_model
+from src.backend.llm_scheduler import ProviderBusy
+from src.backend.embedding_factory import EMBEDDING_FIELDS, get_embeddings, vector_index_for, vector_search_target
+from src.services.admission_service import AdmissionRejected, admission_controller, rejection_body
+from src.services.history_cache import history_cache
+from src.services.idempotency_service import (
+    IDEMPOTENCY_HEADER, NO_SUBMISSION, REPLAYED_HEADER, IdempotencyConflict, answer_events, conflict_body, idempotency_store, request_fingerprint,
+    scoped_key, valid_key
+)
+from src.services.chat_service import RETRIEVAL_K, acached_retrieval, aretrieve, astream_answer, build_chat_prompt, format_docs, source_list, message_document
+from src.utils.cache import config_key
+from src.utils.deadline import (
+    DEADLINE_HEADER, ClientDisconnected, Deadline, RequestAbandoned, abandoned_body, check_deadline, mongo_max_time_ms, record_abandoned,
+    set_deadline, within_deadline
+)
+from src.utils.metrics import chat_timer
+from src.utils.usage import start_usage_meter
+from src.utils.logging_setup import set_request_id
+
+logger = logging.getLogger(__name__)
+
+# --- Async chat endpoint ---
+# Served by the ASGI app (asgi.py) in place of the Flask chat route, with the same request and
+# response format. The config lookup, the retrieval (query embedding + $vectorSearch) and the
+# history load run concurrently on the event loop, and the LLM is awaited rather than blocking a
+# thread, so one worker can hold many in-flight chats. Everything else is still served by Flask.
+# A turn whose deadline passes or whose client disconnects is cancelled (src/utils/deadline.py).
+
+class AuthorizationError(Exception):
+    pass
+
+def authenticate(flask_app, request: Request) -> str:
+    """Returns the identity of the request's JWT access token, using the Flask app's JWT settings."""
+    header_name = flask_app.config.get("JWT_HEADER_NAME", "Authorization")
+    header_type = flask_app.config.get("JWT_HEADER_TYPE", "Bearer")
+    header = request.headers.get(header_name)
+    if not header:
+        raise AuthorizationError(f"Missing {header_name} Header")
+    parts = header.split()
+    if header_type and (len(parts) != 2 or parts[0] != header_type):
+        raise AuthorizationError(f"Bad {header_name} header. Expected value '{header_type} <JWT>'")
+    with flask_app.app_context():
+        try:
+            decoded = decode_token(parts[-1])
+        except Exception as e:
+            raise AuthorizationError(str(e))
+    if decoded.get("type") != "access":
+        raise AuthorizationError("Only non-refresh tokens are allowed")
+    return decoded[flask_app.config.get("JWT_IDENTITY_CLAIM", "sub")]
+
+def cors_headers(request: Request) -> dict:
+    """Mirrors the Flask-CORS settings of the /api routes for responses that bypass Flask."""
+    origin = request.headers.get("origin")
+    if not origin:
+        return {}
+    return {"Access-Control-Allow-Origin": origin, "Access-Control-Allow-Credentials": "true", "Vary": "Origin"}
+
+async def save_turn(db, session_id: str, user_id: str, config_id: str, question: str, answer: str, history: list):
+    """
+    Writes the human and AI message of a turn with one insert_many and one session summary update,
+    and through to the history cache after `history`, the messages the turn was answered with.
+    """
+    messages = [HumanMessage(content=question), AIMessage(content=answer)]
+    await db[MessageStore.COLLECTION_NAME].insert_many(
+        [message_document(session_id, user_id, config_id, message) for message in messages], ordered=True
+    )
+    summary = await db[ChatSession.COLLECTION_NAME].find_one_and_update(
+        *ChatSession.record_message_update(session_id, question, count=len(messages)), **ChatSession.MESSAGE_COUNT_OPTIONS
+    )
+    history_cache().put(session_id, history + messages, ChatSession.message_count(summary))
+
+def cancel(*tasks):
+    for task in tasks:
+        if task is not None:
+            task.cancel()
+
+# Streamed turns with an idempotency key run in tasks of their own (referenced here until done),
+# so a client that disconnects does not stop the turn a retry will pick up
+background_turns = set()
+
+def run_in_background(lines):
+    async def drain():
+        async for _ in lines:
+            pass
+    task = asyncio.create_task(drain())
+    background_turns.add(task)
+    task.add_done_callback(background_turns.discard)
+
+async def iterate(items):
+    for item in items:
+        yield item
+
+async def ndjson(events, timer=None):
+    """Encodes stream events as NDJSON lines; with `timer`, records the request's metrics once the stream ends."""
+    try:
+        async for event in events:
+            yield json.dumps(event) + "\n"
+    finally:
+        if timer is not None:
+            timer.finish(status="200")
+
+async def chat(request: Request):
+    """
+    Async counterpart of routes.chat_routes.chat. Pass "stream": true to receive NDJSON events.
+    The X-Request-Timeout header (seconds) sets the turn's deadline.
+    """
+    request_id = set_request_id(request.headers.get("X-Request-ID"))
+    timer = chat_timer(request.path_params["config_id"])
+    response = await run_chat(request, timer)
+    response.headers["X-Request-ID"] = request_id
+    # A streamed response records its metrics once the stream has ended
+    if not isinstance(response, StreamingResponse):
+        timer.finish(status=str(response.status_code))
+    return response
+
+async def run_chat(request: Request, timer):
+    """Runs one chat turn, recording the duration of every stage on `timer`."""
+    flask_app = request.app.state.flask_app
+    db = request.app.state.async_db
+    config_id = request.path_params["config_id"]
+    chat_id = request.path_params["chat_id"]
+    headers = cors_headers(request)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    if not data or 'input' not in data:
+        return JSONResponse({"message": "Missing 'input' field"}, status_code=400, headers=headers)
+    user_input = data['input']
+
+    # Set before any task is started, so every stage of the turn runs under the deadline
+    deadline = Deadline.from_header(request.headers.get(DEADLINE_HEADER), adisconnected=request.is_disconnected)
+    set_deadline(deadline)
+    # Likewise the usage meter, which the provider calls of the tasks add to
+    meter = start_usage_meter("chat", timer)
+    retrieval = history = None
+
+    try:
+        if not ObjectId.is_valid(config_id):
+            return JSONResponse({"message": "Configuration not found"}, status_code=404, headers=headers)
+
+        # Retrieval and history only depend on the URL, so they start right away and run while the
+        # config is fetched; they are cancelled if the config turns out to be missing or off limits.
+        # Retrieval assumes the deployment's embedding model and is redone for a config stored with another one.
+        assumed_target = (flask_app.config['EMBEDDING_MODEL'], EMBEDDING_FIELDS[0], vector_index_for(flask_app.config['EMBEDDING_MODEL']))
+        retrieval = asyncio.create_task(acached_retrieval(config_id, assumed_target[1], RETRIEVAL_K, user_input, lambda: aretrieve(
+            db[VectorChunks.COLLECTION_NAME], flask_app.config['EMBEDDINGS'], user_input, config_id, timer,
+            index_name=assumed_target[2], path=assumed_target[1], embedding_model=assumed_target[0]
+        )))
+        # A session in the history cache is checked against the count of the session upsert below
+        # before its cached messages are used, and only loaded if they turn out to be out of date
+        if chat_id not in history_cache():
+            history = asyncio.create_task(timer.measure("history_load", aload_session_messages(db[MessageStore.COLLECTION_NAME], chat_id)))
+
+        config_document = await timer.measure("config_lookup", within_deadline("config_lookup", CONFIG_CACHE.aget_or_load(
+            config_key(config_id), lambda: db[flask_app.config["CONFIG"]].find_one(
+                {"_id": ObjectId(config_id), **Config.ACTIVE}, max_time_ms=mongo_max_time_ms("config_lookup")
+            )
+        )))
+        if not config_document:
+            cancel(retrieval, history)
+            return JSONResponse({"message": "Configuration not found"}, status_code=404, headers=headers)
+        deadline.apply_config(config_document)
+
+        user_id_for_history = "anonymous"
+        if not config_document.get("is_public", False):
+            try:
+                jwt_user_id = authenticate(flask_app, request)
+            except AuthorizationError as e:
+                cancel(retrieval, history)
+                return JSONResponse({"message": "Authorization error: " + str(e)}, status_code=401, headers=headers)
+            if str(config_document.get("user_id")) != jwt_user_id:
+                cancel(retrieval, history)
+                return JSONResponse({"message": "Access denied to this chatbot"}, status_code=403, headers=headers)
+            user_id_for_history = jwt_user_id
+
+        target = vector_search_target(config_document)
+        if target != assumed_target:
+            cancel(retrieval)
+            embedding_model, vector_field, vector_index = target
+            retrieval = asyncio.create_task(acached_retrieval(config_id, vector_field, RETRIEVAL_K, user_input, lambda: aretrieve(
+                db[VectorChunks.COLLECTION_NAME], get_embeddings(embedding_model, flask_app.config), user_input, config_id, timer,
+                index_name=vector_index, path=vector_field, embedding_model=embedding_model
+            )))
+
+        model_name = config_document.get("model_name")
+        timer.labels["model_name"] = model_name or ""
+        meter.attribute(config_id, config_document.get("user_id"), model_name)
+        llm = get_chat_model(model_name, config_document.get("temperature"), flask_app.config)
+        if not llm:
+            cancel(retrieval, history)
+            return JSONResponse({"message": f"Unsupported model: {model_name}"}, status_code=400, headers=headers)
+
+        # A retry with the Idempotency-Key of an earlier submission gets that turn's answer instead
+        # of running it again (src/services/idempotency_service.py); a streamed retry of a turn
+        # running in this worker follows its events
+        submission = NO_SUBMISSION
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if idempotency_key:
+            if not valid_key(idempotency_key):
+                cancel(retrieval, history)
+                return JSONResponse({"message": f"Invalid {IDEMPOTENCY_HEADER} header"}, status_code=400, headers=headers)
+            try:
+                claim = await timer.measure("idempotency_wait", idempotency_store().aclaim(
+                    scoped_key(config_id, chat_id, user_id_for_history, idempotency_key), request_fingerprint(user_input),
+                    timeout=deadline.remaining(), follow=bool(data.get("stream"))
+                ))
+            except IdempotencyConflict as e:
+                cancel(retrieval, history)
+                retry_after = {"Retry-After": str(e.retry_after)} if e.retry_after else {}
+                return JSONResponse(conflict_body(e), status_code=e.status, headers={**headers, **retry_after})
+            if not claim.owner:
+                cancel(retrieval, history)
+                replayed = {**headers, REPLAYED_HEADER: "true"}
+                if not data.get("stream"):
+                    return JSONResponse(claim.answer, headers=replayed)
+                events = claim.submission.follow() if claim.answer is None else iterate(answer_events(claim.answer))
+                return StreamingResponse(ndjson(events, timer), media_type="application/x-ndjson", headers=replayed)
+            submission = claim.submission
+            # The answer is kept for a retry, so the turn runs on if this client goes away
+            deadline.ignore_disconnect()
+
+        # Wait for a slot of the worker's admission controller (src/services/admission_service.py);
+        # it is held until the answer is written, also when streamed
+        try:
+            slot = await timer.measure("admission_wait", admission_controller().aacquire(config_document))
+        except AdmissionRejected as e:
+            cancel(retrieval, history)
+            submission.release()
+            return JSONResponse(rejection_body(e), status_code=429, headers={**headers, "Retry-After": str(e.retry_after)})
+        except asyncio.CancelledError:
+            submission.release()
+            raise
+
+        streaming = False
+        try:
+            # The session metadata upsert overlaps with the retrieval and history load
+            ensure_session = timer.measure("session_upsert", db[ChatSession.COLLECTION_NAME].find_one_and_update(
+                *ChatSession.ensure_update(chat_id, user_id_for_history, config_id), upsert=True, **ChatSession.MESSAGE_COUNT_OPTIONS
+            ))
+            docs, summary = await asyncio.gather(retrieval, ensure_session)
+            message_count = ChatSession.message_count(summary)
+            history_messages = history_cache().get(chat_id, message_count)
+            if history_messages is not None:
+                # Another request of the session may have cached it since this one looked
+                cancel(history)
+            else:
+                if history is None:
+                    history = asyncio.create_task(timer.measure("history_load", aload_session_messages(db[MessageStore.COLLECTION_NAME], chat_id)))
+                history_messages = await history
+                history_cache().put(chat_id, history_messages, message_count)
+            messages = build_chat_prompt(config_document).format_messages(
+                context=format_docs(docs), history=history_messages, question=user_input
+            )
+            chain = llm | StrOutputParser()
+
+            if not data.get("stream"):
+                async def generate():
+                    return "".join([chunk async for chunk in astream_answer(chain, messages, timer)])
+                response_content = await within_deadline("llm", generate())
+                # A turn nobody is waiting for any more is not written to the history
+                check_deadline("history_write")
+                await timer.measure("history_write", save_turn(db, chat_id, user_id_for_history, config_id, user_input, response_content, history_messages))
+                answer = {"response": response_content, "sources": source_list(docs)}
+                submission.complete(answer)
+                return JSONResponse(answer, headers=headers)
+
+            def emit(event: dict) -> str:
+                submission.publish(event)
+                return json.dumps(event) + "\n"
+
+            async def events():
+                yield emit({"type": "sources", "sources": source_list(docs)})
+                parts = []
+                status = "error"
+                try:
+                    # The LLM stream ends at the deadline; a disconnect cancels this generator
+                    async for chunk in astream_answer(chain, messages, timer):
+                        parts.append(chunk)
+                        yield emit({"type": "token", "content": chunk})
+                    response_content = "".join(parts)
+                    # A turn nobody is waiting for any more is not written to the history
+                    check_deadline("history_write")
+                    await timer.measure("history_write", save_turn(db, chat_id, user_id_for_history, config_id, user_input, response_content, history_messages))
+                    status = "200"
+                    done = emit({"type": "done", "response": response_content})
+                    submission.complete({"response": response_content, "sources": source_list(docs)})
+                    yield done
+                except RequestAbandoned as e:
+                    status = str(e.status)
+                    yield emit({"type": "error", **abandoned_body(config_id, e)})
+                except asyncio.CancelledError:
+                    status = str(ClientDisconnected.status)
+                    record_abandoned(config_id, ClientDisconnected("llm"))
+                    raise
+                except Exception as e:
+                    logger.error(f"Chat stream failed for session {chat_id}: {e}", exc_info=True)
+                    yield emit({"type": "error", "message": "An internal server error occurred."})
+                finally:
+                    slot.release()
+                    submission.release()
+                    timer.finish(status=status)
+
+            streaming = True
+            if submission is not NO_SUBMISSION:
+                # The turn runs to its end in the background; this client, like any retry, follows it
+                run_in_background(events())
+                return StreamingResponse(ndjson(submission.follow()), media_type="application/x-ndjson", headers=headers)
+            # From here on the stream releases the slot (the background task is a fallback; releasing is idempotent)
+            return StreamingResponse(events(), media_type="application/x-ndjson", headers=headers, background=BackgroundTask(slot.release))
+        finally:
+            if not streaming:
+                slot.release()
+                submission.release()
+
+    except ProviderBusy as e:
+        logger.warning(f"Chat turn for config {config_id} gave up waiting for provider budget: {e}")
+        return JSONResponse(
+            {"message": "The model provider is busy, please retry shortly.", "retry_after": e.retry_after},
+            status_code=503, headers={**headers, "Retry-After": str(e.retry_after)}
+        )
+    except RequestAbandoned as e:
+        cancel(retrieval, history)
+        return JSONResponse(abandoned_body(config_id, e), status_code=e.status, headers=headers)
+    except Exception as e:
+        logger.error(f"An unexpected error occurred in the async chat endpoint: {e}", exc_info=True)
+        return JSONResponse({"message": "An internal server error occurred."}, status_code=500, headers=headers)
+
+async_chat_routes = [
+    Route("/api/chat/{config_id}/{chat_id}", chat, methods=["POST"]),
+]
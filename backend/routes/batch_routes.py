@@ -0,0 +1,40 @@
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from bson import ObjectId
+import logging
+
+from models.config import Config
+from src.services.batch_eval_service import BatchRequestError, parse_batch_request, batch_for_config, ndjson_records
+
+logger = logging.getLogger(__name__)
+batch_bp = Blueprint('batch_routes', __name__)
+
+@batch_bp.route('/config/<string:config_id>/batch', methods=['POST'])
+@jwt_required()
+def batch_evaluate(config_id):
+    """
+    Answers a list of questions against one of the user's configs and streams the results as NDJSON:
+    one {"type": "result", "index", "input", "response" | "error", "sources"} line per question,
+    in input order, then a {"type": "summary"} line. Questions whose embedding or vector search
+    failed get a {"type": "error", "index", "input", "stage", "error"} line instead.
+
+    Body: {"inputs": [...], "k": 3, "concurrency": 4, "save_history": false, "session_id": null}.
+    Nothing is written to message_store unless save_history is true.
+    """
+    try:
+        user_id = get_jwt_identity()
+        if not ObjectId.is_valid(config_id):
+            return jsonify({"message": "Invalid configuration ID format"}), 400
+        config_document = Config.find_owned(config_id, user_id)
+        if not config_document:
+            return jsonify({"message": "Configuration not found or access denied"}), 404
+
+        options = parse_batch_request(request.get_json(silent=True))
+        records = batch_for_config(config_document, options, user_id)
+        logger.info(f"Batch of {len(options['inputs'])} questions for config {config_id} (concurrency {options['concurrency']})")
+        return Response(stream_with_context(ndjson_records(records)), mimetype='application/x-ndjson')
+    except BatchRequestError as e:
+        return jsonify({"message": str(e)}), 400
+    except Exception as e:
+        current_app.logger.error(f"Error running batch for config {config_id}: {e}", exc_info=True)
+        return jsonify({"message": "An internal server error occurred"}), 500
@@ -1,177 +1,269 @@
-from flask import Blueprint, request, jsonify, current_app
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
 from flask_jwt_extended import jwt_required, get_jwt_identity, verify_jwt_in_request
 import logging
-import re
 import json
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_core.runnables import RunnablePassthrough, RunnableLambda
+import hashlib
+from typing import List, Sequence
+from pymongo import ASCENDING, DESCENDING
 from langchain_core.output_parsers import StrOutputParser
-from langchain_mongodb.vectorstores import MongoDBAtlasVectorSearch
 from langchain_mongodb.chat_message_histories import MongoDBChatMessageHistory
-from langchain_core.runnables.history import RunnableWithMessageHistory
-from langchain_core.messages import BaseMessage, messages_from_dict, message_to_dict
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage
 from models.config import Config
+from models.chat_session import ChatSession
+from models.message_store import MessageStore
+from models.vector_stores import VectorChunks
+from src.backend.database.mongo_utils import load_session_messages
+from src.services.chat_service import RETRIEVAL_K, build_chat_prompt, cached_retrieval, format_docs, source_list, message_document, retrieve, stream_answer
+from src.utils.metrics import chat_timer
+from src.utils.usage import current_usage_meter, start_usage_meter, stop_usage_meter
+from src.utils.profiling import profiled
 from bson import ObjectId
-from langchain_community.chat_models import ChatTongyi
-from langchain_deepseek import ChatDeepSeek
+from src.backend.llm_factory import get_chat_model
+from src.backend.llm_scheduler import ProviderBusy
+from src.backend.embedding_factory import get_embeddings, vector_search_target
+from src.services.admission_service import AdmissionRejected, admission_controller, rejection_body
+from src.services.history_cache import history_cache
+from src.services.idempotency_service import (
+    IDEMPOTENCY_HEADER, NO_SUBMISSION, REPLAYED_HEADER, IdempotencyConflict, conflict_body, idempotency_store, request_fingerprint, scoped_key,
+    valid_key
+)
+from src.utils.deadline import (
+    DEADLINE_HEADER, Deadline, RequestAbandoned, abandoned_body, check_deadline, current_deadline, deadline_stage, mongo_max_time_ms,
+    set_deadline, wsgi_disconnected
+)
 
 logger = logging.getLogger(__name__)
 chat_bp = Blueprint('chat_routes', __name__)
 
+SESSION_PAGE_SIZE = 50
+MAX_SESSION_PAGE_SIZE = 200
+HISTORY_PAGE_SIZE = 50
+MAX_HISTORY_PAGE_SIZE = 500
+HISTORY_BATCH_SIZE = 100
+
 # --- DB Collections ---
-# 1. chat_session_metadata: Stores one document per chat session with user_id and config_id.
-# 2. message_store: Stores all messages from all sessions, using LangChain's standard format.
+# 1. chat_session_metadata: Stores one document per chat session with user_id and config_id,
+#    plus a title, message_count and last_activity summary maintained on every message write.
+# 2. message_store: Stores all messages from all sessions, using LangChain's standard format
+#    as a native BSON `History` subdocument (see src/backend/database/mongo_utils.py).
 
 @chat_bp.route('/history/<string:chat_id>', methods=['GET'])
+@profiled("history")
 def get_chat_history(chat_id):
-    """Retrieves the message history for a specific chat session."""
+    """
+    Retrieves one page of the message history for a chat session, oldest message first.
+    Pages backwards from the newest message: pass ?before=<next_cursor>&limit=<n> to get older messages.
+    Responses carry an ETag so unchanged pages can be revalidated with If-None-Match.
+    Sessions of a deleted config are not found.
+    """
     try:
-        history = MongoDBChatMessageHistory(
-            connection_string=current_app.config['MONGO_URI'],
-            session_id=chat_id,
-            database_name=current_app.config['MONGO_DB'].name,
-            collection_name="message_store"
-        )
-        history_dicts = [message_to_dict(m) for m in history.messages]
-        return jsonify({"history": history_dicts}), 200
+        config_id = ChatSession.config_of(chat_id)
+        if config_id and not (ObjectId.is_valid(config_id) and Config.find_by_id_cached(config_id)):
+            return jsonify({"message": "Chat not found"}), 404
+
+        before = request.args.get('before')
+        if before and not ObjectId.is_valid(before):
+            return jsonify({"message": "Invalid cursor"}), 400
+        try:
+            limit = min(max(int(request.args.get('limit', HISTORY_PAGE_SIZE)), 1), MAX_HISTORY_PAGE_SIZE)
+        except ValueError:
+            return jsonify({"message": "Invalid limit"}), 400
+
+        message_collection = MessageStore.get_collection()
+        query = {"SessionId": chat_id}
+        if before:
+            query["_id"] = {"$lt": ObjectId(before)}
+
+        # Resolve the page boundaries with an _id-only projection; one extra id tells us if older pages exist
+        page_ids = [doc["_id"] for doc in message_collection.find(query, {"_id": 1}).sort("_id", DESCENDING).limit(limit + 1)]
+        has_more = len(page_ids) > limit
+        page_ids = page_ids[:limit]
+
+        # Messages are append-only, so the page boundaries identify the page content
+        etag = hashlib.sha1(
+            f"{chat_id}:{before}:{page_ids[0] if page_ids else ''}:{page_ids[-1] if page_ids else ''}:{len(page_ids)}:{has_more}".encode()
+        ).hexdigest()
+        if etag in request.if_none_match:
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+
+        next_cursor = str(page_ids[-1]) if has_more else None
+
+        # The page (at most MAX_HISTORY_PAGE_SIZE documents) is read before the response starts,
+        # so a failed read is still a 500 rather than a 200 whose JSON stops half way
+        docs = []
+        if page_ids:
+            docs = list(message_collection.find(
+                {"SessionId": chat_id, "_id": {"$gte": page_ids[-1], "$lte": page_ids[0]}},
+                {"History": 1}
+            ).sort("_id", ASCENDING).batch_size(HISTORY_BATCH_SIZE))
+
+        def generate():
+            yield '{"history":['
+            for index, doc in enumerate(docs):
+                yield ("," if index else "") + serialize_history_item(doc)
+            yield '],"next_cursor":' + json.dumps(next_cursor) + '}'
+
+        response = Response(stream_with_context(generate()), mimetype='application/json')
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
     except Exception as e:
         logger.error(f"Error fetching history for chat {chat_id}: {e}", exc_info=True)
         return jsonify({"message": "An internal server error occurred."}), 500
 
+def serialize_history_item(doc):
+    """Returns the JSON text of a stored message without deserializing it into a LangChain object."""
+    history = doc.get("History")
+    if isinstance(history, str):
+        # Legacy documents already hold the message as JSON text
+        return history
+    return json.dumps(history)
+
 @chat_bp.route('/chat/list/<string:config_id>', methods=['GET'])
 @jwt_required()
 def get_chat_list(config_id):
+    """
+    Lists the current user's chat sessions for a config, newest first.
+    Served entirely from chat_session_metadata; page with ?before=<next_cursor>&limit=<n>.
+    """
     try:
         user_id = get_jwt_identity()
-        db = current_app.config['MONGO_DB']
-        metadata_collection = db["chat_session_metadata"]
-
-        # This pipeline does all the heavy lifting in the database.
-        pipeline = [
-            {
-                '$match': {
-                    '$or': [
-                        {'user_id': user_id},
-                        {'user_id': "anonymous"}
-                    ],
-                    'config_id': config_id
-                }
-            },
-            {'$sort': {'_id': -1}},
-           
-            {
-                '$lookup': {
-                    'from': 'message_store',
-                    'let': {'session_id_str': '$session_id'},
-                    'pipeline': [
-                        {'$match': {'$expr': {'$eq': ['$SessionId', '$$session_id_str']}}},
-                        {'$sort': {'_id': 1}},
-                        {'$limit': 1},
-                        {'$project': {'History': 1, '_id': 0}}
-                    ],
-                    'as': 'first_message_info'
-                }
-            },
-            {
-                '$project': {
-                    '_id': 1, # Keep _id for timestamp and updates
-                    'session_id': '$session_id',
-                    'user_id': '$user_id',
-                    'timestamp': {'$dateToString': {'format': '%Y-%m-%dT%H:%M:%S.%LZ', 'date': '$_id'}},
-                    'first_message_history': {'$arrayElemAt': ['$first_message_info.History', 0]}
-                }
-            }
-        ]
+        if not ObjectId.is_valid(config_id) or not Config.find_by_id_cached(config_id):
+            return jsonify({"message": "Configuration not found"}), 404
 
-        # 1. Execute the single, efficient pipeline
-        sessions_from_db = list(metadata_collection.aggregate(pipeline))
-        
-        sessions_list = []
-        # 2. Loop through the results just to create the title and claim anonymous chats
-        for session in sessions_from_db:
-            
-            # If the chat is anonymous, claim it for the current user
-            if session.get('user_id') == 'anonymous':
-                 metadata_collection.update_one(
-                    {"_id": session["_id"]}, # Use the _id we kept in the pipeline
-                    {"$set": {"user_id": user_id}}
-                )
-                 print(f"✅ Claimed anonymous chat {session['session_id']} for user {user_id}")
+        before = request.args.get('before')
+        if before and not ObjectId.is_valid(before):
+            return jsonify({"message": "Invalid cursor"}), 400
+        try:
+            limit = min(max(int(request.args.get('limit', SESSION_PAGE_SIZE)), 1), MAX_SESSION_PAGE_SIZE)
+        except ValueError:
+            return jsonify({"message": "Invalid limit"}), 400
 
+        # Claim any anonymous chats of this config for the current user in one write
+        claimed = ChatSession.claim_anonymous(config_id, user_id)
+        if claimed.modified_count:
+            logger.info(f"Claimed {claimed.modified_count} anonymous chats of config {config_id} for user {user_id}")
 
-            title = "New Chat"
-            try:
-                # Use the correct field name from the pipeline: 'first_message_history'
-                if session.get('first_message_history'):
-                    history_data = json.loads(session['first_message_history'])
-                    if history_data.get("data", {}).get("content"):
-                        title = history_data["data"]["content"]
-            except (json.JSONDecodeError, TypeError):
-                pass  # Ignore malformed history
+        # One session beyond the page tells whether there is a next one
+        sessions = list(ChatSession.list_for_user(config_id, user_id, before=before, limit=limit + 1))
+        has_more = len(sessions) > limit
+        sessions = sessions[:limit]
 
+        sessions_list = []
+        for session in sessions:
+            last_activity = session.get('last_activity')
             sessions_list.append({
                 'session_id': session['session_id'],
-                'title': title[:100],
-                'timestamp': session['timestamp']
+                'title': session.get('title') or "New Chat",
+                'message_count': session.get('message_count', 0),
+                'timestamp': session['_id'].generation_time.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                'last_activity': last_activity.isoformat(timespec='milliseconds') + 'Z' if last_activity else None
             })
 
-        # 3. The return statement is OUTSIDE and AFTER the loop
-        return jsonify({"sessions": sessions_list}), 200
+        next_cursor = str(sessions[-1]['_id']) if has_more else None
+
+        return jsonify({"sessions": sessions_list, "next_cursor": next_cursor}), 200
     except Exception as e:
         logger.error(f"Error fetching chat list for config {config_id}: {e}", exc_info=True)
         return jsonify({"message": "An internal server error occurred."}), 500
 
 class CustomMongoDBChatMessageHistory(MongoDBChatMessageHistory):
-    """Custom history class to save user_id and config_id with each message."""
-    def __init__(self, connection_string: str, session_id: str, database_name: str, collection_name: str, user_id: str, config_id: str):
-        super().__init__(connection_string, session_id, database_name, collection_name)
+    """
+    Custom history class to save user_id and config_id with each message.
+    Reads and writes go through the worker's history cache (src/services/history_cache.py);
+    `message_count` is the session's count from its summary, which tells whether the cached history is current.
+    """
+    def __init__(self, client, session_id: str, database_name: str, collection_name: str, user_id: str, config_id: str,
+                 message_count: int = None):
+        # Reuse the worker's MongoClient rather than opening a connection pool per request.
+        # The SessionId index is provisioned at startup (models/indexes.py), so skip the per-request create_index.
+        super().__init__(None, session_id, database_name, collection_name, create_index=False, client=client)
         self.user_id = user_id
         self.config_id = config_id
+        self.message_count = message_count
+        # The messages as last read or written by this object, which the write-through extends
+        self._loaded = None
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        """Retrieve the messages from the history cache, or else from MongoDB in either storage format."""
+        if self.message_count is None:
+            return load_session_messages(self.collection, self.session_id)
+        messages = history_cache().get(self.session_id, self.message_count)
+        if messages is None:
+            messages = load_session_messages(self.collection, self.session_id)
+            history_cache().put(self.session_id, messages, self.message_count)
+        self._loaded = messages
+        return messages
+
+    def message_document(self, message: BaseMessage) -> dict:
+        """Builds the native BSON message_store document for a message."""
+        return message_document(self.session_id, self.user_id, self.config_id, message)
+
+    def written(self, messages: Sequence[BaseMessage], message_count: int):
+        """Writes newly stored messages through to the history cache, if this object has read the history."""
+        if self._loaded is not None:
+            self._loaded = self._loaded + list(messages)
+            history_cache().put(self.session_id, self._loaded, message_count)
+        self.message_count = message_count
 
     def add_message(self, message: BaseMessage) -> None:
-        """Append the message to the record in MongoDB."""
-        self.collection.insert_one(
-            {
-                "SessionId": self.session_id,
-                "user_id": self.user_id,
-                "config_id": self.config_id,
-                "History": json.dumps(message_to_dict(message)),
-            }
-        )
+        """Append the message to the record in MongoDB as a native BSON document."""
+        self.collection.insert_one(self.message_document(message))
+        self.written([message], ChatSession.record_message(self.session_id, message.content))
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Append a whole turn with one insert_many and one session summary update."""
+        if not messages:
+            return
+        self.collection.insert_many([self.message_document(message) for message in messages], ordered=True)
+        self.written(messages, ChatSession.record_message(self.session_id, messages[0].content, count=len(messages)))
 
 def get_session_history(session_id: str, user_id: str, config_id: str) -> CustomMongoDBChatMessageHistory:
     """Factory function to create a message history object and ensure session metadata exists."""
     db = current_app.config['MONGO_DB']
-    metadata_collection = db["chat_session_metadata"]
-    
-    metadata_collection.update_one(
-        {"session_id": session_id},
-        {"$setOnInsert": {"user_id": user_id, "config_id": config_id, "session_id": session_id}},
-        upsert=True
-    )
+    message_count = ChatSession.ensure(session_id, user_id, config_id)
 
     return CustomMongoDBChatMessageHistory(
-        connection_string=current_app.config['MONGO_URI'],
+        client=current_app.config['MONGO_CLIENT'],
         session_id=session_id,
         database_name=db.name,
-        collection_name="message_store",
+        collection_name=MessageStore.COLLECTION_NAME,
         user_id=user_id,
-        config_id=config_id
+        config_id=config_id,
+        message_count=message_count
     )
 
 @chat_bp.route('/chat/<string:config_id>/<string:chat_id>', methods=['POST'])
+@profiled("chat")
 def chat(config_id, chat_id):
-    """Main endpoint for handling chat interactions."""
+    """Main endpoint for handling chat interactions. The X-Request-Timeout header (seconds) sets the turn's deadline."""
+    timer = chat_timer(config_id)
+    set_deadline(Deadline.from_header(request.headers.get(DEADLINE_HEADER), disconnected=wsgi_disconnected(request.environ)))
+    start_usage_meter("chat", timer)
+    try:
+        response = current_app.make_response(run_chat(config_id, chat_id, timer))
+    finally:
+        set_deadline(None)
+        stop_usage_meter()
+    timer.finish(status=str(response.status_code))
+    return response
+
+def run_chat(config_id, chat_id, timer):
+    """Runs one chat turn, recording the duration of every stage on `timer`."""
     data = request.get_json()
     if not data or 'input' not in data:
         return jsonify({"message": "Missing 'input' field"}), 400
     user_input = data['input']
 
     try:
-        config_document = Config.get_collection().find_one({"_id": ObjectId(config_id)})
+        with timer.stage("config_lookup"), deadline_stage("config_lookup"):
+            config_document = Config.find_by_id_cached(config_id, max_time_ms=mongo_max_time_ms("config_lookup"))
         if not config_document:
             return jsonify({"message": "Configuration not found"}), 404
+        current_deadline().apply_config(config_document)
 
         is_public = config_document.get("is_public", False)
         owner_id = str(config_document.get("user_id"))
@@ -186,104 +278,84 @@ def chat(config_id, chat_id):
                 user_id_for_history = jwt_user_id
             except Exception as e:
                 return jsonify(message="Authorization error: " + str(e)), 401
-        
-        db = current_app.config['MONGO_DB']
-        vector_store = MongoDBAtlasVectorSearch(
-            collection=db['vector_collection'],
-            embedding=current_app.config['EMBEDDINGS'],
-            index_name="vector"
-        )
-        
-        # Create a custom retriever function that includes filtering
-        def filtered_retriever(query):
-            try:
-                # Use similarity search with filter
-                docs = vector_store.similarity_search(
-                    query=query,
-                    k=3,
-                    pre_filter={"config_id": {"$eq": config_id}}
-                )
-                logger.info(f"🔍 Vector search found {len(docs)} documents for config_id: {config_id}")
-                if docs:
-                    logger.info(f"📄 First document preview: {docs[0].page_content[:200]}...")
-                    logger.info(f"📋 Document metadata: {docs[0].metadata}")
-                else:
-                    logger.warning(f"⚠️ No documents found in vector store for config_id: {config_id}")
-                return docs
-            except Exception as e:
-                logger.error(f"❌ Vector retrieval failed: {e}")
-                return []
-        
 
-        
-        system_prompt_template = re.sub(r'Question:.*', '', config_document.get("prompt_template", "")).strip()
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", system_prompt_template + "\n\nContext:\n{context}"),
-            MessagesPlaceholder(variable_name="history"),
-            ("human", "{question}")
-        ])
-        
         model_name = config_document.get("model_name")
         temperature = config_document.get("temperature")
-        llm = None
-        
-        if model_name.startswith('gpt'):
-            llm = ChatOpenAI(model=model_name, temperature=temperature, api_key=current_app.config.get("OPENAI_API_KEY"))
-        elif model_name.startswith('qwen'):
-            llm = ChatTongyi(model=model_name, api_key=current_app.config.get("QWEN_API_KEY"))
-        elif model_name.startswith('deepseek'):
-            llm = ChatDeepSeek(model=model_name, temperature=temperature, api_key=current_app.config.get("DEEPSEEK_API_KEY"))
+        timer.labels["model_name"] = model_name or ""
+        current_usage_meter().attribute(config_id, owner_id, model_name)
+        llm = get_chat_model(model_name, temperature, current_app.config)
         
         if not llm:
             return jsonify({"message": f"Unsupported model: {model_name}"}), 400
 
-        def format_docs(docs):
-            context = "\n\n".join(doc.page_content for doc in docs)
-            logger.info(f"📝 Context being sent to LLM ({len(docs)} docs, {len(context)} chars): {context[:300]}...")
-            return context
+        # A retry with the Idempotency-Key of an earlier submission gets that turn's answer instead
+        # of running it again (src/services/idempotency_service.py)
+        submission = NO_SUBMISSION
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if idempotency_key:
+            if not valid_key(idempotency_key):
+                return jsonify({"message": f"Invalid {IDEMPOTENCY_HEADER} header"}), 400
+            try:
+                with timer.stage("idempotency_wait"):
+                    claim = idempotency_store().claim(
+                        scoped_key(config_id, chat_id, user_id_for_history, idempotency_key), request_fingerprint(user_input),
+                        timeout=current_deadline().remaining()
+                    )
+            except IdempotencyConflict as e:
+                return jsonify(conflict_body(e)), e.status, {"Retry-After": str(e.retry_after)} if e.retry_after else {}
+            if claim.answer is not None:
+                return jsonify(claim.answer), 200, {REPLAYED_HEADER: "true"}
+            submission = claim.submission
+            # The answer is kept for a retry, so the turn runs on if this client goes away
+            current_deadline().ignore_disconnect()
 
-        # Convert functions to runnables
-        question_to_retriever = RunnableLambda(lambda x: x["question"])
-        retriever_runnable = RunnableLambda(filtered_retriever)
-        format_docs_runnable = RunnableLambda(format_docs)
-        
-        rag_chain = (
-            RunnablePassthrough.assign(
-                context=question_to_retriever | retriever_runnable | format_docs_runnable
-            )
-            | prompt
-            | llm
-            | StrOutputParser()
-        )
-
-        chain_with_history = RunnableWithMessageHistory(
-            rag_chain,
-            lambda session_id: get_session_history(session_id, user_id_for_history, config_id),
-            input_messages_key="question",
-            history_messages_key="history",
-        )
-
-        # Get docs once for both context and sources
-        docs = filtered_retriever(user_input)
-        context = format_docs(docs)
-        
-        # Run the RAG chain
-        response_content = chain_with_history.invoke(
-            {"question": user_input, "context": context},
-            config={"configurable": {"session_id": chat_id}}
-        )
+        with submission:
+            # Wait for a slot of the worker's admission controller (src/services/admission_service.py)
+            try:
+                with timer.stage("admission_wait"):
+                    slot = admission_controller().acquire(config_document)
+            except AdmissionRejected as e:
+                return jsonify(rejection_body(e)), 429, {"Retry-After": str(e.retry_after)}
+
+            with slot:
+                check_deadline("admission_wait")
+
+                # Retrieve once; the context is passed straight into the prompt
+                db = current_app.config['MONGO_DB']
+                embedding_model, vector_field, vector_index = vector_search_target(config_document)
+                docs = cached_retrieval(config_id, vector_field, RETRIEVAL_K, user_input, lambda: retrieve(
+                    db[VectorChunks.COLLECTION_NAME], get_embeddings(embedding_model, current_app.config), user_input, config_id, timer,
+                    index_name=vector_index, path=vector_field, embedding_model=embedding_model
+                ))
+
+                with timer.stage("session_upsert"):
+                    history = get_session_history(chat_id, user_id_for_history, config_id)
+                with timer.stage("history_load"):
+                    history_messages = history.messages
+
+                messages = build_chat_prompt(config_document).format_messages(
+                    context=format_docs(docs), history=history_messages, question=user_input
+                )
+                response_content = "".join(stream_answer(llm | StrOutputParser(), messages, timer))
+
+                # A turn nobody is waiting for any more is not written to the history
+                check_deadline("history_write")
+                with timer.stage("history_write"):
+                    history.add_messages([HumanMessage(content=user_input), AIMessage(content=response_content)])
         
-        # Return response with sources
-        return jsonify({
-            "response": response_content,
-            "sources": [
-                {
-                    "source": doc.metadata.get("source", ""),
-                    "page_content": doc.page_content[:200] + "..."
-                } for doc in docs
-            ]
-        })
+                # Return response with sources
+                answer = {
+                    "response": response_content,
+                    "sources": source_list(docs)
+                }
+                submission.complete(answer)
+                return jsonify(answer)
 
+    except ProviderBusy as e:
+        logger.warning(f"Chat turn for config {config_id} gave up waiting for provider budget: {e}")
+        return jsonify({"message": "The model provider is busy, please retry shortly.", "retry_after": e.retry_after}), 503, {"Retry-After": str(e.retry_after)}
+    except RequestAbandoned as e:
+        return jsonify(abandoned_body(config_id, e)), e.status
     except Exception as e:
         logger.error(f"An unexpected error occurred in the chat endpoint: {e}", exc_info=True)
         return jsonify({"message": "An internal server error occurred."}), 500
@@ -5,6 +5,7 @@ import logging
 import os
 from werkzeug.utils import secure_filename
 from src.utils.vector_stores.store_vector_stores import process_files_and_create_vector_store
+from src.utils.profiling import profiled
 from models.config import Config
 from models.user import User
 
@@ -30,7 +31,7 @@ def getconfigs():
     try:
         # 1. Get the user ID from the JWT token
         user_id= get_jwt_identity()
-        current_app.logger.info(f"user {user_id}: ", exc_info=True)
+        logger.debug(f"Listing configs for user {user_id}")
         
         if user_id=='':
             return jsonify({"error": "User not authenticated"}), 401
@@ -58,7 +59,6 @@ def getconfigs():
 
 @config_bp.route('/config/<string:config_id>', methods=['GET'])
 def get_single_config(config_id):
-    logger.info(f'{config_id}',exc_info=True)
     user_id=''
     """
     Fetches a single configuration.
@@ -73,8 +73,8 @@ def get_single_config(config_id):
 
         # 3. Query the database for a document that matches BOTH the config_id and the user_id
         # This is a critical security check to prevent users from accessing others' configs.
-        config_document = Config.get_collection().find_one({"_id":ObjectId(config_id)})
-        logger.info(f"config {config_document}",exc_info=True)
+        config_document = Config.find_by_id(config_id)
+        logger.debug(f"Fetched config {config_id}: {'found' if config_document else 'not found'}")
         if config_document is None:
             return jsonify({"message": "Configuration not found"}), 404
 
@@ -109,6 +109,7 @@ def get_single_config(config_id):
         return jsonify({"message": "An internal server error occurred"}), 500
 
 @config_bp.route('/config', methods=['POST'])
+@profiled("ingest")
 @jwt_required()
 def configure_model():
     """
@@ -205,7 +206,8 @@ Answer:"""
             "prompt_template": final_prompt_template, # Save the dynamically created template
             "temperature": temperature,
             "is_public": is_public,
-            "documents": uploaded_filenames  # Store the filenames of uploaded documents
+            "documents": uploaded_filenames,  # Store the filenames of uploaded documents
+            "embedding_model": current_app.config['EMBEDDING_MODEL']  # Queries must use the model the chunks were embedded with
         }
         
         result = mongo_collection.get_collection().insert_one(config_document)
@@ -220,7 +222,8 @@ Answer:"""
                 temp_file_paths=temp_file_paths, 
                 user_id=user_id, 
                 collection_name=final_collection_name,
-                config_id=config_id
+                config_id=config_id,
+                embedding_model=config_document['embedding_model']
             )
             # Update the config with the final collection name if it was generated
             if not collection_name:
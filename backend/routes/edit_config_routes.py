@@ -6,6 +6,9 @@ import os
 
 from models.config import Config
 from src.utils.vector_stores.store_vector_stores import process_files_and_create_vector_store
+from src.utils.profiling import profiled
+from src.backend.embedding_factory import embedding_field_of, embedding_model_of
+from src.services.reembed_service import ReembedError, ReembedInProgress, start_reembed, reembed_status
 
 
 edit_config_bp = Blueprint('edit_config_routes', __name__)
@@ -17,6 +20,7 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 @edit_config_bp.route('/config/<string:config_id>', methods=['PUT'])
+@profiled("ingest")
 @jwt_required()
 def update_existing_config(config_id):
     try:
@@ -30,10 +34,7 @@ def update_existing_config(config_id):
             return jsonify({"error": "Missing one or more required fields"}), 400
 
         # Find the config ensuring it belongs to the authenticated user
-        config_to_update = Config.get_collection().find_one({
-            "_id": ObjectId(config_id),
-            "user_id": user_id
-        })
+        config_to_update = Config.find_owned(config_id, user_id)
 
         if not config_to_update:
             return jsonify({"message": "Configuration not found or access denied"}), 404
@@ -67,7 +68,9 @@ def update_existing_config(config_id):
                     temp_file_paths,
                     user_id,
                     config_to_update.get('collection_name'),
-                    config_id
+                    config_id,
+                    embedding_model=embedding_model_of(config_to_update),
+                    embedding_field=embedding_field_of(config_to_update)
                 )
         
         # Update documents list
@@ -77,9 +80,10 @@ def update_existing_config(config_id):
 
         # Update the document in the database
         Config.get_collection().update_one(
-            {"_id": ObjectId(config_id)},
+            {"_id": ObjectId(config_id), **Config.ACTIVE},
             {"$set": update_data}
         )
+        Config.invalidate(config_id)
 
         return jsonify({"message": "Configuration updated successfully"}), 200
 
@@ -92,56 +96,73 @@ def update_existing_config(config_id):
 @jwt_required()
 def delete_config(config_id):
     """
-    Deletes a configuration and its associated vector store collection.
-    Only the owner of the config can delete it.
+    Deletes a configuration. Only the owner of the config can delete it.
+    The config is soft-deleted and hidden from all reads right away; its vector chunks,
+    chat messages and session metadata are removed in the background by the config reaper
+    (src/services/config_deletion_service.py).
     """
     try:
         user_id = get_jwt_identity()
-        config_to_delete = Config.get_collection().find_one({
-            "_id": ObjectId(config_id),
-            "user_id": user_id
-        })
+        if not ObjectId.is_valid(config_id):
+            return jsonify({"message": "Invalid configuration ID format"}), 400
 
-        if not config_to_delete:
+        if not Config.mark_deleted(config_id, user_id):
             return jsonify({"message": "Configuration not found or access denied"}), 404
 
-        # Delete the configuration from MongoDB
-        Config.get_collection().delete_one({"_id": ObjectId(config_id)})
+        current_app.logger.info(f"Config {config_id} marked for deletion; data cleanup is scheduled.")
+        return jsonify({"message": "Configuration deleted successfully"}), 200
+
+    except Exception as e:
+        current_app.logger.error(f"An error occurred in delete_config: {e}", exc_info=True)
+        return jsonify({"error": "An internal server error occurred"}), 500
+
+
+@edit_config_bp.route('/config/<string:config_id>/reembed', methods=['POST'])
+@jwt_required()
+def reembed_config(config_id):
+    """
+    Moves a config to another embedding model: {"embedding_model": "<model id>"}.
+    The chunks are re-embedded in the background (src/services/reembed_service.py); chat keeps
+    using the old vectors until the job switches the config over. Poll GET for the progress.
+    """
+    try:
+        user_id = get_jwt_identity()
+        if not ObjectId.is_valid(config_id):
+            return jsonify({"message": "Invalid configuration ID format"}), 400
+        if not Config.find_owned(config_id, user_id):
+            return jsonify({"message": "Configuration not found or access denied"}), 404
 
-        # --- Cascading Delete --- 
+        target_model = (request.get_json(silent=True) or {}).get('embedding_model')
+        if not target_model:
+            return jsonify({"message": "Missing 'embedding_model' field"}), 400
         try:
-            db = current_app.config['MONGO_DB']
-            
-            # 1. Delete associated vector chunks from vector_collection
-            vector_collection = db['vector_collection']
-            vector_result = vector_collection.delete_many({"config_id": config_id})
-            current_app.logger.info(f"Deleted {vector_result.deleted_count} vector chunks for config_id: {config_id}")
-
-            # 2. Find all chat sessions associated with this config_id
-            metadata_collection = db['chat_session_metadata']
-            sessions_to_delete = metadata_collection.find({"config_id": config_id})
-            session_ids_to_delete = [s['session_id'] for s in sessions_to_delete]
-
-            if session_ids_to_delete:
-                # 3. Delete all messages for those sessions from message_store
-                message_collection = db['message_store']
-                message_result = message_collection.delete_many({"SessionId": {"$in": session_ids_to_delete}})
-                current_app.logger.info(f"Deleted {message_result.deleted_count} chat messages for config_id: {config_id}")
-
-                # 4. Delete the chat session metadata itself
-                metadata_result = metadata_collection.delete_many({"config_id": config_id})
-                current_app.logger.info(f"Deleted {metadata_result.deleted_count} chat session metadata entries for config_id: {config_id}")
-
-        except Exception as e:
-            current_app.logger.error(f"Error during cascading delete for config_id '{config_id}': {e}", exc_info=True)
-            # Warn the user that cleanup failed but the main config was deleted
-            return jsonify({
-                "message": "Configuration deleted, but a failure occurred during data cleanup.",
-                "warning": str(e)
-            }), 200
+            job = start_reembed(Config.get_collection(), config_id, target_model)
+        except ReembedInProgress as e:
+            return jsonify({"message": str(e)}), 409
+        except ReembedError as e:
+            return jsonify({"message": str(e)}), 400
 
-        return jsonify({"message": "Configuration deleted successfully"}), 200
+        current_app.logger.info(f"Scheduled re-embedding of config {config_id}: {job['source_model']} -> {target_model} ({job['total']} chunks)")
+        return jsonify({"message": "Re-embedding scheduled", "reembed": reembed_status({"reembed": job})}), 202
 
     except Exception as e:
-        current_app.logger.error(f"An error occurred in delete_config: {e}", exc_info=True)
-        return jsonify({"error": "An internal server error occurred"}), 500
\ No newline at end of file
+        current_app.logger.error(f"An error occurred in reembed_config: {e}", exc_info=True)
+        return jsonify({"error": "An internal server error occurred"}), 500
+
+
+@edit_config_bp.route('/config/<string:config_id>/reembed', methods=['GET'])
+@jwt_required()
+def get_reembed_status(config_id):
+    """Reports the progress of a config's re-embedding job."""
+    try:
+        user_id = get_jwt_identity()
+        if not ObjectId.is_valid(config_id):
+            return jsonify({"message": "Invalid configuration ID format"}), 400
+        config = Config.find_owned(config_id, user_id)
+        if not config:
+            return jsonify({"message": "Configuration not found or access denied"}), 404
+        return jsonify({"reembed": reembed_status(config)}), 200
+
+    except Exception as e:
+        current_app.logger.error(f"An error occurred in get_reembed_status: {e}", exc_info=True)
+        return jsonify({"error": "An internal server error occurred"}), 500
@@ -0,0 +1,67 @@
+from flask import Blueprint, request, jsonify, current_app, Response, stream_with_context
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from bson import ObjectId
+import logging
+
+from models.chat_session import ChatSession
+from models.config import Config
+from models.message_store import MessageStore
+from src.services.transcript_export_service import (
+    build_export_query, parse_export_date, iter_export_batches, ndjson_chunks, gzip_csv_chunks, survey_sessions_of_config
+)
+
+logger = logging.getLogger(__name__)
+export_bp = Blueprint('export_routes', __name__)
+
+@export_bp.route('/export/transcripts', methods=['GET'])
+@jwt_required()
+def export_transcripts():
+    """
+    Streams the chat transcripts of one of the user's configs. Survey messages are included when
+    their history was created with the config_id (MongoDbChatMessageHistory), or, with survey_id,
+    when their session belongs to the config in chat_session_metadata.
+
+    Query parameters:
+        config_id (required), survey_id, start, end (ISO dates, end exclusive),
+        format: 'ndjson' (default) or 'csv' (gzip-compressed),
+        after: checkpoint token, i.e. the `id` of the last record already received.
+    """
+    try:
+        user_id = get_jwt_identity()
+        config_id = request.args.get('config_id')
+        if not config_id or not ObjectId.is_valid(config_id):
+            return jsonify({"message": "A valid config_id is required"}), 400
+        if not Config.find_owned(config_id, user_id):
+            return jsonify({"message": "Configuration not found or access denied"}), 404
+
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            return jsonify({"message": "format must be 'ndjson' or 'csv'"}), 400
+
+        after = request.args.get('after')
+        if after and not ObjectId.is_valid(after):
+            return jsonify({"message": "Invalid checkpoint token"}), 400
+
+        try:
+            start = parse_export_date(request.args['start']) if request.args.get('start') else None
+            end = parse_export_date(request.args['end']) if request.args.get('end') else None
+        except ValueError:
+            return jsonify({"message": "start and end must be ISO 8601 dates"}), 400
+
+        survey_id = request.args.get('survey_id')
+        survey_sessions = None
+        if survey_id:
+            survey_sessions = survey_sessions_of_config(MessageStore.get_collection(), ChatSession.get_collection(), config_id, survey_id)
+        query = build_export_query(config_id=config_id, survey_id=survey_id, start=start, end=end, survey_sessions=survey_sessions)
+        batches = iter_export_batches(MessageStore.get_collection(), query, after=after)
+
+        if export_format == 'csv':
+            response = Response(stream_with_context(gzip_csv_chunks(batches, include_header=after is None)), mimetype='application/gzip')
+            response.headers['Content-Disposition'] = f'attachment; filename="transcripts-{config_id}.csv.gz"'
+        else:
+            response = Response(stream_with_context(ndjson_chunks(batches)), mimetype='application/x-ndjson')
+            response.headers['Content-Disposition'] = f'attachment; filename="transcripts-{config_id}.ndjson"'
+        return response
+    except Exception as e:
+        current_app.logger.error(f"Error exporting transcripts: {e}", exc_info=True)
+        return jsonify({"message": "An internal server error occurred"}), 500
@@ -0,0 +1,68 @@
+from flask import Blueprint, request, jsonify, current_app, Response, send_file
+import json
+import os
+import re
+
+from src.utils.profiling import SETTINGS, PROFILE_HEADER
+
+profile_bp = Blueprint('profile_routes', __name__)
+
+PROFILE_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]+$')
+
+def authorized():
+    """The profile endpoints use the same token as the X-Profile header."""
+    return bool(SETTINGS.token) and request.headers.get(PROFILE_HEADER) == SETTINGS.token
+
+@profile_bp.route('/profiles', methods=['GET'])
+def list_profiles():
+    """Lists the stored request profiles, newest first."""
+    if not authorized():
+        return jsonify({"message": "Unauthorized"}), 401
+    try:
+        if not os.path.isdir(SETTINGS.directory):
+            return jsonify({"profiles": []}), 200
+        profiles = []
+        for name in os.listdir(SETTINGS.directory):
+            if not name.endswith('.json'):
+                continue
+            path = os.path.join(SETTINGS.directory, name)
+            with open(path) as f:
+                profile = json.load(f)
+            profiles.append({
+                "id": profile["id"],
+                "endpoint": profile.get("endpoint"),
+                "method": profile.get("method"),
+                "path": profile.get("path"),
+                "request_id": profile.get("request_id"),
+                "started_at": profile.get("started_at"),
+                "duration_seconds": profile.get("duration_seconds"),
+                "samples": profile.get("samples"),
+            })
+        profiles.sort(key=lambda p: p["started_at"] or "", reverse=True)
+        return jsonify({"profiles": profiles}), 200
+    except Exception as e:
+        current_app.logger.error(f"Error listing profiles: {e}", exc_info=True)
+        return jsonify({"message": "An internal server error occurred"}), 500
+
+@profile_bp.route('/profiles/<string:profile_id>', methods=['GET'])
+def download_profile(profile_id):
+    """
+    Downloads a profile: the full JSON by default, or ?format=folded for the folded stacks
+    (one "frame;frame;... count" line per stack, the input of flamegraph.pl and speedscope).
+    """
+    if not authorized():
+        return jsonify({"message": "Unauthorized"}), 401
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return jsonify({"message": "Invalid profile id"}), 400
+    path = os.path.join(SETTINGS.directory, f"{profile_id}.json")
+    if not os.path.exists(path):
+        return jsonify({"message": "Profile not found"}), 404
+
+    if request.args.get('format') == 'folded':
+        with open(path) as f:
+            profile = json.load(f)
+        folded = "".join(f"{stack} {count}\n" for stack, count in profile.get("folded_stacks", {}).items())
+        response = Response(folded, mimetype='text/plain')
+        response.headers['Content-Disposition'] = f'attachment; filename="{profile_id}.folded"'
+        return response
+    return send_file(os.path.abspath(path), mimetype='application/json', as_attachment=True, download_name=f"{profile_id}.json")
@@ -0,0 +1,57 @@
+from flask import Blueprint, request, jsonify, current_app
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from bson import ObjectId
+from pymongo import ASCENDING
+import logging
+
+from models.usage_rollup import UsageRollup
+from src.services.transcript_export_service import parse_export_date
+from src.services.usage_service import GRANULARITIES, default_usage_range, usage_query, usage_report
+
+logger = logging.getLogger(__name__)
+usage_bp = Blueprint('usage_routes', __name__)
+
+@usage_bp.route('/usage', methods=['GET'])
+@jwt_required()
+def get_usage():
+    """
+    Reports the token usage and latencies of the user's configs, from the usage rollups.
+
+    Query parameters:
+        config_id, kind ('chat' or 'ingest'),
+        start, end (ISO dates, end exclusive; default the last 7 days),
+        granularity: 'hour', 'day' (default) or 'total'.
+    """
+    try:
+        user_id = get_jwt_identity()
+        config_id = request.args.get('config_id')
+        if config_id and not ObjectId.is_valid(config_id):
+            return jsonify({"message": "Invalid config_id"}), 400
+
+        kind = request.args.get('kind')
+        if kind and kind not in ('chat', 'ingest'):
+            return jsonify({"message": "kind must be 'chat' or 'ingest'"}), 400
+
+        granularity = request.args.get('granularity', 'day')
+        if granularity not in GRANULARITIES:
+            return jsonify({"message": f"granularity must be one of {', '.join(GRANULARITIES)}"}), 400
+
+        start, end = default_usage_range()
+        try:
+            start = parse_export_date(request.args['start']) if request.args.get('start') else start
+            end = parse_export_date(request.args['end']) if request.args.get('end') else end
+        except ValueError:
+            return jsonify({"message": "start and end must be ISO 8601 dates"}), 400
+
+        docs = UsageRollup.get_collection().find(
+            usage_query(user_id, start, end, config_id=config_id, kind=kind), {"_id": 0}
+        ).sort("bucket", ASCENDING)
+        return jsonify({
+            "start": start.isoformat(),
+            "end": end.isoformat(),
+            "granularity": granularity,
+            "usage": usage_report(docs, granularity)
+        }), 200
+    except Exception as e:
+        current_app.logger.error(f"Error reporting usage: {e}", exc_info=True)
+        return jsonify({"message": "An internal server error occurred"}), 500
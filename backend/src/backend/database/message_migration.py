@@ -0,0 +1,211 @@
+import logging
+import json
+import time
+from datetime import datetime, timezone
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo import ASCENDING, UpdateOne
+from pymongo.database import Database
+
+from models.chat_session import TITLE_MAX_LENGTH
+from src.backend.database.mongo_utils import history_to_message_dict
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_ID = "message_store_native_history"
+SESSION_SUMMARY_MIGRATION_ID = "chat_session_summaries"
+
+def migrate_message_store(db: Database, batch_size: int = 500, pause_seconds: float = 0.2, max_batches: int = None, restart: bool = False):
+    """
+    Converts legacy message_store documents (JSON string `History`) to the native BSON format in place.
+
+    Work is done in batches ordered by _id. After each batch the last processed _id is saved to the
+    `migrations` collection, so an interrupted run resumes where it stopped. Each update is guarded on
+    the original string value, which keeps the migration safe to run while the app is serving traffic.
+    `pause_seconds` throttles the load put on the cluster between batches.
+
+    Returns the progress document.
+    """
+    message_collection = db["message_store"]
+    progress_collection = db["migrations"]
+
+    if restart:
+        progress_collection.delete_one({"_id": MIGRATION_ID})
+
+    state = progress_collection.find_one({"_id": MIGRATION_ID}) or {}
+    last_id = state.get("last_id")
+    if last_id:
+        logger.info(f"Resuming message_store migration after _id {last_id}")
+
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        query = {"History": {"$type": "string"}}
+        if last_id:
+            query["_id"] = {"$gt": last_id}
+        batch = list(message_collection.find(query, {"History": 1}).sort("_id", ASCENDING).limit(batch_size))
+
+        if not batch:
+            progress_collection.update_one(
+                {"_id": MIGRATION_ID},
+                {"$set": {"completed_at": datetime.now(timezone.utc)}},
+                upsert=True
+            )
+            logger.info("message_store migration completed.")
+            break
+
+        operations = []
+        failed = 0
+        for doc in batch:
+            try:
+                history = json.loads(doc["History"])
+            except (json.JSONDecodeError, TypeError):
+                failed += 1
+                logger.warning(f"Skipping message {doc['_id']} with malformed History")
+                continue
+            operations.append(UpdateOne(
+                {"_id": doc["_id"], "History": doc["History"]},
+                {"$set": {"History": history, "created_at": doc["_id"].generation_time}}
+            ))
+
+        converted = 0
+        if operations:
+            converted = message_collection.bulk_write(operations, ordered=False).modified_count
+
+        last_id = batch[-1]["_id"]
+        progress_collection.update_one(
+            {"_id": MIGRATION_ID},
+            {
+                "$set": {"last_id": last_id, "updated_at": datetime.now(timezone.utc)},
+                "$inc": {"converted": converted, "failed": failed},
+                "$unset": {"completed_at": ""}
+            },
+            upsert=True
+        )
+        batches += 1
+        logger.info(f"Migrated batch {batches}: {converted} converted, {failed} skipped, last _id {last_id}")
+
+        if pause_seconds:
+            time.sleep(pause_seconds)
+
+    return progress_collection.find_one({"_id": MIGRATION_ID})
+
+def session_title(doc: dict):
+    """The title a session gets from its first message document: the content, or None if it has none."""
+    try:
+        content = (history_to_message_dict(doc.get("History")) or {}).get("data", {}).get("content")
+    except (json.JSONDecodeError, TypeError, AttributeError):
+        return None
+    return content[:TITLE_MAX_LENGTH] if isinstance(content, str) and content else None
+
+def backfill_session_summary(session_collection, message_collection, session: dict) -> bool:
+    """
+    Sets a session's title, message_count and last_activity from its messages. The update is
+    guarded on the message count read before counting, so a message written meanwhile makes it
+    a no-op (returns False) instead of being lost from the count.
+    """
+    session_id = session["session_id"]
+    count = message_collection.count_documents({"SessionId": session_id})
+    first = message_collection.find_one({"SessionId": session_id}, {"History": 1}, sort=[("_id", ASCENDING)])
+    last = message_collection.find_one({"SessionId": session_id}, {"created_at": 1}, sort=[("_id", -1)])
+    update = {"$set": {"message_count": count, "title": session_title(first) if first else None}}
+    if last:
+        update["$max"] = {"last_activity": (last.get("created_at") or last["_id"].generation_time).replace(tzinfo=None)}
+    guard = session["message_count"] if "message_count" in session else {"$exists": False}
+    return session_collection.update_one({"_id": session["_id"], "message_count": guard}, update).modified_count == 1
+
+def backfill_session_summaries(db: Database, batch_size: int = 500, pause_seconds: float = 0.2, max_batches: int = None, restart: bool = False):
+    """
+    Fills in the summary (title, message_count, last_activity) of the chat_session_metadata
+    documents written before sessions kept one, from message_store. Every session is recounted,
+    since a session that got a message after the upgrade has a count of those messages only.
+    Resumable like migrate_message_store; a session that got a message while it was being
+    counted is counted once more. Returns the progress document.
+    """
+    session_collection = db["chat_session_metadata"]
+    message_collection = db["message_store"]
+    progress_collection = db["migrations"]
+
+    if restart:
+        progress_collection.delete_one({"_id": SESSION_SUMMARY_MIGRATION_ID})
+
+    state = progress_collection.find_one({"_id": SESSION_SUMMARY_MIGRATION_ID}) or {}
+    last_id = state.get("last_id")
+    if last_id:
+        logger.info(f"Resuming session summary backfill after _id {last_id}")
+
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        query = {"_id": {"$gt": last_id}} if last_id else {}
+        batch = list(session_collection.find(query, {"session_id": 1, "message_count": 1}).sort("_id", ASCENDING).limit(batch_size))
+
+        if not batch:
+            progress_collection.update_one(
+                {"_id": SESSION_SUMMARY_MIGRATION_ID},
+                {"$set": {"completed_at": datetime.now(timezone.utc)}},
+                upsert=True
+            )
+            logger.info("Session summary backfill completed.")
+            break
+
+        updated = 0
+        for session in batch:
+            if backfill_session_summary(session_collection, message_collection, session):
+                updated += 1
+                continue
+            current = session_collection.find_one({"_id": session["_id"]}, {"session_id": 1, "message_count": 1})
+            if current and backfill_session_summary(session_collection, message_collection, current):
+                updated += 1
+
+        last_id = batch[-1]["_id"]
+        progress_collection.update_one(
+            {"_id": SESSION_SUMMARY_MIGRATION_ID},
+            {
+                "$set": {"last_id": last_id, "updated_at": datetime.now(timezone.utc)},
+                "$inc": {"updated": updated, "skipped": len(batch) - updated},
+                "$unset": {"completed_at": ""}
+            },
+            upsert=True
+        )
+        batches += 1
+        logger.info(f"Backfilled session batch {batches}: {updated} updated, last _id {last_id}")
+
+        if pause_seconds:
+            time.sleep(pause_seconds)
+
+    return progress_collection.find_one({"_id": SESSION_SUMMARY_MIGRATION_ID})
+
+@click.command("migrate-message-store")
+@click.option("--batch-size", default=500, show_default=True, help="Documents converted per batch.")
+@click.option("--pause", default=0.2, show_default=True, help="Seconds to sleep between batches.")
+@click.option("--max-batches", default=None, type=int, help="Stop after this many batches (resume later).")
+@click.option("--restart", is_flag=True, help="Ignore saved progress and start from the beginning.")
+@click.option("--skip-sessions", is_flag=True, help="Do not backfill the chat session summaries.")
+@with_appcontext
+def migrate_message_store_command(batch_size, pause, max_batches, restart, skip_sessions):
+    """Convert message_store History strings to native BSON documents, then backfill the chat session summaries."""
+    progress = migrate_message_store(
+        current_app.config['MONGO_DB'],
+        batch_size=batch_size,
+        pause_seconds=pause,
+        max_batches=max_batches,
+        restart=restart
+    ) or {}
+    click.echo(
+        f"converted={progress.get('converted', 0)} failed={progress.get('failed', 0)} "
+        f"last_id={progress.get('last_id')} completed={'completed_at' in progress}"
+    )
+    if skip_sessions or "completed_at" not in progress:
+        return
+
+    sessions = backfill_session_summaries(
+        current_app.config['MONGO_DB'],
+        batch_size=batch_size,
+        pause_seconds=pause,
+        max_batches=max_batches,
+        restart=restart
+    ) or {}
+    click.echo(
+        f"sessions updated={sessions.get('updated', 0)} skipped={sessions.get('skipped', 0)} "
+        f"last_id={sessions.get('last_id')} completed={'completed_at' in sessions}"
+    )
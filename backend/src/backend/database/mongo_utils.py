@@ -1,13 +1,42 @@
 import logging
+import json
 import pymongo
 from pymongo.database import Database
 from pymongo.collection import Collection
 # You might not need StreamlitChatMessageHistory anymore, as we're not using it.
 # from langchain_community.chat_message_histories import StreamlitChatMessageHistory 
 from langchain_community.chat_message_histories import MongoDBChatMessageHistory # this one is key
+from langchain_core.messages import BaseMessage, message_to_dict, messages_from_dict
+from typing import List, Sequence
+from datetime import datetime, timezone
 
 logger = logging.getLogger(__name__)
 
+# --- message_store schema ---
+# Messages are stored with `History` as a native BSON subdocument ({"type": ..., "data": {"content": ..., ...}})
+# plus a `created_at` timestamp. Older documents hold `History` as a JSON string; readers accept both
+# until the migration in message_migration.py has converted them.
+
+def message_to_document(message: BaseMessage) -> dict:
+    """Returns the native `History` subdocument for a LangChain message."""
+    return message_to_dict(message)
+
+def history_to_message_dict(history) -> dict:
+    """Returns the message dict for a stored `History` value in either the legacy string or the native format."""
+    if isinstance(history, str):
+        return json.loads(history)
+    return history
+
+def load_session_messages(collection: Collection, session_id: str) -> List[BaseMessage]:
+    """Loads all messages of a session in insertion order, accepting both storage formats."""
+    cursor = collection.find({"SessionId": session_id}, {"History": 1}).sort("_id", pymongo.ASCENDING)
+    return messages_from_dict([history_to_message_dict(doc["History"]) for doc in cursor])
+
+async def aload_session_messages(collection, session_id: str) -> List[BaseMessage]:
+    """Async variant of load_session_messages for a pymongo AsyncCollection."""
+    cursor = collection.find({"SessionId": session_id}, {"History": 1}).sort("_id", pymongo.ASCENDING)
+    return messages_from_dict([history_to_message_dict(doc["History"]) async for doc in cursor])
+
 # This part is from your main.py but belongs here
 def get_mongo_db_connection(mongo_uri: str, db_name: str, collection_name: str):
     """Establishes a connection to MongoDB and returns the client, db, and collection."""
@@ -63,7 +92,8 @@ class MongoDbChatMessageHistory(MongoDBChatMessageHistory):
     """
     Custom MongoDB chat message history that can save additional metadata.
     """
-    def __init__(self, connection_string: str, session_id: str, response_id: str, agent_id: str, survey_id: str, database_name: str, collection_name: str):
+    def __init__(self, connection_string: str, session_id: str, response_id: str, agent_id: str, survey_id: str, database_name: str, collection_name: str,
+                 config_id: str = None):
         # We pass the required arguments to the base class's __init__
         super().__init__(
             connection_string=connection_string,
@@ -74,29 +104,45 @@ class MongoDbChatMessageHistory(MongoDBChatMessageHistory):
         self.response_id = response_id
         self.agent_id = agent_id
         self.survey_id = survey_id
+        # The config the survey's chatbot runs on; the owner's transcript export (routes/export_routes.py) filters on it
+        self.config_id = config_id
 
-    def add_message(self, message) -> None:
+    @property
+    def messages(self) -> List[BaseMessage]:
+        """Retrieve the messages from MongoDB in either storage format."""
+        return load_session_messages(self.collection, self.session_id)
+
+    def message_document(self, message: BaseMessage) -> dict:
+        """Builds the message_store document for a message, survey metadata included."""
+        document = {
+            "SessionId": self.session_id,
+            "History": message_to_document(message),
+            "created_at": datetime.now(timezone.utc),
+            "ResponseId": self.response_id,
+            "AgentId": self.agent_id,
+            "SurveyId": self.survey_id
+        }
+        if self.config_id is not None:
+            document["config_id"] = str(self.config_id)
+        return document
+
+    def add_message(self, message: BaseMessage) -> None:
         """
-        Adds a message to the history and updates the document with additional metadata.
+        Adds a message to the history together with its ResponseId/AgentId/SurveyId metadata,
+        in a single insert. A failed insert is logged and raised, so the caller sees the lost message.
         """
-        # The base class adds the message. We'll add our metadata after the fact.
-        # This is a bit of a workaround since the base class doesn't have a hook for this.
-        super().add_message(message)
+        try:
+            self.collection.insert_one(self.message_document(message))
+        except Exception as e:
+            logger.error(f"Failed to add message for session '{self.session_id}': {e}", exc_info=True)
+            raise
 
-        # Let's find the last message we just added and update it.
-        # This is not atomic, but it works.
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Adds a whole turn (or any batch of messages) with one ordered insert_many."""
+        if not messages:
+            return
         try:
-            # The collection is accessible as `self.collection` in the base class.
-            self.collection.update_one(
-                {"SessionId": self.session_id, "History.data.content": message.content},
-                {"$set": {
-                    "SessionId": self.session_id, # Ensure session_id is always part of the update
-                    "ResponseId": self.response_id,
-                    "AgentId": self.agent_id,
-                    "SurveyId": self.survey_id
-                }},
-                upsert=False # We are updating an existing message, not inserting a new one
-            )
-            logger.debug(f"Metadata updated for session '{self.session_id}'.")
+            self.collection.insert_many([self.message_document(message) for message in messages], ordered=True)
         except Exception as e:
-            logger.error(f"Failed to update metadata for message: {e}", exc_info=True)
\ No newline at end of file
+            logger.error(f"Failed to add {len(messages)} messages for session '{self.session_id}': {e}", exc_info=True)
+            raise
@@ -0,0 +1,161 @@
+import logging
+import os
+import threading
+from typing import List
+from langchain_core.embeddings import Embeddings
+from langchain_openai.embeddings import OpenAIEmbeddings
+
+from src.backend.llm_scheduler import CHAT, ScheduledEmbeddings
+
+logger = logging.getLogger(__name__)
+
+# --- Embedding models ---
+# The deployment picks its embedding model with EMBEDDING_MODEL (a key of EMBEDDING_MODELS).
+# The model id is recorded on every config (`embedding_model`) and on every chunk it stores, and
+# a config is always queried with the model its chunks were embedded with, so changing the
+# deployment model only affects configs created afterwards. `flask embedding-report` lists
+# configs whose chunks do not match their recorded model.
+#
+# Vectors of different sizes cannot share an Atlas vector index, so every dimension has its own
+# index on the `embedding` path (the `index` of each model below). A config being moved to another
+# model (src/services/reembed_service.py) gets its new vectors in the other vector field of its
+# chunks, whose indexes carry a "_next" suffix; the config's `embedding_field` says which one to read.
+
+EMBEDDING_MODELS = {
+    "openai/text-embedding-3-large": {"provider": "openai", "model": "text-embedding-3-large", "dimensions": 3072, "index": "vector"},
+    "openai/text-embedding-3-small": {"provider": "openai", "model": "text-embedding-3-small", "dimensions": 1536, "index": "vector_1536"},
+    "local/all-MiniLM-L6-v2": {"provider": "local", "model": "sentence-transformers/all-MiniLM-L6-v2", "dimensions": 384, "index": "vector_384"},
+    "local/bge-small-en-v1.5": {"provider": "local", "model": "BAAI/bge-small-en-v1.5", "dimensions": 384, "index": "vector_384"},
+}
+
+# Configs and chunks stored before the model id was recorded were embedded with this model
+LEGACY_EMBEDDING_MODEL = "openai/text-embedding-3-large"
+
+# The two chunk fields a config's vectors can live in; a re-embedding writes to the one not in use
+EMBEDDING_FIELDS = ("embedding", "embedding_next")
+
+class UnknownEmbeddingModel(ValueError):
+    pass
+
+def embedding_spec(model_id: str) -> dict:
+    spec = EMBEDDING_MODELS.get(model_id)
+    if spec is None:
+        raise UnknownEmbeddingModel(f"Unknown embedding model '{model_id}'; expected one of: {', '.join(EMBEDDING_MODELS)}")
+    return spec
+
+def default_embedding_model() -> str:
+    """The deployment's embedding model (EMBEDDING_MODEL), validated."""
+    model_id = os.getenv("EMBEDDING_MODEL", LEGACY_EMBEDDING_MODEL)
+    embedding_spec(model_id)
+    return model_id
+
+def embedding_model_of(config_document: dict) -> str:
+    """The embedding model a config's chunks were stored with."""
+    return config_document.get("embedding_model") or LEGACY_EMBEDDING_MODEL
+
+def embedding_field_of(config_document: dict) -> str:
+    """The chunk field holding the vectors a config is queried with."""
+    return config_document.get("embedding_field") or EMBEDDING_FIELDS[0]
+
+def other_embedding_field(field: str) -> str:
+    return EMBEDDING_FIELDS[1] if field == EMBEDDING_FIELDS[0] else EMBEDDING_FIELDS[0]
+
+def vector_index_for(model_id: str, field: str = EMBEDDING_FIELDS[0]) -> str:
+    """The Atlas vector search index over `field` holding the vectors of `model_id`."""
+    index = embedding_spec(model_id)["index"]
+    return index if field == EMBEDDING_FIELDS[0] else f"{index}_next"
+
+def vector_search_target(config_document: dict):
+    """The (embedding model, vector field, Atlas index) a config is queried with."""
+    model_id = embedding_model_of(config_document)
+    field = embedding_field_of(config_document)
+    return model_id, field, vector_index_for(model_id, field)
+
+class LocalEmbeddings(Embeddings):
+    """
+    A sentence-transformers model run on the worker's CPU (needs the optional sentence-transformers
+    package). The model is loaded once per worker, on first use or by the warm-up, and inputs are
+    encoded in batches of LOCAL_EMBEDDING_BATCH_SIZE. At most LOCAL_EMBEDDING_THREADS encodes run at
+    a time per worker, so request threads cannot oversubscribe the CPU; LOCAL_EMBEDDING_BACKEND=onnx
+    runs the model with ONNX Runtime instead of torch.
+    """
+
+    def __init__(self, model_name: str, batch_size: int = 32, max_threads: int = 2, backend: str = "torch", device: str = "cpu"):
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.backend = backend
+        self.device = device
+        self._model = None
+        self._load_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_threads)
+
+    def load(self):
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    try:
+                        from sentence_transformers import SentenceTransformer
+                    except ImportError as e:
+                        raise RuntimeError("Local embedding models need the sentence-transformers package (pip install sentence-transformers)") from e
+                    kwargs = {"device": self.device}
+                    if self.backend != "torch":
+                        kwargs["backend"] = self.backend
+                    self._model = SentenceTransformer(self.model_name, **kwargs)
+                    logger.info(f"Loaded local embedding model {self.model_name} ({self.backend} on {self.device})")
+        return self._model
+
+    def _encode(self, texts: List[str]) -> List[List[float]]:
+        model = self.load()
+        with self._slots:
+            vectors = model.encode(texts, batch_size=self.batch_size, normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False)
+        return vectors.tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._encode(list(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._encode([text])[0]
+
+def create_embeddings(model_id: str, app_config) -> Embeddings:
+    """Creates the LangChain embeddings client of a registered model."""
+    spec = embedding_spec(model_id)
+    if spec["provider"] == "openai":
+        return OpenAIEmbeddings(model=spec["model"], api_key=app_config.get("OPENAI_API_KEY"))
+    return LocalEmbeddings(
+        spec["model"],
+        batch_size=int(os.getenv("LOCAL_EMBEDDING_BATCH_SIZE", 32)),
+        max_threads=int(os.getenv("LOCAL_EMBEDDING_THREADS", 2)),
+        backend=os.getenv("LOCAL_EMBEDDING_BACKEND", "torch"),
+        device=os.getenv("LOCAL_EMBEDDING_DEVICE", "cpu"),
+    )
+
+# Embedding clients of the worker, keyed by model id. Like the chat models they hold connection
+# pools (or a loaded model), so they are created after fork: see src/backend/resources.py.
+_embeddings = {}
+_embeddings_lock = threading.Lock()
+
+def get_embeddings(model_id: str, app_config, priority: int = CHAT) -> Embeddings:
+    """
+    Returns the worker's embeddings client for `model_id`; provider models come wrapped for the
+    outbound scheduler (src/backend/llm_scheduler.py) with `priority`. The deployment model is the
+    client in app.config['EMBEDDINGS'], so replacing that one (as the offline benchmarks do) replaces it everywhere.
+    """
+    if model_id == app_config.get("EMBEDDING_MODEL") and app_config.get("EMBEDDINGS") is not None:
+        embeddings = app_config["EMBEDDINGS"]
+    else:
+        embeddings = _embeddings.get(model_id)
+        if embeddings is None:
+            with _embeddings_lock:
+                embeddings = _embeddings.get(model_id)
+                if embeddings is None:
+                    embeddings = _embeddings[model_id] = create_embeddings(model_id, app_config)
+                    logger.info(f"Created embeddings client for {model_id}")
+    spec = embedding_spec(model_id)
+    if spec["provider"] == "openai":
+        return ScheduledEmbeddings(embeddings, "openai", app_config.get("OPENAI_API_KEY"), priority)
+    return embeddings
+
+def reset_embeddings():
+    """Drops all cached embeddings clients (e.g. clients inherited from a parent process)."""
+    with _embeddings_lock:
+        _embeddings.clear()
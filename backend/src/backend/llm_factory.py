@@ -0,0 +1,72 @@
+import logging
+import threading
+from langchain_openai import ChatOpenAI
+from langchain_community.chat_models import ChatTongyi
+from langchain_deepseek import ChatDeepSeek
+
+from src.backend.llm_scheduler import CHAT, ScheduledChatModel
+
+logger = logging.getLogger(__name__)
+
+# Chat model clients are reused across requests of a worker process, keyed by (model_name, temperature).
+# Each holds an HTTP connection pool, so they must be created after fork: reset_chat_models() is called
+# from the worker initialization (src/backend/resources.py). Callers get the client wrapped for the
+# outbound scheduler (src/backend/llm_scheduler.py) with the priority of their traffic.
+_chat_models = {}
+_chat_models_lock = threading.Lock()
+
+# (model_name prefix, scheduler provider, app config key of the API key)
+PROVIDERS = (
+    ("gpt", "openai", "OPENAI_API_KEY"),
+    ("qwen", "qwen", "QWEN_API_KEY"),
+    ("deepseek", "deepseek", "DEEPSEEK_API_KEY"),
+)
+
+def provider_of(model_name: str):
+    """The (provider, API key config name) of a model_name, or None."""
+    for prefix, provider, key_name in PROVIDERS:
+        if model_name and model_name.startswith(prefix):
+            return provider, key_name
+    return None
+
+def create_chat_model(model_name: str, temperature, app_config):
+    """
+    Creates the LangChain chat model for a config's model_name, or returns None if the provider is unsupported.
+    The OpenAI-compatible clients ask for the token usage of streamed answers too (usage accounting, src/utils/usage.py).
+    """
+    if not model_name:
+        return None
+    if model_name.startswith('gpt'):
+        return ChatOpenAI(model=model_name, temperature=temperature, api_key=app_config.get("OPENAI_API_KEY"), stream_usage=True)
+    if model_name.startswith('qwen'):
+        return ChatTongyi(model=model_name, api_key=app_config.get("QWEN_API_KEY"))
+    if model_name.startswith('deepseek'):
+        return ChatDeepSeek(model=model_name, temperature=temperature, api_key=app_config.get("DEEPSEEK_API_KEY"), stream_usage=True)
+    return None
+
+def get_chat_model(model_name: str, temperature, app_config, priority: int = CHAT):
+    """
+    Returns the worker's shared chat model client for (model_name, temperature), creating it on first use,
+    behind the outbound scheduler with `priority` (CHAT, BATCH or INGEST).
+    """
+    key = (model_name, temperature, priority)
+    llm = _chat_models.get(key)
+    if llm is None:
+        with _chat_models_lock:
+            llm = _chat_models.get(key)
+            if llm is None:
+                client = _chat_models.get((model_name, temperature))
+                if client is None:
+                    client = create_chat_model(model_name, temperature, app_config)
+                    if client is None:
+                        return None
+                    _chat_models[(model_name, temperature)] = client
+                    logger.info(f"Created chat model client for {model_name} (temperature={temperature})")
+                provider, key_name = provider_of(model_name)
+                llm = _chat_models[key] = ScheduledChatModel(model=client, provider=provider, api_key=app_config.get(key_name), priority=priority)
+    return llm
+
+def reset_chat_models():
+    """Drops all cached chat model clients (e.g. clients inherited from a parent process)."""
+    with _chat_models_lock:
+        _chat_models.clear()
@@ -0,0 +1,553 @@
+import asyncio
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import threading
+import time
+from typing import Any, List, Optional
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from src.utils.deadline import DeadlineExceeded, check_deadline, current_deadline, stage_timeout
+from src.utils.metrics import LLM_PROVIDER_RATE_LIMITED, LLM_SCHEDULER_QUEUED, LLM_SCHEDULER_WAIT_SECONDS
+from src.utils.usage import record_embedding_usage, record_llm_usage
+
+logger = logging.getLogger(__name__)
+
+# --- Outbound LLM scheduler ---
+# Every chat model and embedding call to a provider (src/backend/llm_factory.py,
+# src/backend/embedding_factory.py) first takes a reservation from the worker's scheduler, which
+# keeps a request and a token bucket per provider and API key, refilled at the provider's RPM and
+# TPM limits (LLM_RATE_LIMITS). Calls wait for their budget instead of going out and coming back
+# with a 429, and while the budget is short, interactive chat goes first, then batch evaluation,
+# then ingestion and re-embedding.
+#
+# A call's tokens are estimated before it is sent (prompt characters / 4, plus the expected
+# completion) and settled against the usage the provider reports. A 429 that gets through anyway
+# pauses the whole budget for the provider's Retry-After.
+#
+# LLM_RATE_LIMITS is JSON keyed by provider, or by "provider#<key fingerprint>" for one API key
+# (the fingerprint is logged when a budget is created):
+#   {"openai": {"rpm": 5000, "tpm": 800000}, "deepseek": {"rpm": 300}}
+# The budgets are per worker, so give each worker its share of the provider limits, and leave a
+# little headroom (e.g. 95%): the provider counts a call only once it arrives.
+# Providers without limits are not scheduled.
+#
+# Within a request with a deadline (src/utils/deadline.py) a call waits for budget no longer than
+# the deadline allows, is sent with the time left as its request timeout where the client takes
+# one, and a stream is closed as soon as the deadline passes or the client goes away.
+#
+# The usage of every call is also added to the request's usage meter (src/utils/usage.py), if it
+# has one; a stream stopped part way is booked with the estimate of what it produced.
+
+CHAT, BATCH, INGEST = 0, 1, 2
+PRIORITY_NAMES = {CHAT: "chat", BATCH: "batch", INGEST: "ingest"}
+
+# How long a call of each priority may wait for budget before it fails with ProviderBusy
+PRIORITY_TIMEOUTS = {
+    CHAT: float(os.getenv("LLM_SCHEDULER_CHAT_TIMEOUT", 10)),
+    BATCH: float(os.getenv("LLM_SCHEDULER_BATCH_TIMEOUT", 300)),
+    INGEST: float(os.getenv("LLM_SCHEDULER_INGEST_TIMEOUT", 600)),
+}
+
+# Providers whose clients take a per-request `timeout` (the OpenAI SDK)
+REQUEST_TIMEOUT_PROVIDERS = ("openai", "deepseek")
+
+EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", 400))
+CHARS_PER_TOKEN = 4
+
+class ProviderBusy(Exception):
+    """Raised when a call could not get provider budget in time; `retry_after` is in seconds."""
+
+    def __init__(self, provider: str, retry_after: int):
+        super().__init__(f"The {provider} rate limit is exhausted, retry in {retry_after}s")
+        self.provider = provider
+        self.retry_after = retry_after
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def estimate_message_tokens(messages: List[BaseMessage]) -> int:
+    return sum(estimate_tokens(message.content if isinstance(message.content, str) else str(message.content)) + 4 for message in messages)
+
+def key_fingerprint(api_key) -> str:
+    """A short, non-reversible name for an API key."""
+    if api_key is None:
+        return "none"
+    secret = api_key.get_secret_value() if hasattr(api_key, "get_secret_value") else str(api_key)
+    return hashlib.sha1(secret.encode()).hexdigest()[:8]
+
+def provider_status(error: Exception):
+    """The HTTP status of a provider error, if it carries one."""
+    status = getattr(error, "status_code", None) or getattr(getattr(error, "response", None), "status_code", None)
+    return status if isinstance(status, int) else None
+
+def timed_out(error: Exception) -> bool:
+    """Whether a provider error is a request timeout (openai.APITimeoutError, httpx.TimeoutException, ...)."""
+    return any("Timeout" in cls.__name__ for cls in type(error).__mro__)
+
+def retry_after_of(error: Exception, default: float = 1.0) -> float:
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after", default))
+    except (TypeError, ValueError):
+        return default
+
+# --- Budgets ---
+
+class TokenBucket:
+    """`limit` units per `period` seconds, with a burst of up to `limit`. May go into debt after a settle()."""
+
+    def __init__(self, limit: float, period: float = 60.0):
+        self.capacity = float(limit)
+        self.rate = limit / period
+        self.level = float(limit)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` units are available (amounts above the capacity count as the capacity)."""
+        self._refill(now)
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def take(self, amount: float, now: float):
+        self._refill(now)
+        self.level -= amount
+
+    def give_back(self, amount: float):
+        self.level = max(min(self.capacity, self.level + amount), -self.capacity)
+
+class Reservation:
+    """A granted call. settle() corrects the token bucket once the actual usage is known."""
+
+    def __init__(self, budget, tokens: int):
+        self.budget = budget
+        self.tokens = tokens
+
+    def settle(self, actual_tokens: Optional[int]):
+        if self.budget is not None and actual_tokens is not None and self.budget.tokens is not None:
+            with self.budget.condition:
+                self.budget.tokens.give_back(self.tokens - actual_tokens)
+                self.budget.notify()
+
+    def rate_limited(self, error: Exception):
+        if self.budget is not None:
+            self.budget.pause(retry_after_of(error))
+
+class ProviderBudget:
+    """The request and token buckets of one provider and API key, handed out in priority order."""
+
+    def __init__(self, name: str, rpm: Optional[float] = None, tpm: Optional[float] = None, period: float = 60.0):
+        self.name = name
+        self.provider = name.split("#")[0]
+        self.requests = TokenBucket(rpm, period) if rpm else None
+        self.tokens = TokenBucket(tpm, period) if tpm else None
+        self.condition = threading.Condition()
+        self.blocked_until = 0.0
+        self._waiting = []  # heap of (priority, sequence)
+        self._sequence = itertools.count()
+        self._async_wakeups = []  # (loop, future) of the event-loop waiters, woken by notify()
+
+    def notify(self):
+        """Wakes every waiter, thread or coroutine, to look at the budget again. Call with the condition held."""
+        self.condition.notify_all()
+        for loop, future in self._async_wakeups:
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+        self._async_wakeups.clear()
+
+    def _wait_time(self, requests: int, tokens: int, now: float) -> float:
+        wait = self.blocked_until - now
+        if self.requests is not None:
+            wait = max(wait, self.requests.wait_time(requests, now))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.wait_time(tokens, now))
+        return wait
+
+    def acquire(self, tokens: int, priority: int = CHAT, requests: int = 1, timeout: float = None) -> Reservation:
+        """Waits until the budget covers the call and no call of higher priority is waiting."""
+        timeout = PRIORITY_TIMEOUTS[priority] if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        entry = (priority, next(self._sequence))
+        labels = {"provider": self.provider, "priority": PRIORITY_NAMES[priority]}
+        with self.condition:
+            heapq.heappush(self._waiting, entry)
+            LLM_SCHEDULER_QUEUED.inc(**labels)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if self._waiting[0] == entry:
+                        wait = self._wait_time(requests, tokens, now)
+                        if wait <= 0:
+                            if self.requests is not None:
+                                self.requests.take(requests, now)
+                            if self.tokens is not None:
+                                self.tokens.take(tokens, now)
+                            heapq.heappop(self._waiting)
+                            LLM_SCHEDULER_WAIT_SECONDS.observe(now - started, **labels)
+                            return Reservation(self, tokens)
+                    if now >= deadline:
+                        raise ProviderBusy(self.provider, max(1, math.ceil(wait or 1)))
+                    self.condition.wait(min(wait, deadline - now) if wait is not None else deadline - now)
+            finally:
+                self._leave(entry, labels)
+
+    async def aacquire(self, tokens: int, priority: int = CHAT, requests: int = 1, timeout: float = None) -> Reservation:
+        """acquire() for the event loop: waits on a future rather than a thread, and leaves the queue when cancelled."""
+        timeout = PRIORITY_TIMEOUTS[priority] if timeout is None else timeout
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        deadline = started + timeout
+        entry = (priority, next(self._sequence))
+        labels = {"provider": self.provider, "priority": PRIORITY_NAMES[priority]}
+        with self.condition:
+            heapq.heappush(self._waiting, entry)
+            LLM_SCHEDULER_QUEUED.inc(**labels)
+        woken = None
+        try:
+            while True:
+                woken = loop.create_future()
+                with self.condition:
+                    now = time.monotonic()
+                    wait = None
+                    if self._waiting[0] == entry:
+                        wait = self._wait_time(requests, tokens, now)
+                        if wait <= 0:
+                            if self.requests is not None:
+                                self.requests.take(requests, now)
+                            if self.tokens is not None:
+                                self.tokens.take(tokens, now)
+                            heapq.heappop(self._waiting)
+                            LLM_SCHEDULER_WAIT_SECONDS.observe(now - started, **labels)
+                            return Reservation(self, tokens)
+                    if now >= deadline:
+                        raise ProviderBusy(self.provider, max(1, math.ceil(wait or 1)))
+                    self._async_wakeups.append((loop, woken))
+                await asyncio.wait({woken}, timeout=min(wait, deadline - now) if wait is not None else deadline - now)
+        finally:
+            # Also on cancellation (deadline, client gone): the entry must not hold back the calls behind it
+            with self.condition:
+                if (loop, woken) in self._async_wakeups:
+                    self._async_wakeups.remove((loop, woken))
+                self._leave(entry, labels)
+
+    def _leave(self, entry: tuple, labels: dict):
+        """Takes a waiter that got its budget, timed out or was cancelled off the queue. Call with the condition held."""
+        if entry in self._waiting:
+            self._waiting.remove(entry)
+            heapq.heapify(self._waiting)
+        LLM_SCHEDULER_QUEUED.dec(**labels)
+        self.notify()
+
+    def pause(self, seconds: float):
+        """Holds every call back for `seconds`, after the provider answered with a 429."""
+        LLM_PROVIDER_RATE_LIMITED.inc(provider=self.provider)
+        with self.condition:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.notify()
+        logger.warning(f"{self.name} returned 429; holding calls back for {seconds:.1f}s")
+
+class LLMScheduler:
+    """The worker's provider budgets, created on first use from `limits` (see LLM_RATE_LIMITS)."""
+
+    def __init__(self, limits: dict, period: float = 60.0):
+        self.limits = limits
+        self.period = period
+        self._budgets = {}
+        self._lock = threading.Lock()
+
+    def budget(self, provider: str, api_key=None) -> Optional[ProviderBudget]:
+        """The budget of a provider and API key, or None if the provider has no limits."""
+        name = f"{provider}#{key_fingerprint(api_key)}"
+        budget = self._budgets.get(name)
+        if budget is None:
+            limits = self.limits.get(name) or self.limits.get(provider)
+            if not limits:
+                return None
+            with self._lock:
+                budget = self._budgets.get(name)
+                if budget is None:
+                    budget = self._budgets[name] = ProviderBudget(name, limits.get("rpm"), limits.get("tpm"), self.period)
+                    logger.info(f"LLM budget {name}: {limits}")
+        return budget
+
+    def acquire(self, provider: str, api_key, tokens: int, priority: int = CHAT, requests: int = 1) -> Reservation:
+        budget = self.budget(provider, api_key)
+        if budget is None:
+            return Reservation(None, tokens)
+        try:
+            return budget.acquire(tokens, priority, requests, timeout=wait_timeout(priority))
+        except ProviderBusy:
+            # Out of time for the request rather than out of patience for the provider
+            check_deadline("provider_wait")
+            raise
+
+    async def aacquire(self, provider: str, api_key, tokens: int, priority: int = CHAT, requests: int = 1) -> Reservation:
+        """acquire() for the event loop."""
+        budget = self.budget(provider, api_key)
+        if budget is None:
+            return Reservation(None, tokens)
+        try:
+            return await budget.aacquire(tokens, priority, requests, timeout=wait_timeout(priority))
+        except ProviderBusy:
+            check_deadline("provider_wait")
+            raise
+
+def wait_timeout(priority: int) -> float:
+    """How long a call may wait for budget: its priority's timeout, or less if the request's deadline comes first."""
+    remaining = stage_timeout("provider_wait")
+    return PRIORITY_TIMEOUTS[priority] if remaining is None else min(PRIORITY_TIMEOUTS[priority], remaining)
+
+def load_rate_limits() -> dict:
+    raw = os.getenv("LLM_RATE_LIMITS")
+    if not raw:
+        return {}
+    try:
+        return json.loads(raw)
+    except ValueError as e:
+        raise ValueError(f"LLM_RATE_LIMITS is not valid JSON: {e}") from e
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def llm_scheduler() -> LLMScheduler:
+    global _scheduler
+    if _scheduler is None:
+        with _scheduler_lock:
+            if _scheduler is None:
+                _scheduler = LLMScheduler(load_rate_limits())
+    return _scheduler
+
+def set_llm_scheduler(scheduler: LLMScheduler):
+    """Replaces the worker's scheduler (benchmarks)."""
+    global _scheduler
+    _scheduler = scheduler
+
+# --- Scheduled clients ---
+
+def usage_counts(message) -> Optional[tuple]:
+    """The (input, output) tokens a provider reported on a message or stream chunk, or None."""
+    usage = getattr(message, "usage_metadata", None)
+    if usage:
+        return usage.get("input_tokens", 0), usage.get("output_tokens", 0)
+    # ChatTongyi reports its usage in the response metadata only
+    usage = (getattr(message, "response_metadata", None) or {}).get("token_usage")
+    if usage:
+        return usage.get("input_tokens", usage.get("prompt_tokens", 0)), usage.get("output_tokens", usage.get("completion_tokens", 0))
+    return None
+
+def content_characters(message) -> int:
+    return len(message.content) if isinstance(message.content, str) else 0
+
+class ScheduledChatModel(BaseChatModel):
+    """A chat model whose calls go through the scheduler with a fixed priority."""
+
+    model: BaseChatModel
+    provider: str
+    api_key: Optional[Any] = None
+    priority: int = CHAT
+
+    @property
+    def _llm_type(self) -> str:
+        return f"scheduled-{self.model._llm_type}"
+
+    def _estimate(self, messages: List[BaseMessage]) -> int:
+        return estimate_message_tokens(messages) + EXPECTED_COMPLETION_TOKENS
+
+    def _prompt_tokens(self, messages: List[BaseMessage]) -> int:
+        return estimate_message_tokens(messages)
+
+    @property
+    def _model_name(self) -> str:
+        return getattr(self.model, "model_name", None) or getattr(self.model, "model", None) or self.provider
+
+    def _account(self, messages: List[BaseMessage], usage: Optional[tuple], characters: int) -> int:
+        """Books a call's usage on the request's meter, estimated if the provider did not report it; returns its total tokens."""
+        estimated = usage is None
+        if estimated:
+            usage = (self._prompt_tokens(messages), characters // CHARS_PER_TOKEN)
+        record_llm_usage(self._model_name, usage[0], usage[1], estimated)
+        return usage[0] + usage[1]
+
+    def _failed(self, reservation: Reservation, error: Exception, deadline=None, stage: str = "llm"):
+        """Handles a failed call; a provider timeout under a request deadline is raised as DeadlineExceeded."""
+        if provider_status(error) == 429:
+            reservation.rate_limited(error)
+        if deadline is not None and not isinstance(error, DeadlineExceeded) and timed_out(error):
+            raise DeadlineExceeded(stage) from error
+
+    def _request_kwargs(self, kwargs: dict, deadline, stage: str) -> dict:
+        """Passes the time `stage` may take to providers whose clients take a per-request timeout."""
+        if deadline is not None and self.provider in REQUEST_TIMEOUT_PROVIDERS and "timeout" not in kwargs:
+            return {**kwargs, "timeout": deadline.timeout(stage)}
+        return kwargs
+
+    def _generate(self, messages, stop=None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs) -> ChatResult:
+        deadline = current_deadline()
+        reservation = llm_scheduler().acquire(self.provider, self.api_key, self._estimate(messages), self.priority)
+        try:
+            message = self.model.invoke(messages, stop=stop, **self._request_kwargs(kwargs, deadline, "llm"))
+        except Exception as e:
+            self._failed(reservation, e, deadline, "llm")
+            raise
+        reservation.settle(self._account(messages, usage_counts(message), content_characters(message)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager: Optional[CallbackManagerForLLMRun] = None, **kwargs):
+        deadline = current_deadline()
+        reservation = llm_scheduler().acquire(self.provider, self.api_key, self._estimate(messages), self.priority)
+        characters = 0
+        usage = None
+        completed = False
+        # The first chunk may take the llm_first_token budget; closing the stream drops the provider connection
+        stream = self.model.stream(messages, stop=stop, **self._request_kwargs(kwargs, deadline, "llm_first_token"))
+        stage = "llm_first_token"
+        try:
+            for chunk in stream:
+                stage = "llm"
+                if deadline is not None:
+                    deadline.check(stage)
+                characters += content_characters(chunk)
+                usage = usage_counts(chunk) or usage
+                generation = ChatGenerationChunk(message=chunk)
+                if run_manager:
+                    run_manager.on_llm_new_token(chunk.content, chunk=generation)
+                yield generation
+            completed = True
+        except Exception as e:
+            self._failed(reservation, e, deadline, stage)
+            raise
+        finally:
+            stream.close()
+            if not completed and characters:
+                self._account(messages, None, characters)
+        reservation.settle(self._account(messages, usage, characters))
+
+    async def _agenerate(self, messages, stop=None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs) -> ChatResult:
+        deadline = current_deadline()
+        reservation = await llm_scheduler().aacquire(self.provider, self.api_key, self._estimate(messages), self.priority)
+        try:
+            message = await self.model.ainvoke(messages, stop=stop, **self._request_kwargs(kwargs, deadline, "llm"))
+        except Exception as e:
+            self._failed(reservation, e, deadline, "llm")
+            raise
+        reservation.settle(self._account(messages, usage_counts(message), content_characters(message)))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _astream(self, messages, stop=None, run_manager: Optional[AsyncCallbackManagerForLLMRun] = None, **kwargs):
+        deadline = current_deadline()
+        reservation = await llm_scheduler().aacquire(self.provider, self.api_key, self._estimate(messages), self.priority)
+        characters = 0
+        usage = None
+        completed = False
+        stream = self.model.astream(messages, stop=stop, **self._request_kwargs(kwargs, deadline, "llm_first_token"))
+        stage = "llm_first_token"
+        try:
+            while True:
+                try:
+                    if deadline is None:
+                        chunk = await stream.__anext__()
+                    else:
+                        chunk = await asyncio.wait_for(stream.__anext__(), deadline.timeout(stage))
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise DeadlineExceeded(stage)
+                stage = "llm"
+                characters += content_characters(chunk)
+                usage = usage_counts(chunk) or usage
+                generation = ChatGenerationChunk(message=chunk)
+                if run_manager:
+                    await run_manager.on_llm_new_token(chunk.content, chunk=generation)
+                yield generation
+            completed = True
+        except Exception as e:
+            self._failed(reservation, e, deadline, stage)
+            raise
+        finally:
+            await stream.aclose()
+            if not completed and characters:
+                self._account(messages, None, characters)
+        reservation.settle(self._account(messages, usage, characters))
+
+class ScheduledEmbeddings(Embeddings):
+    """An embeddings client whose calls go through the scheduler with a fixed priority."""
+
+    def __init__(self, embeddings: Embeddings, provider: str, api_key=None, priority: int = CHAT, batch_size: int = 1000):
+        self.embeddings = embeddings
+        self.provider = provider
+        self.api_key = api_key
+        self.priority = priority
+        self.batch_size = batch_size
+
+    def __getattr__(self, name):
+        # load(), model names and the like of the wrapped client
+        if name == "embeddings":
+            raise AttributeError(name)
+        return getattr(self.embeddings, name)
+
+    @property
+    def _model_name(self) -> str:
+        return getattr(self.embeddings, "model", None) or self.provider
+
+    def _call(self, texts: List[str], call):
+        tokens = sum(estimate_tokens(text) for text in texts)
+        reservation = llm_scheduler().acquire(
+            self.provider, self.api_key, tokens, self.priority,
+            requests=max(1, math.ceil(len(texts) / self.batch_size))
+        )
+        try:
+            result = call()
+        except Exception as e:
+            if provider_status(e) == 429:
+                reservation.rate_limited(e)
+            raise
+        record_embedding_usage(self._model_name, tokens)
+        return result
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        texts = list(texts)
+        return self._call(texts, lambda: self.embeddings.embed_documents(texts))
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._call([text], lambda: self.embeddings.embed_query(text))
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        texts = list(texts)
+        tokens = sum(estimate_tokens(text) for text in texts)
+        reservation = await llm_scheduler().aacquire(
+            self.provider, self.api_key, tokens, self.priority,
+            requests=max(1, math.ceil(len(texts) / self.batch_size))
+        )
+        try:
+            result = await self.embeddings.aembed_documents(texts)
+        except Exception as e:
+            if provider_status(e) == 429:
+                reservation.rate_limited(e)
+            raise
+        record_embedding_usage(self._model_name, tokens)
+        return result
+
+    async def aembed_query(self, text: str) -> List[float]:
+        tokens = estimate_tokens(text)
+        reservation = await llm_scheduler().aacquire(self.provider, self.api_key, tokens, self.priority)
+        try:
+            result = await self.embeddings.aembed_query(text)
+        except Exception as e:
+            if provider_status(e) == 429:
+                reservation.rate_limited(e)
+            raise
+        record_embedding_usage(self._model_name, tokens)
+        return result
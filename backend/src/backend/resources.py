@@ -0,0 +1,112 @@
+import logging
+import os
+import time
+
+from src.backend.database.mongo_utils import get_mongo_db_connection
+from src.backend.llm_factory import get_chat_model, reset_chat_models
+from src.backend.embedding_factory import create_embeddings, reset_embeddings
+from models.indexes import start_index_provisioning
+from src.services.admission_service import check_admission_settings
+from src.services.background_worker import start_background_worker
+from src.services.config_deletion_service import run_config_reaper
+from src.services.reembed_service import run_reembed_worker
+from src.services.usage_service import UsageSettings, flush_usage
+from src.utils.cache import configure_cache
+from src.utils.logging_setup import start_log_listener
+
+logger = logging.getLogger(__name__)
+
+# --- Per-process resources ---
+# The Mongo client, the embedding client and the chat model clients hold sockets and background
+# threads that do not survive fork(). Under gunicorn with preload_app they are therefore created in
+# each worker by the post_fork hook (gunicorn.conf.py) instead of in the preloading master.
+
+def env_flag(name: str, default: str = 'true') -> bool:
+    return os.getenv(name, default).lower() in ['true', '1', 't']
+
+def init_resources(app):
+    """Creates the log writer, Mongo client, embedding client, chat model cache and shared cache client for the current process."""
+    start_log_listener()
+    check_admission_settings()
+    configure_cache()
+    client, db, mongo_collection = get_mongo_db_connection(
+        mongo_uri=app.config["MONGO_URI"],
+        db_name=app.config["MONGO_DB_NAME"],
+        collection_name=app.config["USER"]
+    )
+    app.config['MONGO_CLIENT'] = client
+    app.config['MONGO_COLLECTION'] = mongo_collection
+    app.config['MONGO_DB'] = db
+    # The deployment's embedding model (EMBEDDING_MODEL, see src/backend/embedding_factory.py)
+    app.config['EMBEDDINGS'] = create_embeddings(app.config['EMBEDDING_MODEL'], app.config)
+    reset_embeddings()
+    reset_chat_models()
+
+def start_background_tasks(app):
+    """Starts the index provisioning and the background workers of the current process."""
+    # Make sure the indexes behind the hot queries exist (idempotent, built off the startup path)
+    if env_flag('ENSURE_INDEXES'):
+        start_index_provisioning(app.config['MONGO_DB'], app.config)
+
+    # Background reaper that removes the data of soft-deleted configs in bounded batches
+    if env_flag('CONFIG_REAPER_ENABLED'):
+        start_background_worker(app, "config-reaper", float(os.getenv('CONFIG_REAPER_INTERVAL', 30)), run_config_reaper)
+
+    # Background re-embedding of configs moved to another embedding model
+    if env_flag('REEMBED_WORKER_ENABLED'):
+        start_background_worker(app, "reembed", float(os.getenv('REEMBED_INTERVAL', 30)), run_reembed_worker)
+
+    # Periodic flush of the worker's usage rollups (src/services/usage_service.py)
+    usage_settings = UsageSettings()
+    if usage_settings.enabled:
+        start_background_worker(app, "usage-rollups", usage_settings.flush_interval, flush_usage)
+
+def flush_remaining_usage(app):
+    """Writes the usage rollups the worker has not flushed yet; called when the worker exits."""
+    try:
+        with app.app_context():
+            flush_usage()
+    except Exception as e:
+        logger.error(f"Final flush of the usage rollups failed: {e}")
+
+def warm_up(app):
+    """
+    Primes the worker before it accepts traffic: opens the Mongo connection pool, loads a local
+    embedding model, loads the most recently used configs and creates their chat model clients. WARMUP_MODELS adds
+    "model_name:temperature" pairs to create regardless of recent use.
+    """
+    started = time.perf_counter()
+    db = app.config['MONGO_DB']
+    try:
+        db.client.admin.command('ping')
+    except Exception as e:
+        logger.warning(f"Warm-up ping failed: {e}")
+
+    # Local models take seconds to load; do it here rather than in the first request
+    load_embedding_model = getattr(app.config['EMBEDDINGS'], "load", None)
+    if load_embedding_model:
+        try:
+            load_embedding_model()
+        except Exception as e:
+            logger.warning(f"Warm-up of the embedding model failed: {e}")
+
+    models = set()
+    try:
+        recent = db[app.config["CONFIG"]].find(
+            {"deleted_at": {"$exists": False}}, {"model_name": 1, "temperature": 1}
+        ).sort("_id", -1).limit(int(os.getenv('WARMUP_CONFIG_COUNT', 20)))
+        models.update((c.get("model_name"), c.get("temperature")) for c in recent if c.get("model_name"))
+    except Exception as e:
+        logger.warning(f"Warm-up config load failed: {e}")
+    for entry in filter(None, os.getenv('WARMUP_MODELS', '').split(',')):
+        name, _, temperature = entry.partition(':')
+        models.add((name.strip(), float(temperature) if temperature else 0.7))
+
+    with app.app_context():
+        for model_name, temperature in models:
+            try:
+                get_chat_model(model_name, temperature, app.config)
+            except Exception as e:
+                logger.warning(f"Warm-up of chat model {model_name} failed: {e}")
+
+    logger.info(f"Worker warm-up finished in {time.perf_counter() - started:.2f}s ({len(models)} chat models)")
@@ -0,0 +1,382 @@
+import asyncio
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+
+import click
+from bson import ObjectId
+from flask.cli import with_appcontext
+
+from models.config import Config
+from src.utils.metrics import ADMISSION_ACTIVE, ADMISSION_QUEUED, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# --- Admission control ---
+# A chat turn holds a web thread (or, on the async endpoint, a provider connection) for as long as
+# the LLM takes, so without a limit one busy public config can take every slot of a worker and the
+# users of other configs wait behind it. Every chat turn therefore takes a slot from the worker's
+# controller before retrieval and the LLM call:
+#
+# - at most ADMISSION_MAX_ACTIVE turns run at once per worker, at most max_active per config and
+#   at most ADMISSION_OWNER_MAX_ACTIVE across the configs of one owner;
+# - the others wait in a bounded queue per config, and freed slots go round-robin across the
+#   configs with waiters, so a config with a long queue cannot starve one with a single request;
+# - a request that finds its config's queue (or the worker's queue) full, or waits longer than
+#   queue_timeout, gets a 429 with a Retry-After estimated from recent turn durations.
+#
+# A config document can override its limits with an `admission` subdocument:
+#   {"max_active": 2, "max_queued": 10, "queue_timeout": 5}
+# (set by operators with `flask admission-limits`, not through the config API).
+#
+# Under the gthread worker a queued request still occupies a web thread. The defaults are therefore
+# derived from GUNICORN_THREADS: ADMISSION_RESERVED_THREADS threads are left to the other routes
+# (/health, history, config lists), the worker's turns (active + queued) share the rest, and one
+# config gets half of that. Limits that would let chat turns take every thread are reported at
+# worker start (see DEPLOYMENT.md).
+#
+# Under any other worker class (the async endpoint on uvicorn, asgi.py) a waiting turn holds no
+# thread, so there is no default limit: only the ADMISSION_* limits that are set apply.
+
+class AdmissionRejected(Exception):
+    """Raised when a request is not admitted; `retry_after` is the suggested wait in seconds."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(f"Too many requests ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+
+def env_limit(name: str, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+class AdmissionSettings:
+    def __init__(self):
+        self.enabled = os.getenv("ADMISSION_ENABLED", "true").lower() in ['true', '1', 't']
+        self.queue_timeout = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", 15))
+        self.gthread = os.getenv("GUNICORN_WORKER_CLASS", "gthread") == "gthread"
+        self.threads = int(os.getenv("GUNICORN_THREADS", 8))
+        if not self.gthread:
+            self.reserved_threads = 0
+            self.max_active = env_limit("ADMISSION_MAX_ACTIVE", math.inf)
+            self.max_queued = env_limit("ADMISSION_MAX_QUEUED", math.inf)
+            self.config_max_active = env_limit("ADMISSION_CONFIG_MAX_ACTIVE", math.inf)
+            self.config_max_queued = env_limit("ADMISSION_CONFIG_MAX_QUEUED", math.inf)
+            self.owner_max_active = env_limit("ADMISSION_OWNER_MAX_ACTIVE", math.inf)
+            return
+        self.reserved_threads = env_limit("ADMISSION_RESERVED_THREADS", max(2, self.threads // 4))
+        # Threads chat turns may hold, running or queued; with 8 threads: 4 active + 2 queued per worker,
+        # 2 active + 1 queued per config
+        turn_threads = max(1, self.threads - self.reserved_threads)
+        default_active = max(1, turn_threads * 2 // 3)
+        self.max_active = env_limit("ADMISSION_MAX_ACTIVE", default_active)
+        self.max_queued = env_limit("ADMISSION_MAX_QUEUED", turn_threads - default_active)
+        self.config_max_active = env_limit("ADMISSION_CONFIG_MAX_ACTIVE", max(1, self.max_active // 2))
+        self.config_max_queued = env_limit("ADMISSION_CONFIG_MAX_QUEUED", self.max_queued // 2)
+        self.owner_max_active = env_limit("ADMISSION_OWNER_MAX_ACTIVE", max(self.config_max_active, self.max_active * 3 // 4))
+
+    def thread_problems(self) -> list:
+        """The limits that let chat turns hold every thread of a gthread worker."""
+        problems = []
+        if self.max_active + self.max_queued >= self.threads:
+            problems.append(f"ADMISSION_MAX_ACTIVE + ADMISSION_MAX_QUEUED ({self.max_active + self.max_queued}) "
+                            f"must be below GUNICORN_THREADS ({self.threads})")
+        if self.config_max_active + self.config_max_queued >= self.threads:
+            problems.append(f"ADMISSION_CONFIG_MAX_ACTIVE + ADMISSION_CONFIG_MAX_QUEUED ({self.config_max_active + self.config_max_queued}) "
+                            f"must be below GUNICORN_THREADS ({self.threads})")
+        return problems
+
+def check_admission_settings():
+    """
+    Logs the admission limits that leave no thread of a gthread worker to the other routes. With
+    ADMISSION_STRICT the worker refuses to start instead.
+    """
+    settings = AdmissionSettings()
+    if not settings.enabled or not settings.gthread:
+        return
+    problems = settings.thread_problems()
+    if problems and os.getenv("ADMISSION_STRICT", "false").lower() in ['true', '1', 't']:
+        raise ValueError("Admission limits leave no threads for other requests: " + "; ".join(problems))
+    for problem in problems:
+        logger.warning(f"Admission limits leave no threads for other requests: {problem}")
+
+def admission_limits(config_document: dict, settings: AdmissionSettings) -> dict:
+    """The limits of a config: the worker defaults, overridden by the config's `admission` subdocument."""
+    overrides = config_document.get("admission") or {}
+    return {
+        "max_active": int(overrides["max_active"]) if "max_active" in overrides else settings.config_max_active,
+        "max_queued": int(overrides["max_queued"]) if "max_queued" in overrides else settings.config_max_queued,
+        "queue_timeout": float(overrides.get("queue_timeout", settings.queue_timeout)),
+    }
+
+class Waiter:
+    """A queued request; `wake` is called (under the controller lock) once it holds a slot."""
+
+    def __init__(self, config_id: str, owner_id: str, limits: dict, wake):
+        self.config_id = config_id
+        self.owner_id = owner_id
+        self.limits = limits
+        self.wake = wake
+        self.admitted = False
+
+class Slot:
+    """An admitted request's slot. Release it once the turn is done; releasing twice is harmless."""
+
+    def __init__(self, controller, config_id: str, owner_id: str):
+        self.controller = controller
+        self.config_id = config_id
+        self.owner_id = owner_id
+        self.started = time.monotonic()
+        self.released = False
+
+    def release(self):
+        self.controller.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+class AdmissionController:
+    """Per-worker admission state. Thread-safe; the async methods may be used from any event loop."""
+
+    def __init__(self, settings: AdmissionSettings = None):
+        self.settings = settings or AdmissionSettings()
+        self._lock = threading.Lock()
+        self._active = 0
+        self._active_by_config = {}
+        self._active_by_owner = {}
+        self._queues = {}          # config_id -> deque of Waiters
+        self._ring = deque()       # config_ids with waiters, in round-robin order
+        self._queued = 0
+        self._average_turn = 5.0   # seconds, exponentially weighted over released slots
+
+    # --- Bookkeeping (under self._lock) ---
+
+    def _can_run(self, config_id: str, owner_id: str, limits: dict) -> bool:
+        return (
+            self._active < self.settings.max_active
+            and self._active_by_config.get(config_id, 0) < limits["max_active"]
+            and self._active_by_owner.get(owner_id, 0) < self.settings.owner_max_active
+        )
+
+    def _take(self, config_id: str, owner_id: str) -> Slot:
+        self._active += 1
+        self._active_by_config[config_id] = self._active_by_config.get(config_id, 0) + 1
+        self._active_by_owner[owner_id] = self._active_by_owner.get(owner_id, 0) + 1
+        ADMISSION_ACTIVE.inc()
+        return Slot(self, config_id, owner_id)
+
+    def _enqueue(self, waiter: Waiter):
+        queue = self._queues.get(waiter.config_id)
+        if queue is None:
+            queue = self._queues[waiter.config_id] = deque()
+            self._ring.append(waiter.config_id)
+        queue.append(waiter)
+        self._queued += 1
+        ADMISSION_QUEUED.inc()
+
+    def _dequeue(self, waiter: Waiter):
+        queue = self._queues[waiter.config_id]
+        queue.remove(waiter)
+        if not queue:
+            del self._queues[waiter.config_id]
+            self._ring.remove(waiter.config_id)
+        self._queued -= 1
+        ADMISSION_QUEUED.dec()
+
+    def _dispatch(self):
+        """Hands free slots to the head waiters of the queued configs, round-robin."""
+        admitted = True
+        while admitted and self._ring and self._active < self.settings.max_active:
+            admitted = False
+            for _ in range(len(self._ring)):
+                if not self._ring:
+                    break
+                config_id = self._ring[0]
+                self._ring.rotate(-1)
+                waiter = self._queues[config_id][0]
+                if self._can_run(config_id, waiter.owner_id, waiter.limits):
+                    self._dequeue(waiter)
+                    waiter.admitted = True
+                    waiter.wake(self._take(config_id, waiter.owner_id))
+                    admitted = True
+                    if self._active >= self.settings.max_active:
+                        break
+
+    def _retry_after(self, config_id: str, limits: dict) -> int:
+        waiting = len(self._queues.get(config_id, ())) + 1
+        return max(1, min(60, math.ceil(self._average_turn * waiting / max(limits["max_active"], 1))))
+
+    def _admit_or_enqueue(self, config_id: str, owner_id: str, limits: dict, wake):
+        """Returns a Slot, or the queued Waiter; raises AdmissionRejected if the queue is full."""
+        with self._lock:
+            if config_id not in self._queues and self._can_run(config_id, owner_id, limits):
+                return self._take(config_id, owner_id)
+            if len(self._queues.get(config_id, ())) >= limits["max_queued"] or self._queued >= self.settings.max_queued:
+                ADMISSION_REJECTED.inc(config_id=config_id, reason="queue_full")
+                ADMISSION_WAIT_SECONDS.observe(0, outcome="rejected")
+                raise AdmissionRejected("queue_full", self._retry_after(config_id, limits))
+            waiter = Waiter(config_id, owner_id, limits, wake)
+            self._enqueue(waiter)
+            return waiter
+
+    def _give_up(self, waiter: Waiter) -> bool:
+        """Removes a waiter that timed out or was cancelled. Returns False if it was admitted meanwhile."""
+        with self._lock:
+            if waiter.admitted:
+                return False
+            self._dequeue(waiter)
+            return True
+
+    def _timed_out(self, waiter: Waiter, waited: float):
+        ADMISSION_REJECTED.inc(config_id=waiter.config_id, reason="timeout")
+        ADMISSION_WAIT_SECONDS.observe(waited, outcome="timeout")
+        with self._lock:
+            retry_after = self._retry_after(waiter.config_id, waiter.limits)
+        return AdmissionRejected("timeout", retry_after)
+
+    # --- API ---
+
+    def acquire(self, config_document: dict) -> Slot:
+        """Waits for a slot for a chat turn of `config_document`; raises AdmissionRejected."""
+        config_id = str(config_document["_id"])
+        owner_id = str(config_document.get("user_id"))
+        limits = admission_limits(config_document, self.settings)
+        started = time.monotonic()
+        admitted = threading.Event()
+        slots = []
+
+        def wake(slot):
+            slots.append(slot)
+            admitted.set()
+
+        result = self._admit_or_enqueue(config_id, owner_id, limits, wake)
+        if isinstance(result, Slot):
+            ADMISSION_WAIT_SECONDS.observe(0, outcome="admitted")
+            return result
+        if not admitted.wait(limits["queue_timeout"]) and self._give_up(result):
+            raise self._timed_out(result, time.monotonic() - started)
+        admitted.wait()
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started, outcome="admitted")
+        return slots[0]
+
+    async def aacquire(self, config_document: dict) -> Slot:
+        """acquire() for the async endpoint: waits without blocking the event loop."""
+        config_id = str(config_document["_id"])
+        owner_id = str(config_document.get("user_id"))
+        limits = admission_limits(config_document, self.settings)
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def wake(slot):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(slot))
+
+        result = self._admit_or_enqueue(config_id, owner_id, limits, wake)
+        if isinstance(result, Slot):
+            ADMISSION_WAIT_SECONDS.observe(0, outcome="admitted")
+            return result
+        try:
+            slot = await asyncio.wait_for(asyncio.shield(future), limits["queue_timeout"])
+        except asyncio.TimeoutError:
+            if self._give_up(result):
+                raise self._timed_out(result, time.monotonic() - started)
+            slot = await future
+        except asyncio.CancelledError:
+            # The client went away while queued: leave the queue, or hand back a slot granted meanwhile
+            if not self._give_up(result):
+                (await future).release()
+            raise
+        ADMISSION_WAIT_SECONDS.observe(time.monotonic() - started, outcome="admitted")
+        return slot
+
+    def release(self, slot: Slot):
+        with self._lock:
+            if slot.released:
+                return
+            slot.released = True
+            self._active -= 1
+            for counts, key in ((self._active_by_config, slot.config_id), (self._active_by_owner, slot.owner_id)):
+                counts[key] -= 1
+                if not counts[key]:
+                    del counts[key]
+            self._average_turn = 0.9 * self._average_turn + 0.1 * (time.monotonic() - slot.started)
+            ADMISSION_ACTIVE.dec()
+            self._dispatch()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "active": self._active,
+                "queued": self._queued,
+                "active_by_config": dict(self._active_by_config),
+                "queued_by_config": {config_id: len(queue) for config_id, queue in self._queues.items()},
+            }
+
+class NoAdmission:
+    """Stand-in controller with ADMISSION_ENABLED=false."""
+
+    class _Slot:
+        def release(self):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            pass
+
+    def acquire(self, config_document: dict):
+        return self._Slot()
+
+    async def aacquire(self, config_document: dict):
+        return self._Slot()
+
+_controller = None
+_controller_lock = threading.Lock()
+
+def admission_controller():
+    """The worker's admission controller (created on first use, so after fork)."""
+    global _controller
+    if _controller is None:
+        with _controller_lock:
+            if _controller is None:
+                settings = AdmissionSettings()
+                _controller = AdmissionController(settings) if settings.enabled else NoAdmission()
+    return _controller
+
+def rejection_body(rejected: AdmissionRejected) -> dict:
+    return {"message": "This chatbot is busy, please retry shortly.", "retry_after": rejected.retry_after}
+
+@click.command("admission-limits")
+@click.option("--config-id", required=True, help="Config to tune.")
+@click.option("--max-active", type=click.IntRange(min=1), default=None, help="Concurrent chat turns of the config per worker.")
+@click.option("--max-queued", type=click.IntRange(min=0), default=None, help="Chat turns of the config that may wait per worker.")
+@click.option("--queue-timeout", type=click.FloatRange(min=0), default=None, help="Seconds a chat turn may wait before a 429.")
+@click.option("--reset", is_flag=True, help="Go back to the worker defaults.")
+@with_appcontext
+def admission_limits_command(config_id, max_active, max_queued, queue_timeout, reset):
+    """Show or set the admission limits of a config."""
+    values = {"max_active": max_active, "max_queued": max_queued, "queue_timeout": queue_timeout}
+    update = {f"admission.{field}": value for field, value in values.items() if value is not None}
+    collection = Config.get_collection()
+    query = {"_id": ObjectId(config_id), **Config.ACTIVE}
+    if reset:
+        result = collection.update_one(query, {"$unset": {"admission": ""}})
+    elif update:
+        result = collection.update_one(query, {"$set": update})
+    else:
+        result = None
+    if result is not None:
+        if not result.matched_count:
+            raise click.UsageError(f"Config {config_id} not found")
+        Config.invalidate(config_id)
+    config_document = Config.find_by_id(config_id)
+    if not config_document:
+        raise click.UsageError(f"Config {config_id} not found")
+    click.echo(f"Admission limits of config {config_id}: {admission_limits(config_document, AdmissionSettings())}")
@@ -0,0 +1,26 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+def start_background_worker(app, name: str, interval_seconds: float, task):
+    """
+    Runs `task()` inside an app context every `interval_seconds` on a daemon thread.
+    Exceptions are logged and the loop keeps going, so a transient database error
+    does not stop the worker. Returns the thread and the event that stops it.
+    """
+    stop_event = threading.Event()
+
+    def run():
+        logger.info(f"Background worker '{name}' started (interval {interval_seconds}s)")
+        while not stop_event.is_set():
+            try:
+                with app.app_context():
+                    task()
+            except Exception as e:
+                logger.error(f"Background worker '{name}' failed: {e}", exc_info=True)
+            stop_event.wait(interval_seconds)
+
+    thread = threading.Thread(target=run, name=name, daemon=True)
+    thread.start()
+    return thread, stop_event
@@ -0,0 +1,256 @@
+import json
+import logging
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.output_parsers import StrOutputParser
+
+from models.chat_session import ChatSession
+from models.config import Config
+from models.message_store import MessageStore
+from models.vector_stores import VectorChunks
+from src.backend.llm_factory import get_chat_model
+from src.backend.embedding_factory import get_embeddings, vector_search_target
+from src.backend.llm_scheduler import BATCH
+from src.services.chat_service import (
+    EMBEDDING_KEY, RETRIEVAL_K, VECTOR_INDEX_NAME, build_chat_prompt, documents_from_search, format_docs, message_document, source_list, vector_search_pipeline
+)
+
+logger = logging.getLogger(__name__)
+
+# --- Batch evaluation ---
+# Runs many questions against a config without the per-turn chat round trip: all questions
+# are embedded in one call, their vector searches run concurrently, and the answers come from
+# the model's batch() with bounded concurrency. Every question is answered on its own (no
+# chat history), and nothing is written to message_store unless a session is requested.
+# Questions are processed in slices of BATCH_SLICE_SIZE so results stream out as they finish.
+
+MAX_BATCH_INPUTS = int(os.getenv("BATCH_MAX_INPUTS", 1000))
+MAX_BATCH_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 16))
+DEFAULT_BATCH_CONCURRENCY = 4
+BATCH_SLICE_SIZE = 50
+
+class BatchRequestError(ValueError):
+    """Raised for an invalid batch request; the message is safe to return to the client."""
+
+def parse_batch_request(data: dict) -> dict:
+    """Validates a batch request body and returns the normalized options."""
+    if not isinstance(data, dict):
+        raise BatchRequestError("Request body must be a JSON object")
+    inputs = data.get("inputs")
+    if not isinstance(inputs, list) or not inputs or not all(isinstance(item, str) and item.strip() for item in inputs):
+        raise BatchRequestError("'inputs' must be a non-empty list of questions")
+    if len(inputs) > MAX_BATCH_INPUTS:
+        raise BatchRequestError(f"At most {MAX_BATCH_INPUTS} inputs per batch")
+    try:
+        k = int(data.get("k", RETRIEVAL_K))
+        concurrency = int(data.get("concurrency", DEFAULT_BATCH_CONCURRENCY))
+    except (TypeError, ValueError):
+        raise BatchRequestError("'k' and 'concurrency' must be integers")
+    if not 1 <= k <= 20:
+        raise BatchRequestError("'k' must be between 1 and 20")
+    session_id = None
+    if data.get("save_history"):
+        session_id = data.get("session_id") or f"batch-{uuid.uuid4().hex}"
+    return {
+        "inputs": inputs,
+        "k": k,
+        "concurrency": min(max(concurrency, 1), MAX_BATCH_CONCURRENCY),
+        "session_id": session_id,
+    }
+
+def search_many(vector_collection, query_vectors: List[List[float]], config_id: str, k: int, concurrency: int,
+                index_name: str = VECTOR_INDEX_NAME, path: str = EMBEDDING_KEY) -> list:
+    """Runs one vector search per query vector, `concurrency` at a time. Returns the documents per query, in order."""
+    def search(query_vector):
+        return documents_from_search(list(vector_collection.aggregate(vector_search_pipeline(query_vector, config_id, k, index_name, path))))
+
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch-search") as pool:
+        return list(pool.map(search, query_vectors))
+
+def save_batch_turns(session_id: str, user_id: str, config_id: str, results: list):
+    """Writes the answered questions of a slice to the batch session with one insert_many."""
+    messages = []
+    for result in results:
+        if "response" in result:
+            messages.append(HumanMessage(content=result["input"]))
+            messages.append(AIMessage(content=result["response"]))
+    if not messages:
+        return
+    ChatSession.ensure(session_id, user_id, config_id)
+    MessageStore.get_collection().insert_many(
+        [message_document(session_id, user_id, config_id, message) for message in messages], ordered=True
+    )
+    ChatSession.record_message(session_id, messages[0].content, count=len(messages))
+
+def error_message(error: Exception) -> str:
+    return str(error) or error.__class__.__name__
+
+def slice_errors(questions: List[str], offset: int, stage: str, error: Exception) -> Iterator[dict]:
+    """The error records of a slice of questions that failed together in `stage`."""
+    for index, question in enumerate(questions, offset):
+        yield {"type": "error", "index": index, "input": question, "stage": stage, "error": error_message(error)}
+
+def run_batch(config_document: dict, llm, vector_collection, embeddings, inputs: List[str], k: int = RETRIEVAL_K,
+              concurrency: int = DEFAULT_BATCH_CONCURRENCY, session_id: str = None, user_id: str = None,
+              index_name: str = VECTOR_INDEX_NAME, path: str = EMBEDDING_KEY) -> Iterator[dict]:
+    """
+    Answers `inputs` against a config and yields one record per question, in input order,
+    followed by a summary record. A question whose answer failed yields a result with an `error`
+    instead of a `response`. When the embedding or a slice's vector search fails, each question
+    it covers yields an `error` record with the stage. The rest of the batch carries on, and the
+    summary is always yielded.
+    """
+    config_id = str(config_document["_id"])
+    prompt = build_chat_prompt(config_document)
+    chain = llm | StrOutputParser()
+    started = time.perf_counter()
+    answered = failed = 0
+    history_error = None
+
+    stage_seconds = {"embedding": 0.0, "vector_search": 0.0, "llm": 0.0}
+    step = time.perf_counter()
+    try:
+        query_vectors = embeddings.embed_documents(inputs)
+        embedding_error = None
+    except Exception as e:
+        logger.error(f"Batch embedding for config {config_id} failed: {e}", exc_info=True)
+        query_vectors, embedding_error = None, e
+    stage_seconds["embedding"] += time.perf_counter() - step
+
+    for offset in range(0, len(inputs), BATCH_SLICE_SIZE):
+        questions = inputs[offset:offset + BATCH_SLICE_SIZE]
+        if embedding_error is not None:
+            failed += len(questions)
+            yield from slice_errors(questions, offset, "embedding", embedding_error)
+            continue
+
+        step = time.perf_counter()
+        try:
+            docs_per_question = search_many(vector_collection, query_vectors[offset:offset + BATCH_SLICE_SIZE], config_id, k, concurrency, index_name, path)
+        except Exception as e:
+            logger.error(f"Batch vector search for config {config_id} failed at input {offset}: {e}", exc_info=True)
+            failed += len(questions)
+            yield from slice_errors(questions, offset, "vector_search", e)
+            continue
+        finally:
+            stage_seconds["vector_search"] += time.perf_counter() - step
+
+        step = time.perf_counter()
+        prompts = [
+            prompt.format_messages(context=format_docs(docs), history=[], question=question)
+            for question, docs in zip(questions, docs_per_question)
+        ]
+        answers = chain.batch(prompts, config={"max_concurrency": concurrency}, return_exceptions=True)
+        stage_seconds["llm"] += time.perf_counter() - step
+
+        results = []
+        for index, (question, docs, answer) in enumerate(zip(questions, docs_per_question, answers), offset):
+            result = {"type": "result", "index": index, "input": question}
+            if isinstance(answer, Exception):
+                logger.warning(f"Batch question {index} for config {config_id} failed: {answer}")
+                result["error"] = error_message(answer)
+                failed += 1
+            else:
+                result["response"] = answer
+                answered += 1
+            result["sources"] = source_list(docs)
+            results.append(result)
+
+        if session_id:
+            try:
+                save_batch_turns(session_id, user_id, config_id, results)
+            except Exception as e:
+                logger.error(f"Saving batch answers for config {config_id} to session {session_id} failed: {e}", exc_info=True)
+                history_error = error_message(e)
+        yield from results
+
+    yield {
+        "type": "summary",
+        "config_id": config_id,
+        "total": len(inputs),
+        "answered": answered,
+        "failed": failed,
+        "session_id": session_id,
+        "history_error": history_error,
+        "seconds": round(time.perf_counter() - started, 3),
+        "stage_seconds": {stage: round(seconds, 3) for stage, seconds in stage_seconds.items()},
+    }
+
+def batch_for_config(config_document: dict, options: dict, user_id: str) -> Iterator[dict]:
+    """
+    run_batch() with the app's shared clients; raises BatchRequestError for an unsupported model,
+    or for a session_id that is already a session of another user or config.
+    """
+    session_id = options["session_id"]
+    if session_id and ChatSession.taken_by_other(session_id, user_id, str(config_document["_id"])):
+        raise BatchRequestError("session_id belongs to another user or configuration")
+    llm = get_chat_model(config_document.get("model_name"), config_document.get("temperature"), current_app.config, priority=BATCH)
+    if not llm:
+        raise BatchRequestError(f"Unsupported model: {config_document.get('model_name')}")
+    embedding_model, vector_field, vector_index = vector_search_target(config_document)
+    return run_batch(
+        config_document,
+        llm,
+        current_app.config['MONGO_DB'][VectorChunks.COLLECTION_NAME],
+        get_embeddings(embedding_model, current_app.config, priority=BATCH),
+        options["inputs"],
+        k=options["k"],
+        concurrency=options["concurrency"],
+        session_id=session_id,
+        user_id=user_id,
+        index_name=vector_index,
+        path=vector_field,
+    )
+
+def ndjson_records(records: Iterator[dict]) -> Iterator[bytes]:
+    for record in records:
+        yield (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+def read_batch_inputs(path: str) -> List[str]:
+    """Reads questions from a JSON list, a JSONL file of {"input": ...} objects, or plain text (one per line)."""
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+    if path.endswith(".json"):
+        return json.loads(content)
+    if path.endswith(".jsonl"):
+        return [json.loads(line)["input"] for line in content.splitlines() if line.strip()]
+    return [line.strip() for line in content.splitlines() if line.strip()]
+
+@click.command("batch-eval")
+@click.option("--config-id", required=True, help="Config to evaluate.")
+@click.option("--input", "input_path", required=True, type=click.Path(exists=True, dir_okay=False), help="Questions: .json list, .jsonl with an 'input' field, or one per line.")
+@click.option("--output", required=True, type=click.Path(dir_okay=False), help="NDJSON file to write the results to.")
+@click.option("--k", default=RETRIEVAL_K, show_default=True, help="Chunks retrieved per question.")
+@click.option("--concurrency", default=DEFAULT_BATCH_CONCURRENCY, show_default=True, help="Concurrent searches and model calls.")
+@click.option("--save-history", is_flag=True, help="Also store the answers in a chat session of the config owner.")
+@click.option("--session-id", default=None, help="Session to store the answers in (with --save-history).")
+@with_appcontext
+def batch_eval_command(config_id, input_path, output, k, concurrency, save_history, session_id):
+    """Answer a file of questions against a config and write the answers and sources as NDJSON."""
+    config_document = Config.find_by_id(config_id)
+    if not config_document:
+        raise click.UsageError(f"Config {config_id} not found")
+    try:
+        options = parse_batch_request({
+            "inputs": read_batch_inputs(input_path),
+            "k": k,
+            "concurrency": concurrency,
+            "save_history": save_history,
+            "session_id": session_id,
+        })
+        records = batch_for_config(config_document, options, str(config_document.get("user_id")))
+        with open(output, "wb") as f:
+            for chunk in ndjson_records(records):
+                f.write(chunk)
+    except BatchRequestError as e:
+        raise click.UsageError(str(e))
+
+    summary = json.loads(chunk)
+    click.echo(f"Answered {summary['answered']}/{summary['total']} questions in {summary['seconds']}s ({summary['failed']} failed) -> {output}")
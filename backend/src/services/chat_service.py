@@ -0,0 +1,253 @@
+import logging
+import re
+import time
+from datetime import datetime, timezone
+from typing import List
+from langchain_core.documents import Document
+from langchain_core.messages import BaseMessage
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+from src.backend.database.mongo_utils import message_to_document
+from src.backend.embedding_factory import EMBEDDING_FIELDS
+from src.utils.cache import SETTINGS as CACHE_SETTINGS, BsonCodec, VectorCodec, content_key, query_hash, two_level_cache
+from src.utils.deadline import RequestAbandoned, deadline_stage, mongo_time_limit, within_deadline
+
+logger = logging.getLogger(__name__)
+
+# Shared pieces of the chat pipeline, used by the WSGI endpoint (routes/chat_routes.py)
+# and the async endpoint (routes/async_chat_routes.py).
+
+RETRIEVAL_K = 3
+VECTOR_INDEX_NAME = "vector"
+# Field names MongoDBAtlasVectorSearch writes the chunks with (src/utils/vector_stores/store_vector_stores.py).
+# A config's vectors are in EMBEDDING_KEY or, after a re-embedding, in the other field of EMBEDDING_FIELDS.
+TEXT_KEY = "text"
+EMBEDDING_KEY = "embedding"
+VECTOR_FIELDS_PROJECTION = {field: 0 for field in EMBEDDING_FIELDS}
+
+# Query vectors by embedding model and normalized query, and retrievals by config content version,
+# vector field, k and query (src/utils/cache.py). An upload, a re-embedding switch or the deletion
+# of the config bumps its content version. A retrieval is cached as the ids of the chunks it found,
+# and each chunk once (CHUNK_CACHE), however many queries retrieve it.
+QUERY_EMBEDDING_CACHE = two_level_cache("query_embedding", VectorCodec, local_entries=20_000)
+RETRIEVAL_CACHE = two_level_cache("retrieval", BsonCodec, local_entries=50_000, local_max_bytes=CACHE_SETTINGS.retrieval_max_bytes)
+CHUNK_CACHE = two_level_cache("chunk", BsonCodec, local_entries=50_000, local_max_bytes=CACHE_SETTINGS.chunk_max_bytes)
+
+def build_chat_prompt(config_document: dict) -> ChatPromptTemplate:
+    """Builds the chat prompt from a config's prompt template."""
+    system_prompt_template = re.sub(r'Question:.*', '', config_document.get("prompt_template", "")).strip()
+    return ChatPromptTemplate.from_messages([
+        ("system", system_prompt_template + "\n\nContext:\n{context}"),
+        MessagesPlaceholder(variable_name="history"),
+        ("human", "{question}")
+    ])
+
+def format_docs(docs: List[Document]) -> str:
+    context = "\n\n".join(doc.page_content for doc in docs)
+    # Payload logging is DEBUG (sampled via LOG_SAMPLE_RATES); the check skips building the message otherwise
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"📝 Context being sent to LLM ({len(docs)} docs, {len(context)} chars): {context[:300]}...")
+    return context
+
+def source_list(docs: List[Document]) -> list:
+    """The `sources` part of a chat response."""
+    return [
+        {
+            "source": doc.metadata.get("source", ""),
+            "page_content": doc.page_content[:200] + "..."
+        } for doc in docs
+    ]
+
+def message_document(session_id: str, user_id: str, config_id: str, message: BaseMessage) -> dict:
+    """Builds the native BSON message_store document for a message."""
+    return {
+        "SessionId": session_id,
+        "user_id": user_id,
+        "config_id": config_id,
+        "History": message_to_document(message),
+        "created_at": datetime.now(timezone.utc),
+    }
+
+def vector_search_pipeline(query_vector: List[float], config_id: str, k: int = RETRIEVAL_K, index_name: str = VECTOR_INDEX_NAME, path: str = EMBEDDING_KEY) -> list:
+    """
+    The $vectorSearch aggregation MongoDBAtlasVectorSearch.similarity_search runs for a config,
+    for use with a driver directly (e.g. the async client). `index_name` and `path` are the index
+    and vector field of the config's embedding model (src/backend/embedding_factory.py).
+    """
+    return [
+        {"$vectorSearch": {
+            "index": index_name,
+            "path": path,
+            "queryVector": query_vector,
+            "numCandidates": k * 10,
+            "limit": k,
+            "filter": {"config_id": {"$eq": config_id}}
+        }},
+        {"$project": VECTOR_FIELDS_PROJECTION}
+    ]
+
+def documents_from_search(results: List[dict]) -> List[Document]:
+    """Turns $vectorSearch results into LangChain documents, the other fields becoming the metadata."""
+    docs = []
+    for result in results:
+        text = result.pop(TEXT_KEY, "")
+        result["_id"] = str(result["_id"])
+        docs.append(Document(page_content=text, metadata=result))
+    return docs
+
+def embed_query_cached(embeddings, embedding_model: str, query: str) -> List[float]:
+    return QUERY_EMBEDDING_CACHE.get_or_load(f"{embedding_model}:{query_hash(query)}", lambda: embeddings.embed_query(query), stage="embedding")
+
+async def aembed_query_cached(embeddings, embedding_model: str, query: str) -> List[float]:
+    return await QUERY_EMBEDDING_CACHE.aget_or_load(f"{embedding_model}:{query_hash(query)}", lambda: embeddings.aembed_query(query))
+
+def retrieval_cache_key(space: str, path: str, k: int, query: str) -> str:
+    """The key of a retrieval in `space`, the current key space of the config's chunks (content_key())."""
+    return f"{space}:{path}:{k}:{query_hash(query)}"
+
+def documents_to_cache(space: str, docs: List[Document]):
+    """
+    The cached form of retrieved chunks: their ids in order, and the chunks by chunk cache key.
+    (None, {}) (not cached) when nothing was found, which is also what a failed search returns.
+    """
+    if not docs or not all(doc.metadata.get("_id") for doc in docs):
+        return None, {}
+    refs = [doc.metadata["_id"] for doc in docs]
+    return refs, {f"{space}:{ref}": {"c": doc.page_content, "m": dict(doc.metadata)} for ref, doc in zip(refs, docs)}
+
+def documents_from_cache(space: str, refs: list, chunks: dict) -> List[Document]:
+    """The documents of a cached retrieval, or None if one of its chunks is no longer cached."""
+    entries = [chunks.get(f"{space}:{ref}") for ref in refs]
+    if None in entries:
+        return None
+    return [Document(page_content=entry["c"], metadata=dict(entry["m"])) for entry in entries]
+
+def cached_retrieval(config_id: str, path: str, k: int, query: str, load) -> List[Document]:
+    """The chunks `load()` retrieves for a query, served from the retrieval cache when possible."""
+    space = content_key(config_id)
+    if space is None:
+        return load()
+    key = retrieval_cache_key(space, path, k, query)
+    loaded = []
+
+    def load_refs():
+        docs = load()
+        loaded.append(docs)
+        refs, chunks = documents_to_cache(space, docs)
+        CHUNK_CACHE.set_many(chunks)
+        return refs
+
+    # A wait for another request's retrieval (embedding and search) may use all the time left
+    refs = RETRIEVAL_CACHE.get_or_load(key, load_refs, stage="retrieval")
+    if loaded:
+        return loaded[0]
+    if not refs:
+        return []  # the search this request waited for found nothing
+    docs = documents_from_cache(space, refs, CHUNK_CACHE.get_many([f"{space}:{ref}" for ref in refs]))
+    if docs is None:
+        # The chunks were evicted before the retrieval that refers to them
+        refs = load_refs()
+        if refs:
+            RETRIEVAL_CACHE.set_many({key: refs})
+        docs = loaded[0]
+    return docs
+
+async def acached_retrieval(config_id: str, path: str, k: int, query: str, load) -> List[Document]:
+    """Async cached_retrieval(); `load` is a coroutine function."""
+    space = content_key(config_id)
+    if space is None:
+        return await load()
+    key = retrieval_cache_key(space, path, k, query)
+    loaded = []
+
+    async def load_refs():
+        docs = await load()
+        loaded.append(docs)
+        refs, chunks = documents_to_cache(space, docs)
+        await CHUNK_CACHE.aset_many(chunks)
+        return refs
+
+    refs = await RETRIEVAL_CACHE.aget_or_load(key, load_refs)
+    if loaded:
+        return loaded[0]
+    if not refs:
+        return []  # the search this request waited for found nothing
+    docs = documents_from_cache(space, refs, await CHUNK_CACHE.aget_many([f"{space}:{ref}" for ref in refs]))
+    if docs is None:
+        refs = await load_refs()
+        if refs:
+            await RETRIEVAL_CACHE.aset_many({key: refs})
+        docs = loaded[0]
+    return docs
+
+def log_retrieval(docs: List[Document], config_id: str):
+    if not docs:
+        logger.warning(f"⚠️ No documents found in vector store for config_id: {config_id}")
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"🔍 Vector search found {len(docs)} documents for config_id: {config_id}")
+        logger.debug(f"📄 First document preview: {docs[0].page_content[:200]}...")
+        logger.debug(f"📋 Document metadata: {docs[0].metadata}")
+
+def retrieve(vector_collection, embeddings, query: str, config_id: str, timer, k: int = RETRIEVAL_K, index_name: str = VECTOR_INDEX_NAME, path: str = EMBEDDING_KEY,
+             embedding_model: str = None) -> List[Document]:
+    """
+    Embeds the query and runs the config's vector search, timing both stages on `timer`.
+    With `embedding_model`, the query vector comes from the query embedding cache.
+    Both stages run within the request's deadline (src/utils/deadline.py), if it has one.
+    """
+    try:
+        with timer.stage("embedding"), deadline_stage("embedding"):
+            query_vector = embed_query_cached(embeddings, embedding_model, query) if embedding_model else embeddings.embed_query(query)
+        with timer.stage("vector_search"), deadline_stage("vector_search"):
+            pipeline = vector_search_pipeline(query_vector, config_id, k, index_name, path)
+            results = list(vector_collection.aggregate(pipeline, **mongo_time_limit("vector_search")))
+        docs = documents_from_search(results)
+        log_retrieval(docs, config_id)
+        return docs
+    except RequestAbandoned:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Vector retrieval failed: {e}")
+        return []
+
+async def aretrieve(vector_collection, embeddings, query: str, config_id: str, timer, k: int = RETRIEVAL_K, index_name: str = VECTOR_INDEX_NAME, path: str = EMBEDDING_KEY,
+                    embedding_model: str = None) -> List[Document]:
+    """Async variant of retrieve() that does not block the event loop; a stage past its deadline is cancelled."""
+    try:
+        embedding = aembed_query_cached(embeddings, embedding_model, query) if embedding_model else embeddings.aembed_query(query)
+        query_vector = await timer.measure("embedding", within_deadline("embedding", embedding))
+        async def search():
+            pipeline = vector_search_pipeline(query_vector, config_id, k, index_name, path)
+            cursor = await vector_collection.aggregate(pipeline, **mongo_time_limit("vector_search"))
+            return await cursor.to_list()
+        results = await timer.measure("vector_search", within_deadline("vector_search", search()))
+        docs = documents_from_search(results)
+        log_retrieval(docs, config_id)
+        return docs
+    except RequestAbandoned:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Vector retrieval failed: {e}")
+        return []
+
+def stream_answer(chain, messages, timer):
+    """Yields the answer chunks of `chain`, recording the time to first token and the total LLM time."""
+    started = time.perf_counter()
+    first = True
+    for chunk in chain.stream(messages):
+        if first:
+            timer.observe("llm_first_token", time.perf_counter() - started)
+            first = False
+        yield chunk
+    timer.observe("llm_total", time.perf_counter() - started)
+
+async def astream_answer(chain, messages, timer):
+    """Async variant of stream_answer()."""
+    started = time.perf_counter()
+    first = True
+    async for chunk in chain.astream(messages):
+        if first:
+            timer.observe("llm_first_token", time.perf_counter() - started)
+            first = False
+        yield chunk
+    timer.observe("llm_total", time.perf_counter() - started)
@@ -0,0 +1,141 @@
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo import ReturnDocument
+from pymongo.database import Database
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+def claim_deleted_config(config_collection, lease_seconds: int):
+    """
+    Claims one config marked for deletion whose lease is free or expired.
+    The lease lets several workers run the reaper without deleting the same config twice,
+    and lets another worker take over a config whose reaper crashed mid-way.
+    """
+    now = datetime.now(timezone.utc)
+    return config_collection.find_one_and_update(
+        {
+            "deleted_at": {"$exists": True},
+            "$or": [{"deletion.lease_until": {"$exists": False}}, {"deletion.lease_until": {"$lt": now}}]
+        },
+        {"$set": {
+            "deletion.status": "running",
+            "deletion.worker": WORKER_ID,
+            "deletion.lease_until": now + timedelta(seconds=lease_seconds)
+        }},
+        sort=[("deleted_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+def record_progress(config_collection, config_oid, lease_seconds: int, stage: str, counter: str, deleted: int):
+    """Adds a batch to the config's progress record and extends the lease."""
+    config_collection.update_one(
+        {"_id": config_oid},
+        {
+            "$set": {
+                "deletion.stage": stage,
+                "deletion.lease_until": datetime.now(timezone.utc) + timedelta(seconds=lease_seconds)
+            },
+            "$inc": {f"deletion.{counter}": deleted}
+        }
+    )
+
+def delete_in_batches(collection, query: dict, batch_size: int, pause_seconds: float, on_batch):
+    """
+    Deletes the documents matching `query` at most `batch_size` at a time, by _id,
+    sleeping `pause_seconds` between batches. Calls `on_batch(deleted_count)` after each batch.
+    """
+    total = 0
+    while True:
+        ids = [doc["_id"] for doc in collection.find(query, {"_id": 1}).limit(batch_size)]
+        if not ids:
+            return total
+        deleted = collection.delete_many({"_id": {"$in": ids}}).deleted_count
+        total += deleted
+        on_batch(deleted)
+        if pause_seconds:
+            time.sleep(pause_seconds)
+
+def reap_config(db: Database, config_collection, config: dict, batch_size: int, session_batch_size: int, pause_seconds: float, lease_seconds: int):
+    """
+    Removes everything that belongs to a config marked for deletion, then the config itself.
+    Each stage only deletes what is still there, so a reaper that crashed can simply start over.
+    Messages are deleted by their config_id first, and the rest before their session metadata,
+    so the sessions can still be found on resume.
+    """
+    config_oid = config["_id"]
+    config_id = str(config_oid)
+
+    # 1. Vector chunks
+    delete_in_batches(
+        db["vector_collection"], {"config_id": config_id}, batch_size, pause_seconds,
+        lambda deleted: record_progress(config_collection, config_oid, lease_seconds, "vectors", "vectors_deleted", deleted)
+    )
+
+    # 2. Messages that carry the config_id, wherever their session metadata is
+    message_collection = db["message_store"]
+    delete_in_batches(
+        message_collection, {"config_id": config_id}, batch_size, pause_seconds,
+        lambda deleted: record_progress(config_collection, config_oid, lease_seconds, "messages", "messages_deleted", deleted)
+    )
+
+    # 3. Messages without one (legacy and survey writes) through their sessions, then the
+    #    metadata, a bounded number of sessions at a time
+    metadata_collection = db["chat_session_metadata"]
+    while True:
+        sessions = list(metadata_collection.find({"config_id": config_id}, {"session_id": 1}).limit(session_batch_size))
+        if not sessions:
+            break
+        session_ids = [s["session_id"] for s in sessions]
+        delete_in_batches(
+            message_collection, {"SessionId": {"$in": session_ids}}, batch_size, pause_seconds,
+            lambda deleted: record_progress(config_collection, config_oid, lease_seconds, "messages", "messages_deleted", deleted)
+        )
+        deleted = metadata_collection.delete_many({"_id": {"$in": [s["_id"] for s in sessions]}}).deleted_count
+        record_progress(config_collection, config_oid, lease_seconds, "sessions", "sessions_deleted", deleted)
+
+    # 4. The config itself
+    final = config_collection.find_one_and_delete({"_id": config_oid})
+    progress = (final or config).get("deletion", {})
+    logger.info(
+        f"Reaped config {config_id}: {progress.get('vectors_deleted', 0)} vector chunks, "
+        f"{progress.get('messages_deleted', 0)} messages, {progress.get('sessions_deleted', 0)} sessions"
+    )
+
+def reap_deleted_configs(db: Database, config_collection_name: str, batch_size: int = 500, session_batch_size: int = 50, pause_seconds: float = 0.1, lease_seconds: int = 300, max_configs: int = None):
+    """Reaps configs marked for deletion until none are left (or `max_configs` were handled). Returns the count."""
+    config_collection = db[config_collection_name]
+    reaped = 0
+    while max_configs is None or reaped < max_configs:
+        config = claim_deleted_config(config_collection, lease_seconds)
+        if not config:
+            break
+        logger.info(f"Reaping deleted config {config['_id']} (progress so far: {config.get('deletion')})")
+        reap_config(db, config_collection, config, batch_size, session_batch_size, pause_seconds, lease_seconds)
+        reaped += 1
+    return reaped
+
+def run_config_reaper():
+    """Background worker task: one reaper pass using the app's settings."""
+    reap_deleted_configs(
+        current_app.config['MONGO_DB'],
+        current_app.config['CONFIG'],
+        batch_size=int(os.getenv('CONFIG_REAPER_BATCH_SIZE', 500)),
+        pause_seconds=float(os.getenv('CONFIG_REAPER_PAUSE', 0.1))
+    )
+
+@click.command("reap-deleted-configs")
+@click.option("--batch-size", default=500, show_default=True, help="Documents deleted per batch.")
+@click.option("--pause", default=0.1, show_default=True, help="Seconds to sleep between batches.")
+@with_appcontext
+def reap_deleted_configs_command(batch_size, pause):
+    """Delete the data of configs marked for deletion."""
+    reaped = reap_deleted_configs(current_app.config['MONGO_DB'], current_app.config['CONFIG'], batch_size=batch_size, pause_seconds=pause)
+    click.echo(f"Reaped {reaped} configs.")
@@ -0,0 +1,170 @@
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Sequence
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+from src.utils.metrics import CACHE_REQUESTS, HISTORY_CACHE_BYTES, HISTORY_CACHE_SESSIONS
+
+logger = logging.getLogger(__name__)
+
+# --- Hot session history ---
+# Every chat turn puts the whole history of its session into the prompt. Multi-turn conversations
+# keep coming back to the worker that just wrote their previous turn, so the worker keeps the
+# message lists of recent sessions and reads message_store only on a miss.
+#
+# Entries are filled when a history is read and kept up to date when a turn is written
+# (write-through). They hold (type, content) pairs rather than LangChain messages, which is all the
+# prompt uses. A session whose messages cannot be represented that way is not cached.
+#
+# The session summary's message_count (models/chat_session.py) tells whether an entry is current.
+# The chat path gets that count from the session upsert it already makes. An entry is used only
+# if it holds exactly that many messages, so a turn written by another worker (or a batch run)
+# makes it a miss. Filling follows the same rule, so a read that raced a write is not cached.
+#
+# Entries are evicted least recently used first, when the cache holds more than
+# HISTORY_CACHE_MAX_SESSIONS sessions or HISTORY_CACHE_MAX_BYTES of messages, and after
+# HISTORY_CACHE_IDLE_TTL seconds without use.
+#
+# Environment:
+#   HISTORY_CACHE_ENABLED       'false' reads every history from message_store (default true)
+#   HISTORY_CACHE_MAX_SESSIONS  sessions per worker (default 10000)
+#   HISTORY_CACHE_MAX_BYTES     approximate memory per worker (default 64 MiB)
+#   HISTORY_CACHE_IDLE_TTL      seconds an unused session is kept (default 1800)
+
+CACHE_NAME = "history"
+MESSAGE_TYPES = {"human": HumanMessage, "ai": AIMessage, "system": SystemMessage}
+# Approximate size of a cache entry and of each (type, content) pair, without the content itself
+ENTRY_OVERHEAD_BYTES = 200
+MESSAGE_OVERHEAD_BYTES = sys.getsizeof(("human", "")) + 8
+
+class HistoryCacheSettings:
+    def __init__(self):
+        self.enabled = os.getenv("HISTORY_CACHE_ENABLED", "true").lower() in ['true', '1', 't']
+        self.max_sessions = int(os.getenv("HISTORY_CACHE_MAX_SESSIONS", 10_000))
+        self.max_bytes = int(os.getenv("HISTORY_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+        self.idle_ttl = float(os.getenv("HISTORY_CACHE_IDLE_TTL", 1800))
+
+def compact(messages: Sequence[BaseMessage]) -> Optional[tuple]:
+    """The (type, content) pairs of `messages`, or None if one of them needs more than that."""
+    pairs = []
+    for message in messages:
+        if message.type not in MESSAGE_TYPES or not isinstance(message.content, str) or getattr(message, "tool_calls", None):
+            return None
+        pairs.append((message.type, message.content))
+    return tuple(pairs)
+
+def expand(pairs: tuple) -> List[BaseMessage]:
+    return [MESSAGE_TYPES[message_type](content=content) for message_type, content in pairs]
+
+def size_of(pairs: tuple) -> int:
+    return ENTRY_OVERHEAD_BYTES + sum(MESSAGE_OVERHEAD_BYTES + sys.getsizeof(content) for _, content in pairs)
+
+class HistoryCache:
+    """The worker's LRU of session histories, keyed by session id."""
+
+    def __init__(self, settings: HistoryCacheSettings):
+        self.settings = settings
+        # session_id -> (last used, pairs, size), least recently used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, session_id: str) -> bool:
+        with self._lock:
+            return session_id in self._entries
+
+    def get(self, session_id: str, message_count: int) -> Optional[List[BaseMessage]]:
+        """The history of a session that has `message_count` messages, or None if it is not cached as such."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is None:
+                result = "miss"
+            elif time.monotonic() - entry[0] > self.settings.idle_ttl or len(entry[1]) != message_count:
+                self._remove(session_id)
+                result = "stale"
+            else:
+                entry = self._entries[session_id] = (time.monotonic(), entry[1], entry[2])
+                self._entries.move_to_end(session_id)
+                result = "hit"
+            self._report()
+        CACHE_REQUESTS.inc(cache=CACHE_NAME, tier="local", result=result)
+        return expand(entry[1]) if result == "hit" else None
+
+    def put(self, session_id: str, messages: Sequence[BaseMessage], message_count: int):
+        """
+        Caches the history of a session that has `message_count` messages. A list of another length
+        missed or added a write in the meantime, and only drops what is cached for the session.
+        """
+        pairs = compact(messages) if len(messages) == message_count else None
+        size = size_of(pairs) if pairs is not None else 0
+        with self._lock:
+            self._remove(session_id)
+            if pairs is not None and size <= self.settings.max_bytes:
+                now = time.monotonic()
+                self._entries[session_id] = (now, pairs, size)
+                self._bytes += size
+                self._evict(now)
+            self._report()
+
+    def discard(self, session_id: str):
+        with self._lock:
+            self._remove(session_id)
+            self._report()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self._report()
+
+    def _remove(self, session_id: str):
+        entry = self._entries.pop(session_id, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def _evict(self, now: float):
+        while self._entries:
+            session_id, (last_used, _, _) = next(iter(self._entries.items()))
+            over_budget = len(self._entries) > self.settings.max_sessions or self._bytes > self.settings.max_bytes
+            if not over_budget and now - last_used <= self.settings.idle_ttl:
+                return
+            self._remove(session_id)
+
+    def _report(self):
+        HISTORY_CACHE_SESSIONS.set(len(self._entries))
+        HISTORY_CACHE_BYTES.set(self._bytes)
+
+class NoHistoryCache:
+    """Stand-in for HistoryCache when HISTORY_CACHE_ENABLED is off."""
+
+    def __contains__(self, session_id: str) -> bool:
+        return False
+
+    def get(self, session_id: str, message_count: int):
+        return None
+
+    def put(self, session_id: str, messages: Sequence[BaseMessage], message_count: int):
+        pass
+
+    def discard(self, session_id: str):
+        pass
+
+    def clear(self):
+        pass
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def history_cache():
+    """The worker's history cache (created on first use, so after fork)."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                settings = HistoryCacheSettings()
+                _cache = HistoryCache(settings) if settings.enabled else NoHistoryCache()
+    return _cache
@@ -0,0 +1,361 @@
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import namedtuple
+
+from src.utils.cache import KEY_PREFIX, BsonCodec, LRUCache, shared_store
+from src.utils.metrics import IDEMPOTENT_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# --- Idempotent chat submissions ---
+# Clients and proxies retry a chat POST after a timeout. With an Idempotency-Key header, a retry
+# does not run the turn again (retrieval, LLM call, another human/AI pair in message_store): it
+# gets the answer of the first submission with that key.
+#
+# - If that turn completed within IDEMPOTENCY_TTL, its answer is replayed.
+# - If it is still running in this worker, the retry waits for it. A streamed retry follows the
+#   turn's events as they are produced.
+# - If it is running in another worker (its claim is in the shared cache tier), the retry polls
+#   for the answer.
+#
+# Keys are scoped to the config, the session and the user. Reusing a key for a different input is
+# a 422. A retry that is still waiting when its own deadline passes gets a 409 with Retry-After.
+# A turn that fails drops its claim, and the next submission with the key runs it again. With a
+# key, a turn keeps running when its client disconnects, so that a retry can pick up the answer.
+#
+# Completed answers are kept in the worker (IDEMPOTENCY_LOCAL_ENTRIES, LRU) and, if configured,
+# in the shared tier (src/utils/cache.py), both for IDEMPOTENCY_TTL seconds.
+
+IDEMPOTENCY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+MAX_KEY_LENGTH = 255
+POLL_SECONDS = 0.1
+
+class IdempotencySettings:
+    def __init__(self):
+        self.enabled = os.getenv("IDEMPOTENCY_ENABLED", "true").lower() in ['true', '1', 't']
+        self.ttl = int(os.getenv("IDEMPOTENCY_TTL", 900))
+        self.local_entries = int(os.getenv("IDEMPOTENCY_LOCAL_ENTRIES", 10_000))
+        # How long another worker's claim is honored if that worker dies before finishing the turn
+        self.claim_ttl = int(os.getenv("IDEMPOTENCY_CLAIM_TTL", 300))
+
+class IdempotencyConflict(Exception):
+    """A submission that cannot be served: the key is in use for another input, or its turn is still running."""
+
+    STATUS = {"mismatch": 422, "in_progress": 409}
+
+    def __init__(self, reason: str, retry_after: int = None):
+        super().__init__(f"Idempotency key conflict ({reason})")
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status = self.STATUS[reason]
+
+def request_fingerprint(user_input) -> str:
+    return hashlib.sha1(str(user_input).encode("utf-8")).hexdigest()
+
+def scoped_key(config_id: str, chat_id: str, user_id: str, key: str) -> str:
+    return hashlib.sha1(f"{config_id}\0{chat_id}\0{user_id}\0{key}".encode("utf-8")).hexdigest()
+
+def valid_key(key: str) -> bool:
+    return 0 < len(key) <= MAX_KEY_LENGTH
+
+# The answer of a turn is {"response": ..., "sources": [...]}, the body of a non-streamed chat response
+def answer_events(answer: dict) -> list:
+    """The NDJSON events of a streamed response that replays `answer`."""
+    return [
+        {"type": "sources", "sources": answer["sources"]},
+        {"type": "token", "content": answer["response"]},
+        {"type": "done", "response": answer["response"]},
+    ]
+
+class Submission:
+    """
+    The chat turn running under an idempotency key in this worker. The request that runs it
+    publishes its stream events and completes it with the answer. Other requests with the key
+    wait for it or follow its events. Leaving its `with` block without complete() drops the claim.
+    """
+
+    def __init__(self, store, key: str, fingerprint: str):
+        self.store = store
+        self.key = key
+        self.fingerprint = fingerprint
+        self.events = []
+        self.answer = None
+        self.done = False
+        self._condition = threading.Condition()
+        self._subscribers = []  # (loop, asyncio.Event) of async followers
+
+    def _wake(self):
+        for loop, event in self._subscribers:
+            loop.call_soon_threadsafe(event.set)
+
+    def publish(self, event: dict):
+        with self._condition:
+            self.events.append(event)
+            self._wake()
+
+    def _finish(self, answer):
+        with self._condition:
+            if self.done:
+                return False
+            self.answer = answer
+            self.done = True
+            self._condition.notify_all()
+            self._wake()
+            return True
+
+    def complete(self, answer: dict):
+        if self._finish(answer):
+            self.store.completed(self, answer)
+
+    def release(self):
+        """Drops the claim of a turn that did not complete; does nothing after complete()."""
+        if self._finish(None):
+            self.store.released(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    def wait(self, timeout: float) -> bool:
+        with self._condition:
+            return self._condition.wait_for(lambda: self.done, timeout)
+
+    async def follow(self):
+        """Yields the turn's events, from the first one, until it is done."""
+        loop = asyncio.get_running_loop()
+        wake = asyncio.Event()
+        subscriber = (loop, wake)
+        with self._condition:
+            self._subscribers.append(subscriber)
+        try:
+            index = 0
+            while True:
+                wake.clear()
+                with self._condition:
+                    events = self.events[index:]
+                    done = self.done
+                for event in events:
+                    yield event
+                index += len(events)
+                if done:
+                    if self.answer is None and not any(event["type"] == "error" for event in events):
+                        yield {"type": "error", "message": "An internal server error occurred."}
+                    return
+                await wake.wait()
+        finally:
+            with self._condition:
+                self._subscribers.remove(subscriber)
+
+    async def await_done(self, timeout: float) -> bool:
+        async def drain():
+            async for _ in self.follow():
+                pass
+        try:
+            await asyncio.wait_for(drain(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.done
+
+class NoSubmission:
+    """Stand-in Submission of a request without an idempotency key."""
+
+    def publish(self, event: dict):
+        pass
+
+    def complete(self, answer: dict):
+        pass
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+NO_SUBMISSION = NoSubmission()
+
+# What claim() found for a key: the answer to replay, a running Submission to follow, or the
+# Submission the caller now owns and must run.
+Claim = namedtuple("Claim", ["answer", "submission", "owner"])
+
+class IdempotencyStore:
+    """The worker's idempotency keys. Thread-safe; the async methods may be used from any event loop."""
+
+    def __init__(self, settings: IdempotencySettings = None):
+        self.settings = settings or IdempotencySettings()
+        self.answers = LRUCache(self.settings.local_entries, self.settings.ttl)
+        self._running = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _shared_key(key: str) -> str:
+        return f"{KEY_PREFIX}:idempotency:{key}"
+
+    def _shared(self, operation):
+        """Runs a shared-store operation; None without a shared store or when it fails."""
+        store = shared_store()
+        if store is None:
+            return None
+        try:
+            return operation(store)
+        except Exception as e:
+            logger.warning(f"Shared idempotency store failed: {e}")
+            return None
+
+    def _answer(self, key: str, fingerprint: str, local_only: bool = False):
+        """The completed answer of `key`, or None; raises IdempotencyConflict for another input."""
+        found, entry = self.answers.get(key)
+        if not found:
+            if local_only:
+                return None
+            data = self._shared(lambda store: store.get(self._shared_key(key)))
+            if data is None:
+                return None
+            entry = BsonCodec.decode(data)
+            self.answers.set(key, entry)
+        if entry["fingerprint"] != fingerprint:
+            raise IdempotencyConflict("mismatch")
+        return entry["answer"]
+
+    def _claim_elsewhere(self, key: str, fingerprint: str):
+        """
+        Takes the cross-worker claim of `key`. Returns None if taken (or there is no shared store),
+        else the fingerprint of the worker holding it.
+        """
+        claim_key = self._shared_key(key) + ":claim"
+        taken = self._shared(lambda store: store.set_if_absent(claim_key, fingerprint.encode(), self.settings.claim_ttl))
+        if taken or taken is None:
+            return None
+        holder = self._shared(lambda store: store.get(claim_key))
+        return holder.decode() if holder else None
+
+    def begin(self, key: str, fingerprint: str):
+        """
+        One look at `key`: a Claim, or None if another worker runs the turn. Raises
+        IdempotencyConflict if the key was used for another input.
+        """
+        answer = self._answer(key, fingerprint)
+        if answer is not None:
+            return Claim(answer, None, False)
+        with self._lock:
+            submission = self._running.get(key)
+            if submission is not None:
+                if submission.fingerprint != fingerprint:
+                    raise IdempotencyConflict("mismatch")
+                return Claim(None, submission, False)
+            # The turn may have completed since the first look
+            answer = self._answer(key, fingerprint, local_only=True)
+            if answer is not None:
+                return Claim(answer, None, False)
+            holder = self._claim_elsewhere(key, fingerprint)
+            if holder is not None:
+                if holder != fingerprint:
+                    raise IdempotencyConflict("mismatch")
+                return None
+            answer = self._answer(key, fingerprint)
+            if answer is not None:
+                self._shared(lambda store: store.delete(self._shared_key(key) + ":claim"))
+                return Claim(answer, None, False)
+            submission = self._running[key] = Submission(self, key, fingerprint)
+            return Claim(None, submission, True)
+
+    def completed(self, submission: Submission, answer: dict):
+        entry = {"fingerprint": submission.fingerprint, "answer": answer}
+        self.answers.set(submission.key, entry)
+        shared_key = self._shared_key(submission.key)
+        self._shared(lambda store: store.set(shared_key, BsonCodec.encode(entry), self.settings.ttl))
+        self._shared(lambda store: store.delete(shared_key + ":claim"))
+        with self._lock:
+            self._running.pop(submission.key, None)
+
+    def released(self, submission: Submission):
+        self._shared(lambda store: store.delete(self._shared_key(submission.key) + ":claim"))
+        with self._lock:
+            self._running.pop(submission.key, None)
+
+    def _record(self, claim: Claim):
+        outcome = "replayed" if claim.answer is not None else "owner" if claim.owner else "attached"
+        IDEMPOTENT_REQUESTS.inc(outcome=outcome)
+
+    def _conflict(self, error: IdempotencyConflict):
+        IDEMPOTENT_REQUESTS.inc(outcome=error.reason)
+        return error
+
+    def claim(self, key: str, fingerprint: str, timeout: float) -> Claim:
+        """
+        Waits until `key` has an answer to replay, or the caller owns its turn. Waits for a turn
+        that is running for at most `timeout` seconds, then raises IdempotencyConflict("in_progress").
+        The returned Claim never has a submission to follow.
+        """
+        give_up = time.monotonic() + timeout
+        while True:
+            try:
+                claim = self.begin(key, fingerprint)
+            except IdempotencyConflict as e:
+                raise self._conflict(e)
+            if claim is not None and (claim.answer is not None or claim.owner):
+                self._record(claim)
+                return claim
+            remaining = give_up - time.monotonic()
+            if remaining <= 0:
+                raise self._conflict(IdempotencyConflict("in_progress", retry_after=max(1, int(timeout))))
+            if claim is not None:
+                # Running here: wait for it, then replay its answer or run it if it failed
+                claim.submission.wait(remaining)
+            else:
+                time.sleep(min(POLL_SECONDS, remaining))
+
+    async def aclaim(self, key: str, fingerprint: str, timeout: float, follow: bool = False) -> Claim:
+        """claim() for the async endpoint. With `follow`, a turn running in this worker is returned to be followed."""
+        give_up = time.monotonic() + timeout
+        while True:
+            try:
+                claim = await asyncio.to_thread(self.begin, key, fingerprint)
+            except IdempotencyConflict as e:
+                raise self._conflict(e)
+            if claim is not None and (claim.answer is not None or claim.owner or follow):
+                self._record(claim)
+                return claim
+            remaining = give_up - time.monotonic()
+            if remaining <= 0:
+                raise self._conflict(IdempotencyConflict("in_progress", retry_after=max(1, int(timeout))))
+            if claim is not None:
+                await claim.submission.await_done(remaining)
+            else:
+                await asyncio.sleep(min(POLL_SECONDS, remaining))
+
+class NoIdempotency:
+    """Stand-in store with IDEMPOTENCY_ENABLED=false: every submission runs its turn."""
+
+    def claim(self, key: str, fingerprint: str, timeout: float) -> Claim:
+        return Claim(None, NO_SUBMISSION, True)
+
+    async def aclaim(self, key: str, fingerprint: str, timeout: float, follow: bool = False) -> Claim:
+        return Claim(None, NO_SUBMISSION, True)
+
+_store = None
+_store_lock = threading.Lock()
+
+def idempotency_store():
+    """The worker's idempotency store (created on first use, so after fork)."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                settings = IdempotencySettings()
+                _store = IdempotencyStore(settings) if settings.enabled else NoIdempotency()
+    return _store
+
+def conflict_body(conflict: IdempotencyConflict) -> dict:
+    if conflict.reason == "mismatch":
+        return {"message": f"This {IDEMPOTENCY_HEADER} was already used for a different request."}
+    return {"message": "A request with this Idempotency-Key is still in progress, please retry shortly.", "retry_after": conflict.retry_after}
@@ -0,0 +1,271 @@
+import logging
+import os
+import socket
+import time
+from datetime import datetime, timedelta, timezone
+import click
+from bson import ObjectId
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
+from pymongo.database import Database
+
+from models.config import Config
+from models.vector_stores import VectorChunks
+from src.backend.embedding_factory import (
+    embedding_field_of, embedding_model_of, embedding_spec, get_embeddings, other_embedding_field
+)
+from src.backend.llm_scheduler import INGEST
+from src.services.chat_service import TEXT_KEY
+from src.utils.cache import bump_config_version, bump_content_version
+from src.utils.metrics import REEMBED_CHUNKS
+
+logger = logging.getLogger(__name__)
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# --- Re-embedding a config with another embedding model ---
+# The chunk text is already stored, so a config is moved to another model without re-uploading:
+#   1. copy     the chunks are re-embedded in _id order, a batch at a time, into the vector field
+#               the config does not read (the shadow field, see src/backend/embedding_factory.py);
+#               chat keeps querying the old vectors meanwhile
+#   2. switch   one update of the config sets the new embedding_model and embedding_field, so
+#               every request after it queries the new vectors
+#   3. cleanup  chunks stored by uploads that raced the switch are embedded too, then the old
+#               vectors are removed and the chunks are tagged with the new model
+# The job's state lives in the config's `reembed` subdocument: the status, the last chunk copied
+# (so a crashed job resumes where it stopped), the progress counters and a lease, which lets a
+# worker take over the job of a worker that died. Batches are throttled by a pause between them.
+
+ACTIVE_STATUSES = ["pending", "running", "switched"]
+MAX_ATTEMPTS = int(os.getenv("REEMBED_MAX_ATTEMPTS", 3))
+
+class ReembedError(ValueError):
+    """Raised when a re-embedding cannot be started; the message is safe to return to the client."""
+
+class ReembedInProgress(ReembedError):
+    pass
+
+def start_reembed(config_collection, config_id: str, target_model: str) -> dict:
+    """Schedules the re-embedding of a config with `target_model`. Returns the job's initial state."""
+    try:
+        embedding_spec(target_model)
+    except ValueError as e:
+        raise ReembedError(str(e))
+    config = config_collection.find_one({"_id": ObjectId(config_id), **Config.ACTIVE})
+    if not config:
+        raise ReembedError("Configuration not found")
+    if embedding_model_of(config) == target_model:
+        raise ReembedError(f"Configuration already uses {target_model}")
+
+    job = {
+        "status": "pending",
+        "source_model": embedding_model_of(config),
+        "target_model": target_model,
+        "source_field": embedding_field_of(config),
+        "target_field": other_embedding_field(embedding_field_of(config)),
+        "total": config_collection.database[VectorChunks.COLLECTION_NAME].count_documents({"config_id": config_id}),
+        "processed": 0,
+        "requested_at": datetime.now(timezone.utc),
+    }
+    # Only one job per config at a time
+    result = config_collection.update_one(
+        {"_id": config["_id"], **Config.ACTIVE, "reembed.status": {"$nin": ACTIVE_STATUSES}},
+        {"$set": {"reembed": job}}
+    )
+    if result.modified_count != 1:
+        raise ReembedInProgress("A re-embedding of this configuration is already in progress")
+    return job
+
+def claim_reembed_job(config_collection, lease_seconds: int):
+    """Claims one unfinished re-embedding whose lease is free or expired (as the config reaper does)."""
+    now = datetime.now(timezone.utc)
+    return config_collection.find_one_and_update(
+        {
+            **Config.ACTIVE,
+            "reembed.status": {"$in": ACTIVE_STATUSES},
+            "$or": [{"reembed.lease_until": {"$exists": False}}, {"reembed.lease_until": {"$lt": now}}]
+        },
+        {"$set": {"reembed.worker": WORKER_ID, "reembed.lease_until": now + timedelta(seconds=lease_seconds)}},
+        sort=[("reembed.requested_at", 1)],
+        return_document=ReturnDocument.AFTER
+    )
+
+class LeaseLost(Exception):
+    """The job was taken over by another worker, or its config was deleted."""
+
+def update_job(config_collection, config_oid, lease_seconds: int, set_fields: dict = None, inc_fields: dict = None):
+    """Records progress and extends the lease; raises LeaseLost if this worker no longer owns the job."""
+    update = {"$set": {
+        "reembed.lease_until": datetime.now(timezone.utc) + timedelta(seconds=lease_seconds),
+        **{f"reembed.{key}": value for key, value in (set_fields or {}).items()}
+    }}
+    if inc_fields:
+        update["$inc"] = {f"reembed.{key}": value for key, value in inc_fields.items()}
+    result = config_collection.update_one({"_id": config_oid, **Config.ACTIVE, "reembed.worker": WORKER_ID}, update)
+    if result.matched_count != 1:
+        raise LeaseLost()
+
+def embed_chunks(vector_collection, embeddings, chunks: list, target_field: str, target_model: str) -> int:
+    """Writes the new vectors of a batch of chunks with one bulk_write."""
+    vectors = embeddings.embed_documents([chunk.get(TEXT_KEY, "") for chunk in chunks])
+    vector_collection.bulk_write([
+        UpdateOne({"_id": chunk["_id"]}, {"$set": {target_field: vector, "reembed_model": target_model}})
+        for chunk, vector in zip(chunks, vectors)
+    ], ordered=False)
+    REEMBED_CHUNKS.inc(len(chunks), model=target_model)
+    return len(chunks)
+
+def reembed_config(db: Database, config_collection, config: dict, embeddings, batch_size: int, pause_seconds: float, lease_seconds: int):
+    """Runs (or resumes) the re-embedding job of a claimed config through copy, switch and cleanup."""
+    config_oid = config["_id"]
+    config_id = str(config_oid)
+    job = config["reembed"]
+    target_model, target_field, source_field = job["target_model"], job["target_field"], job["source_field"]
+    vector_collection = db[VectorChunks.COLLECTION_NAME]
+
+    if job["status"] != "switched":
+        # 1. Copy, resuming after the last chunk done. Chunks uploaded meanwhile get larger _ids,
+        #    so the loop picks them up until it catches up.
+        update_job(config_collection, config_oid, lease_seconds, {"status": "running", "started_at": job.get("started_at") or datetime.now(timezone.utc)})
+        last_id = job.get("last_id")
+        while True:
+            query = {"config_id": config_id}
+            if last_id:
+                query["_id"] = {"$gt": last_id}
+            chunks = list(vector_collection.find(query, {TEXT_KEY: 1}).sort("_id", ASCENDING).limit(batch_size))
+            if not chunks:
+                break
+            done = embed_chunks(vector_collection, embeddings, chunks, target_field, target_model)
+            last_id = chunks[-1]["_id"]
+            update_job(config_collection, config_oid, lease_seconds, {"last_id": last_id}, {"processed": done})
+            if pause_seconds:
+                time.sleep(pause_seconds)
+
+        # 2. Switch: from this write on, the config is queried with the new model and field
+        result = config_collection.update_one(
+            {"_id": config_oid, **Config.ACTIVE, "reembed.worker": WORKER_ID},
+            {"$set": {
+                "embedding_model": target_model,
+                "embedding_field": target_field,
+                "reembed.status": "switched",
+                "reembed.switched_at": datetime.now(timezone.utc)
+            }}
+        )
+        if result.matched_count != 1:
+            raise LeaseLost()
+        bump_config_version(config_id)
+        bump_content_version(config_id)
+        logger.info(f"Config {config_id} switched to {target_model} ({target_field})")
+
+    # 3. Cleanup: embed the chunks an upload stored with the old model while the switch happened,
+    #    then drop the old vectors and tag the chunks with the new model
+    while True:
+        chunks = list(vector_collection.find(
+            {"config_id": config_id, "reembed_model": {"$ne": target_model}, "embedding_model": {"$ne": target_model}},
+            {TEXT_KEY: 1}
+        ).limit(batch_size))
+        if not chunks:
+            break
+        done = embed_chunks(vector_collection, embeddings, chunks, target_field, target_model)
+        update_job(config_collection, config_oid, lease_seconds, inc_fields={"processed": done})
+
+    while True:
+        ids = [chunk["_id"] for chunk in vector_collection.find({"config_id": config_id, "reembed_model": target_model}, {"_id": 1}).limit(batch_size)]
+        if not ids:
+            break
+        vector_collection.update_many(
+            {"_id": {"$in": ids}},
+            {"$set": {"embedding_model": target_model}, "$unset": {source_field: "", "reembed_model": ""}}
+        )
+        update_job(config_collection, config_oid, lease_seconds)
+        if pause_seconds:
+            time.sleep(pause_seconds)
+
+    config_collection.update_one(
+        {"_id": config_oid, "reembed.worker": WORKER_ID},
+        {"$set": {"reembed.status": "done", "reembed.finished_at": datetime.now(timezone.utc)}, "$unset": {"reembed.lease_until": ""}}
+    )
+    logger.info(f"Re-embedded config {config_id} with {target_model}")
+
+def run_reembed_jobs(db: Database, config_collection_name: str, app_config, batch_size: int = 100, pause_seconds: float = 0.5, lease_seconds: int = 300, max_jobs: int = None):
+    """Runs unfinished re-embedding jobs until none are left (or `max_jobs` were handled). Returns the count."""
+    config_collection = db[config_collection_name]
+    handled = 0
+    while max_jobs is None or handled < max_jobs:
+        config = claim_reembed_job(config_collection, lease_seconds)
+        if not config:
+            break
+        handled += 1
+        job = config["reembed"]
+        logger.info(f"Re-embedding config {config['_id']} with {job['target_model']} ({job.get('processed', 0)}/{job.get('total')} done so far)")
+        try:
+            reembed_config(db, config_collection, config, get_embeddings(job["target_model"], app_config, priority=INGEST), batch_size, pause_seconds, lease_seconds)
+        except LeaseLost:
+            logger.warning(f"Re-embedding of config {config['_id']} was taken over or the config was deleted; stopping")
+        except Exception as e:
+            # Retried from where it stopped once the lease expires, up to MAX_ATTEMPTS times
+            logger.error(f"Re-embedding of config {config['_id']} failed: {e}", exc_info=True)
+            failed = config_collection.find_one_and_update(
+                {"_id": config["_id"], "reembed.worker": WORKER_ID},
+                {"$set": {"reembed.error": str(e)}, "$inc": {"reembed.attempts": 1}},
+                return_document=ReturnDocument.AFTER
+            )
+            if failed and failed["reembed"]["attempts"] >= MAX_ATTEMPTS:
+                config_collection.update_one(
+                    {"_id": config["_id"], "reembed.worker": WORKER_ID},
+                    {"$set": {"reembed.status": "failed"}, "$unset": {"reembed.lease_until": ""}}
+                )
+    return handled
+
+def run_reembed_worker():
+    """Background worker task: runs the pending re-embeddings using the app's settings."""
+    run_reembed_jobs(
+        current_app.config['MONGO_DB'],
+        current_app.config['CONFIG'],
+        current_app.config,
+        batch_size=int(os.getenv('REEMBED_BATCH_SIZE', 100)),
+        pause_seconds=float(os.getenv('REEMBED_PAUSE', 0.5))
+    )
+
+def reembed_status(config: dict) -> dict:
+    """The client-facing view of a config's re-embedding job."""
+    job = config.get("reembed")
+    if not job:
+        return {"status": "none", "embedding_model": embedding_model_of(config)}
+    total = job.get("total") or 0
+    return {
+        "status": job["status"],
+        "embedding_model": embedding_model_of(config),
+        "source_model": job.get("source_model"),
+        "target_model": job.get("target_model"),
+        "processed": job.get("processed", 0),
+        "total": total,
+        "progress": round(min(job.get("processed", 0) / total, 1.0), 4) if total else None,
+        "error": job.get("error"),
+        "requested_at": job.get("requested_at"),
+        "switched_at": job.get("switched_at"),
+        "finished_at": job.get("finished_at"),
+    }
+
+@click.command("reembed-config")
+@click.option("--config-id", required=True, help="Config to move to another embedding model.")
+@click.option("--model", "target_model", required=True, help="Target embedding model id (see src/backend/embedding_factory.py).")
+@click.option("--batch-size", default=100, show_default=True, help="Chunks embedded per batch.")
+@click.option("--pause", default=0.5, show_default=True, help="Seconds to sleep between batches.")
+@click.option("--schedule-only", is_flag=True, help="Only schedule the job for the background workers.")
+@with_appcontext
+def reembed_config_command(config_id, target_model, batch_size, pause, schedule_only):
+    """Re-embed a config's chunks with another embedding model and switch the config over."""
+    config_collection = current_app.config['MONGO_DB'][current_app.config['CONFIG']]
+    if not ObjectId.is_valid(config_id):
+        raise click.UsageError("Invalid config id")
+    try:
+        job = start_reembed(config_collection, config_id, target_model)
+    except ReembedError as e:
+        raise click.UsageError(str(e))
+    click.echo(f"Scheduled re-embedding of {job['total']} chunks: {job['source_model']} -> {target_model}")
+    if schedule_only:
+        return
+    run_reembed_jobs(current_app.config['MONGO_DB'], current_app.config['CONFIG'], current_app.config, batch_size=batch_size, pause_seconds=pause)
+    click.echo(f"Status: {reembed_status(config_collection.find_one({'_id': ObjectId(config_id)}))}")
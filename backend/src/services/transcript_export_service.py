@@ -0,0 +1,178 @@
+import logging
+import csv
+import io
+import json
+import os
+import time
+import zlib
+from datetime import datetime, timezone
+import click
+from bson import ObjectId
+from flask import current_app
+from flask.cli import with_appcontext
+from pymongo import ASCENDING
+from pymongo.collection import Collection
+
+from src.backend.database.mongo_utils import history_to_message_dict
+
+logger = logging.getLogger(__name__)
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FIELDS = ["id", "session_id", "config_id", "user_id", "survey_id", "response_id", "agent_id", "type", "content", "created_at"]
+EXPORT_PROJECTION = {"SessionId": 1, "config_id": 1, "user_id": 1, "SurveyId": 1, "ResponseId": 1, "AgentId": 1, "History": 1, "created_at": 1}
+
+def parse_export_date(value: str):
+    """Parses an ISO 8601 date or datetime; naive values are taken as UTC."""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def survey_sessions_of_config(message_collection: Collection, session_collection: Collection, config_id: str, survey_id: str) -> list:
+    """
+    The sessions of a survey that chat_session_metadata assigns to `config_id`. Survey messages
+    written without a config_id are exported through these; sessions of other configs are left out.
+    """
+    session_ids = message_collection.distinct("SessionId", {"SurveyId": survey_id})
+    if not session_ids:
+        return []
+    return session_collection.distinct("session_id", {"session_id": {"$in": session_ids}, "config_id": config_id})
+
+def build_export_query(config_id: str = None, survey_id: str = None, start: datetime = None, end: datetime = None,
+                       survey_sessions: list = None):
+    """
+    Builds the message_store filter for an export. The date range is applied to _id,
+    whose embedded timestamp is set for both legacy and native documents, so it stays
+    on the (config_id, _id) / (SurveyId, _id) indexes. With `survey_sessions` (see
+    survey_sessions_of_config), messages of those sessions count as the config's too.
+    """
+    query = {}
+    if config_id and survey_sessions:
+        query["$or"] = [{"config_id": config_id}, {"SessionId": {"$in": survey_sessions}}]
+    elif config_id:
+        query["config_id"] = config_id
+    if survey_id:
+        query["SurveyId"] = survey_id
+    id_range = {}
+    if start:
+        id_range["$gte"] = ObjectId.from_datetime(start)
+    if end:
+        id_range["$lt"] = ObjectId.from_datetime(end)
+    if id_range:
+        query["_id"] = id_range
+    return query
+
+def export_record(doc: dict) -> dict:
+    """Flattens a message_store document into an export record."""
+    try:
+        message = history_to_message_dict(doc.get("History"))
+    except (json.JSONDecodeError, TypeError):
+        message = {}
+    created_at = doc.get("created_at") or doc["_id"].generation_time
+    return {
+        "id": str(doc["_id"]),
+        "session_id": doc.get("SessionId"),
+        "config_id": doc.get("config_id"),
+        "user_id": doc.get("user_id"),
+        "survey_id": doc.get("SurveyId"),
+        "response_id": doc.get("ResponseId"),
+        "agent_id": doc.get("AgentId"),
+        "type": message.get("type"),
+        "content": (message.get("data") or {}).get("content"),
+        "created_at": created_at.replace(tzinfo=None).isoformat(timespec="milliseconds") + "Z",
+    }
+
+def iter_export_batches(collection: Collection, query: dict, after: str = None, batch_size: int = EXPORT_BATCH_SIZE, pause_seconds: float = 0):
+    """
+    Yields lists of export records in _id order. Each batch is a separate bounded query that
+    continues after the last _id of the previous one, so memory stays constant, no cursor is
+    held open between batches, and an export can resume from any record id (the checkpoint token).
+    """
+    last_id = ObjectId(after) if after else None
+    while True:
+        batch_query = dict(query)
+        if last_id:
+            batch_query["_id"] = {**query.get("_id", {}), "$gt": last_id}
+        docs = list(collection.find(batch_query, EXPORT_PROJECTION).sort("_id", ASCENDING).limit(batch_size))
+        if not docs:
+            return
+        last_id = docs[-1]["_id"]
+        yield [export_record(doc) for doc in docs]
+        if pause_seconds:
+            time.sleep(pause_seconds)
+
+def ndjson_chunks(batches):
+    """Encodes record batches as newline-delimited JSON, one chunk per batch."""
+    for records in batches:
+        yield "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records).encode("utf-8")
+
+def gzip_csv_chunks(batches, include_header: bool = True):
+    """
+    Encodes record batches as gzip-compressed CSV. Every batch is a complete gzip member;
+    gzip readers treat concatenated members as one file, so the output is valid after every
+    batch and a resumed export can simply append to it.
+    """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=EXPORT_FIELDS)
+    if include_header:
+        writer.writeheader()
+    for records in batches:
+        writer.writerows(records)
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31 -> gzip container
+        yield compressor.compress(buffer.getvalue().encode("utf-8")) + compressor.flush()
+        buffer.seek(0)
+        buffer.truncate(0)
+
+@click.command("export-transcripts")
+@click.option("--config-id", default=None, help="Only export messages of this config.")
+@click.option("--survey-id", default=None, help="Only export messages tagged with this SurveyId.")
+@click.option("--start", default=None, help="Only export messages created at or after this ISO date.")
+@click.option("--end", default=None, help="Only export messages created before this ISO date.")
+@click.option("--format", "export_format", type=click.Choice(["ndjson", "csv"]), default="ndjson", show_default=True, help="csv output is gzip-compressed.")
+@click.option("--output", required=True, type=click.Path(dir_okay=False), help="File to write (appended to when resuming).")
+@click.option("--checkpoint-file", default=None, type=click.Path(dir_okay=False), help="Where the last exported id is kept; resumes from it if present.")
+@click.option("--batch-size", default=EXPORT_BATCH_SIZE, show_default=True)
+@click.option("--pause", default=0.0, show_default=True, help="Seconds to sleep between batches.")
+@with_appcontext
+def export_transcripts_command(config_id, survey_id, start, end, export_format, output, checkpoint_file, batch_size, pause):
+    """Export chat transcripts from message_store as NDJSON or gzip-compressed CSV."""
+    if not any([config_id, survey_id, start, end]):
+        raise click.UsageError("Give at least one of --config-id, --survey-id, --start or --end.")
+
+    checkpoint_file = checkpoint_file or f"{output}.checkpoint"
+    after = None
+    if os.path.exists(checkpoint_file):
+        with open(checkpoint_file) as f:
+            after = f.read().strip() or None
+        click.echo(f"Resuming after message {after}")
+
+    collection = current_app.config['MONGO_DB']["message_store"]
+    survey_sessions = None
+    if config_id and survey_id:
+        survey_sessions = survey_sessions_of_config(collection, current_app.config['MONGO_DB']["chat_session_metadata"], config_id, survey_id)
+    query = build_export_query(
+        config_id=config_id,
+        survey_id=survey_id,
+        start=parse_export_date(start) if start else None,
+        end=parse_export_date(end) if end else None,
+        survey_sessions=survey_sessions
+    )
+
+    exported = 0
+    last_id = after
+
+    def tracked_batches():
+        nonlocal exported, last_id
+        for records in iter_export_batches(collection, query, after=after, batch_size=batch_size, pause_seconds=pause):
+            yield records
+            exported += len(records)
+            last_id = records[-1]["id"]
+            with open(checkpoint_file, "w") as f:
+                f.write(last_id)
+
+    encoder = ndjson_chunks(tracked_batches()) if export_format == "ndjson" else gzip_csv_chunks(tracked_batches(), include_header=after is None)
+    with open(output, "ab" if after else "wb") as f:
+        for chunk in encoder:
+            f.write(chunk)
+
+    click.echo(f"Exported {exported} messages to {output} (last id {last_id})")
@@ -0,0 +1,234 @@
+import logging
+import math
+import os
+import threading
+from datetime import datetime, timedelta, timezone
+
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+from models.usage_rollup import UsageRollup
+from src.utils.metrics import USAGE_ROLLUP_FLUSHES
+
+logger = logging.getLogger(__name__)
+
+# --- Usage rollups ---
+# Every chat turn and ingestion is booked to its config, the config's owner and the model, in time
+# buckets of USAGE_BUCKET_SECONDS (src/utils/usage.py meters the request). A worker adds the
+# requests it served to rollups in memory and flushes them every USAGE_FLUSH_INTERVAL seconds as
+# $inc upserts, one per (config, kind, model, bucket) document of usage_rollups
+# (models/usage_rollup.py), so the request path never writes to Mongo and the workers never
+# overwrite each other. A failed flush keeps its rollups for the next one; what a worker has not
+# flushed when it dies is lost.
+#
+# Latencies are kept as sums (for averages) and as counts per LATENCY_BUCKETS bucket, from which
+# the usage report estimates percentiles.
+#
+# Environment:
+#   USAGE_ENABLED         'false' turns the rollups off (default true)
+#   USAGE_BUCKET_SECONDS  width of a rollup bucket (default 3600)
+#   USAGE_FLUSH_INTERVAL  seconds between flushes of a worker (default 10)
+
+# Upper bounds (seconds) of the request latency buckets
+LATENCY_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, math.inf)
+SUCCESS_STATUSES = ("ok", "200")
+GRANULARITIES = ("hour", "day", "total")
+# Counters added up by the report, besides the latency buckets
+SUMMED_FIELDS = (
+    "requests", "errors", "input_tokens", "output_tokens", "embedding_tokens", "llm_calls",
+    "estimated_calls", "chunks", "total_seconds", "llm_total_seconds", "llm_first_token_seconds",
+)
+
+class UsageSettings:
+    def __init__(self):
+        self.enabled = os.getenv("USAGE_ENABLED", "true").lower() in ['true', '1', 't']
+        self.bucket_seconds = int(os.getenv("USAGE_BUCKET_SECONDS", 3600))
+        self.flush_interval = float(os.getenv("USAGE_FLUSH_INTERVAL", 10))
+
+def latency_field(seconds: float) -> str:
+    """The name of the latency bucket of `seconds`, e.g. 'le_0_5' or 'le_inf'."""
+    bound = next(bound for bound in LATENCY_BUCKETS if seconds <= bound)
+    if bound == math.inf:
+        return "le_inf"
+    return "le_" + f"{bound:g}".replace(".", "_")
+
+def bucket_start(when: datetime, bucket_seconds: int) -> datetime:
+    seconds = int(when.timestamp()) // bucket_seconds * bucket_seconds
+    return datetime.fromtimestamp(seconds, tz=timezone.utc)
+
+class UsageRecorder:
+    """The worker's rollups that have not been flushed yet, keyed by (bucket, kind, config_id, model)."""
+
+    def __init__(self, settings: UsageSettings):
+        self.settings = settings
+        # key -> {"owner_id": ..., "inc": {field: amount}, "max": {field: value}}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def add(self, meter, durations: dict, status: str):
+        """Books one finished request (a UsageMeter and its StageTimer durations)."""
+        total = durations.get("total", 0.0)
+        counts = {
+            "requests": 1,
+            "errors": int(status not in SUCCESS_STATUSES),
+            "input_tokens": meter.input_tokens,
+            "output_tokens": meter.output_tokens,
+            "embedding_tokens": meter.embedding_tokens,
+            "llm_calls": meter.llm_calls,
+            "estimated_calls": meter.estimated_calls,
+            "chunks": meter.chunks,
+            "total_seconds": total,
+            "llm_total_seconds": durations.get("llm_total", 0.0),
+            "llm_first_token_seconds": durations.get("llm_first_token", 0.0),
+            f"latency.{latency_field(total)}": 1,
+        }
+        key = (bucket_start(datetime.now(timezone.utc), self.settings.bucket_seconds), meter.kind, meter.config_id, meter.model)
+        self._merge(key, meter.owner_id, counts, {"max_total_seconds": total})
+
+    def _merge(self, key, owner_id, counts: dict, maxima: dict):
+        with self._lock:
+            rollup = self._pending.setdefault(key, {"owner_id": owner_id, "inc": {}, "max": {}})
+            for field, amount in counts.items():
+                rollup["inc"][field] = rollup["inc"].get(field, 0) + amount
+            for field, value in maxima.items():
+                rollup["max"][field] = max(rollup["max"].get(field, value), value)
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self, collection) -> int:
+        """Writes the pending rollups with one unordered bulk_write; returns the number written."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            keys = list(pending)
+            operations = []
+            for bucket, kind, config_id, model in keys:
+                rollup = pending[(bucket, kind, config_id, model)]
+                operations.append(UpdateOne(
+                    {"config_id": config_id, "kind": kind, "model": model, "bucket": bucket},
+                    {"$inc": rollup["inc"], "$max": rollup["max"], "$setOnInsert": {"owner_id": rollup["owner_id"]}},
+                    upsert=True
+                ))
+            try:
+                collection.bulk_write(operations, ordered=False)
+            except BulkWriteError as e:
+                failed = [keys[error["index"]] for error in e.details.get("writeErrors", [])]
+                self._restore(pending, failed)
+                USAGE_ROLLUP_FLUSHES.inc(result="error")
+                logger.error(f"Flushing usage rollups failed for {len(failed)} of {len(keys)}: {e}")
+                return len(keys) - len(failed)
+            except Exception:
+                self._restore(pending, keys)
+                USAGE_ROLLUP_FLUSHES.inc(result="error")
+                raise
+            USAGE_ROLLUP_FLUSHES.inc(result="ok")
+            return len(keys)
+
+    def _restore(self, pending: dict, keys):
+        """Adds the rollups of a failed flush back, to be written by the next one."""
+        for key in keys:
+            self._merge(key, pending[key]["owner_id"], pending[key]["inc"], pending[key]["max"])
+
+class NoUsageRecorder:
+    """Stand-in for UsageRecorder when USAGE_ENABLED is off."""
+
+    def add(self, meter, durations: dict, status: str):
+        pass
+
+    def pending(self) -> int:
+        return 0
+
+    def flush(self, collection) -> int:
+        return 0
+
+_recorder = None
+_recorder_lock = threading.Lock()
+
+def usage_recorder():
+    """The worker's usage recorder (created on first use, so after fork)."""
+    global _recorder
+    if _recorder is None:
+        with _recorder_lock:
+            if _recorder is None:
+                settings = UsageSettings()
+                _recorder = UsageRecorder(settings) if settings.enabled else NoUsageRecorder()
+    return _recorder
+
+def flush_usage():
+    """Background worker task: writes the worker's pending usage rollups."""
+    written = usage_recorder().flush(UsageRollup.get_collection())
+    if written:
+        logger.debug(f"Flushed {written} usage rollups")
+
+# --- Usage report ---
+
+def usage_query(owner_id: str, start: datetime, end: datetime, config_id: str = None, kind: str = None) -> dict:
+    """The usage_rollups filter of an owner's usage between `start` (inclusive) and `end` (exclusive)."""
+    query = {"owner_id": owner_id, "bucket": {"$gte": start, "$lt": end}}
+    if config_id:
+        query["config_id"] = config_id
+    if kind:
+        query["kind"] = kind
+    return query
+
+def period_of(bucket: datetime, granularity: str):
+    if granularity == "total":
+        return None
+    if bucket.tzinfo is None:
+        bucket = bucket.replace(tzinfo=timezone.utc)
+    if granularity == "day":
+        bucket = bucket.replace(hour=0)
+    return bucket.replace(minute=0, second=0, microsecond=0).isoformat()
+
+def latency_percentile(latency: dict, requests: int, quantile: float):
+    """The upper bound of the latency bucket holding the `quantile` request; None for the last bucket."""
+    if not requests:
+        return None
+    seen = 0
+    for bound in LATENCY_BUCKETS:
+        seen += latency.get(latency_field(bound), 0)
+        if seen >= quantile * requests:
+            return bound if bound != math.inf else None
+    return None
+
+def usage_report(docs, granularity: str = "day") -> list:
+    """
+    Adds up rollup documents per config, kind, model and period (an hour, a day, or the whole
+    range for 'total'), with average latencies and the estimated p95.
+    """
+    rows = {}
+    for doc in docs:
+        key = (doc["config_id"], doc["kind"], doc.get("model", ""), period_of(doc["bucket"], granularity))
+        row = rows.setdefault(key, {"max_total_seconds": 0.0, "latency": {}})
+        for field in SUMMED_FIELDS:
+            row[field] = row.get(field, 0) + doc.get(field, 0)
+        for field, count in (doc.get("latency") or {}).items():
+            row["latency"][field] = row["latency"].get(field, 0) + count
+        row["max_total_seconds"] = max(row["max_total_seconds"], doc.get("max_total_seconds", 0.0))
+
+    report = []
+    for (config_id, kind, model, period), row in sorted(rows.items(), key=lambda item: (item[0][3] or "", item[0][:3])):
+        requests = row["requests"]
+        report.append({
+            "config_id": config_id,
+            "kind": kind,
+            "model": model,
+            "period": period,
+            **{field: row[field] for field in SUMMED_FIELDS if not field.endswith("_seconds")},
+            "total_tokens": row["input_tokens"] + row["output_tokens"] + row["embedding_tokens"],
+            "avg_seconds": row["total_seconds"] / requests if requests else None,
+            "avg_llm_seconds": row["llm_total_seconds"] / requests if requests else None,
+            "avg_first_token_seconds": row["llm_first_token_seconds"] / requests if requests else None,
+            "p95_seconds": latency_percentile(row["latency"], requests, 0.95),
+            "max_seconds": row["max_total_seconds"],
+        })
+    return report
+
+def default_usage_range(now: datetime = None, days: int = 7):
+    now = now or datetime.now(timezone.utc)
+    return now - timedelta(days=days), now
@@ -0,0 +1,609 @@
+import array
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+import bson
+
+from src.utils.deadline import DeadlineExceeded, stage_timeout
+from src.utils.metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# --- Two-level cache ---
+# An in-process LRU (per worker, microseconds) in front of an optional shared store that all
+# workers and nodes see (Redis via CACHE_REDIS_URL), so a restarted or newly added worker starts
+# warm. Values are stored in the shared tier in compact binary form: float32 arrays for vectors,
+# BSON for documents.
+#
+# Keys are namespaced ("rag:<cache>:<key>"), and everything derived from a config carries one of
+# the config's version counters in its key; bump_config_version() and bump_content_version() move
+# a config to a fresh key space, so stale entries are never read again and simply expire. Without
+# a shared store the counters are per worker, and other workers see a change once their local
+# entries expire (CACHE_LOCAL_TTL).
+#
+# Stampede protection: concurrent misses of one key in a worker wait for a single load, and across
+# workers the first one takes a short lock in the shared store while the others poll for its result.
+# Only misses of the same key wait for each other, and never longer than the request's deadline
+# allows for the stage (src/utils/deadline.py).
+#
+# Environment:
+#   CACHE_ENABLED         'false' turns every cache off (default true)
+#   CACHE_REDIS_URL       shared tier, e.g. redis://cache:6379/0 (needs the redis package)
+#   CACHE_SHARED          'local' uses an in-process stand-in for the shared tier (tests, benchmarks)
+#   CACHE_LOCAL_TTL       seconds entries live in the in-process tier (default 60)
+#   CACHE_SHARED_TTL      seconds entries live in the shared tier (default 3600)
+#   CACHE_VERSION_TTL     seconds a worker trusts a config version read from the shared tier (default 1)
+#   CACHE_RETRIEVAL_MAX_BYTES  in-process budget of the retrieval cache (default 8 MiB)
+#   CACHE_CHUNK_MAX_BYTES      in-process budget of the chunks retrievals refer to (default 64 MiB)
+
+KEY_PREFIX = "rag"
+LOCK_TTL_SECONDS = 10
+LOCK_WAIT_SECONDS = 2.0
+LOCK_POLL_SECONDS = 0.02
+
+class CacheSettings:
+    def __init__(self):
+        self.enabled = os.getenv("CACHE_ENABLED", "true").lower() in ['true', '1', 't']
+        self.local_ttl = float(os.getenv("CACHE_LOCAL_TTL", 60))
+        self.shared_ttl = int(os.getenv("CACHE_SHARED_TTL", 3600))
+        self.version_ttl = float(os.getenv("CACHE_VERSION_TTL", 1))
+        self.retrieval_max_bytes = int(os.getenv("CACHE_RETRIEVAL_MAX_BYTES", 8 * 1024 * 1024))
+        self.chunk_max_bytes = int(os.getenv("CACHE_CHUNK_MAX_BYTES", 64 * 1024 * 1024))
+
+SETTINGS = CacheSettings()
+
+def query_hash(text: str) -> str:
+    """Hash of a normalized query (case and whitespace do not change the retrieval)."""
+    return hashlib.sha1(" ".join(text.lower().split()).encode("utf-8")).hexdigest()
+
+# --- Tiers ---
+
+class LRUCache:
+    """
+    Thread-safe LRU with a per-entry TTL. With `max_bytes`, it also evicts to keep the total
+    `size(value)` of its entries within that budget.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, max_bytes: int = None, size=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = size if max_bytes else None
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (found, value)."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return False, None
+            expires, value, _ = entry
+            if expires < time.monotonic():
+                self._remove(key)
+                return False, None
+            self._entries.move_to_end(key)
+            return True, value
+
+    def set(self, key, value):
+        size = self.size(value) if self.size else 0
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, value, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+class LocalSharedStore:
+    """In-process stand-in for the shared tier with the same interface as RedisStore."""
+
+    def __init__(self):
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        entry = self._values.get(key)
+        if entry and entry[0] is not None and entry[0] < time.monotonic():
+            del self._values[key]
+            return None
+        return entry
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._live(key)
+            return entry[1] if entry else None
+
+    def get_many(self, keys: list) -> list:
+        with self._lock:
+            return [entry[1] if entry else None for entry in map(self._live, keys)]
+
+    def set(self, key: str, value: bytes, ttl: int):
+        with self._lock:
+            self._values[key] = (time.monotonic() + ttl, value)
+
+    def set_many(self, values: dict, ttl: int):
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = (time.monotonic() + ttl, value)
+
+    def set_if_absent(self, key: str, value: bytes, ttl: int) -> bool:
+        with self._lock:
+            if self._live(key):
+                return False
+            self._values[key] = (time.monotonic() + ttl, value)
+            return True
+
+    def incr(self, key: str) -> int:
+        with self._lock:
+            entry = self._live(key)
+            value = int(entry[1]) + 1 if entry else 1
+            self._values[key] = (None, str(value).encode())
+            return value
+
+    def delete(self, key: str):
+        with self._lock:
+            self._values.pop(key, None)
+
+class RedisStore:
+    """The shared tier on Redis. Errors are logged and treated as misses, so a Redis outage only costs hit rate."""
+
+    def __init__(self, url: str):
+        import redis
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+    def get(self, key: str):
+        return self.client.get(key)
+
+    def get_many(self, keys: list) -> list:
+        return self.client.mget(keys)
+
+    def set(self, key: str, value: bytes, ttl: int):
+        self.client.set(key, value, ex=ttl)
+
+    def set_many(self, values: dict, ttl: int):
+        pipeline = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipeline.set(key, value, ex=ttl)
+        pipeline.execute()
+
+    def set_if_absent(self, key: str, value: bytes, ttl: int) -> bool:
+        return bool(self.client.set(key, value, ex=ttl, nx=True))
+
+    def incr(self, key: str) -> int:
+        return int(self.client.incr(key))
+
+    def delete(self, key: str):
+        self.client.delete(key)
+
+_shared_store = None
+
+def configure_cache():
+    """Creates the shared tier for the current process (after fork, like the other clients; see src/backend/resources.py)."""
+    global _shared_store
+    url = os.getenv("CACHE_REDIS_URL")
+    if url:
+        _shared_store = RedisStore(url)
+        logger.info("Shared cache tier: Redis")
+    elif os.getenv("CACHE_SHARED") == "local":
+        _shared_store = LocalSharedStore()
+    else:
+        _shared_store = None
+    CONFIG_VERSIONS.clear()
+    CONTENT_VERSIONS.clear()
+    for cache in CACHES.values():
+        cache.local.clear()
+
+def shared_store():
+    return _shared_store
+
+# --- Codecs ---
+
+class VectorCodec:
+    """Embedding vectors as float32 arrays: 4 bytes per dimension."""
+
+    @staticmethod
+    def encode(vector) -> bytes:
+        return array.array("f", vector).tobytes()
+
+    @staticmethod
+    def decode(data: bytes):
+        values = array.array("f")
+        values.frombytes(data)
+        return values.tolist()
+
+class BsonCodec:
+    """Documents (dicts, lists) as BSON, which keeps ObjectIds and datetimes as they are."""
+
+    @staticmethod
+    def encode(value) -> bytes:
+        return bson.encode({"v": value})
+
+    @staticmethod
+    def decode(data: bytes):
+        return bson.decode(data)["v"]
+
+# --- Config versions ---
+# Two counters per config: its version, which every write to the config bumps, and its content
+# version, which only changes of its chunks in vector_collection bump (an upload, a re-embedding
+# switch, the deletion of the config). Retrievals are keyed by the content version, so editing a
+# config's prompt or model keeps its cached retrievals.
+#
+# While a config's version cannot be read from the shared tier, config_key() and content_key()
+# return None and the caches load around themselves for it. A bump that fails is retried by the
+# worker before it uses the config's version again, and the config stays uncached until it succeeds.
+
+class VersionCounter:
+    """Per-config version counters in the shared tier (or in this worker without one)."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._versions = LRUCache(max_entries=100_000, ttl=SETTINGS.version_ttl)
+        self._local_counters = {}
+        self._local_lock = threading.Lock()
+        self._unbumped = set()  # configs whose last bump failed
+
+    def key(self, config_id: str) -> str:
+        return f"{KEY_PREFIX}:{self.name}:{config_id}"
+
+    def current(self, config_id: str) -> Optional[int]:
+        """
+        The current value for a config (read from the shared tier at most every CACHE_VERSION_TTL),
+        or None if the shared tier cannot be read or a bump of the config is still pending.
+        """
+        store = shared_store()
+        if store is None:
+            return self._local_counters.get(config_id, 0)
+        if config_id in self._unbumped:
+            self.bump(config_id)
+            if config_id in self._unbumped:
+                return None
+        found, version = self._versions.get(config_id)
+        if found:
+            return version
+        try:
+            data = store.get(self.key(config_id))
+            version = int(data) if data else 0
+        except Exception as e:
+            logger.warning(f"Could not read the cache {self.name} of config {config_id}: {e}")
+            return None
+        self._versions.set(config_id, version)
+        return version
+
+    def bump(self, config_id: str):
+        if not SETTINGS.enabled:
+            return
+        store = shared_store()
+        if store is None:
+            with self._local_lock:
+                self._local_counters[config_id] = self._local_counters.get(config_id, 0) + 1
+            return
+        try:
+            self._versions.set(config_id, store.incr(self.key(config_id)))
+            self._unbumped.discard(config_id)
+        except Exception as e:
+            logger.error(f"Could not bump the cache {self.name} of config {config_id}: {e}")
+            self._versions.delete(config_id)
+            self._unbumped.add(config_id)
+
+    def clear(self):
+        self._versions.clear()
+
+CONFIG_VERSIONS = VersionCounter("version")
+CONTENT_VERSIONS = VersionCounter("content")
+
+def config_version(config_id: str) -> Optional[int]:
+    return CONFIG_VERSIONS.current(str(config_id))
+
+def content_version(config_id: str) -> Optional[int]:
+    return CONTENT_VERSIONS.current(str(config_id))
+
+def bump_config_version(config_id: str):
+    """Invalidates what is cached from a config's document, in every worker sharing the store."""
+    CONFIG_VERSIONS.bump(str(config_id))
+
+def bump_content_version(config_id: str):
+    """Invalidates what is cached from a config's chunks (retrievals), in every worker sharing the store."""
+    CONTENT_VERSIONS.bump(str(config_id))
+
+def config_key(config_id: str, *parts) -> Optional[str]:
+    """A cache key in the current key space of a config, or None while its version is unknown (do not cache)."""
+    version = config_version(config_id)
+    if version is None:
+        return None
+    return ":".join([str(config_id), f"v{version}", *map(str, parts)])
+
+def content_key(config_id: str, *parts) -> Optional[str]:
+    """A cache key in the current key space of a config's chunks, or None while its version is unknown (do not cache)."""
+    version = content_version(config_id)
+    if version is None:
+        return None
+    return ":".join([str(config_id), f"c{version}", *map(str, parts)])
+
+# --- Caches ---
+
+class Load:
+    """A load of one key in progress in this worker; `done` is set when it has finished, successfully or not."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.succeeded = False
+        self.value = None
+
+    def finish(self, value):
+        self.value = value
+        self.succeeded = True
+
+class TwoLevelCache:
+    """
+    A named cache over the in-process LRU and the shared tier. get_or_load() returns the cached
+    value or calls `loader`; a loader result of None is returned but not cached, and a key of None
+    (config_key() of a config whose version is unknown) just calls `loader`. Values from the
+    in-process tier are shared between requests and must not be modified. With `local_max_bytes`,
+    the in-process tier also evicts to keep the encoded size of its values within that budget.
+    """
+
+    def __init__(self, name: str, codec, local_entries: int, local_ttl: float = None, shared_ttl: int = None,
+                 local_max_bytes: int = None):
+        self.name = name
+        self.codec = codec
+        self.local = LRUCache(local_entries, local_ttl or SETTINGS.local_ttl, max_bytes=local_max_bytes, size=lambda value: len(codec.encode(value)))
+        self.shared_ttl = shared_ttl or SETTINGS.shared_ttl
+        # full key -> the load running in this worker, from a thread (Load) or on the event loop (future)
+        self._loads = {}
+        self._loads_lock = threading.Lock()
+        self._inflight = {}
+
+    def _key(self, key: str) -> str:
+        return f"{KEY_PREFIX}:{self.name}:{key}"
+
+    def _record(self, tier: str, result: str):
+        CACHE_REQUESTS.inc(cache=self.name, tier=tier, result=result)
+
+    def _local_get(self, full_key: str):
+        found, value = self.local.get(full_key)
+        self._record("local", "hit" if found else "miss")
+        return found, value
+
+    def _shared_get(self, store, full_key: str):
+        try:
+            data = store.get(full_key)
+        except Exception as e:
+            logger.warning(f"Shared cache read failed ({self.name}): {e}")
+            self._record("shared", "error")
+            return False, None
+        if data is None:
+            self._record("shared", "miss")
+            return False, None
+        self._record("shared", "hit")
+        value = self.codec.decode(data)
+        self.local.set(full_key, value)
+        return True, value
+
+    def _store(self, store, full_key: str, value):
+        self.local.set(full_key, value)
+        if store is not None:
+            try:
+                store.set(full_key, self.codec.encode(value), self.shared_ttl)
+            except Exception as e:
+                logger.warning(f"Shared cache write failed ({self.name}): {e}")
+                self._record("shared", "error")
+
+    def _shared_get_many(self, store, keys: list) -> dict:
+        full_keys = [self._key(key) for key in keys]
+        try:
+            data = store.get_many(full_keys)
+        except Exception as e:
+            logger.warning(f"Shared cache read failed ({self.name}): {e}")
+            self._record("shared", "error")
+            return {}
+        found = {}
+        for key, full_key, value in zip(keys, full_keys, data):
+            self._record("shared", "miss" if value is None else "hit")
+            if value is not None:
+                found[key] = self.codec.decode(value)
+                self.local.set(full_key, found[key])
+        return found
+
+    def _shared_set_many(self, store, values: dict):
+        try:
+            store.set_many({self._key(key): self.codec.encode(value) for key, value in values.items()}, self.shared_ttl)
+        except Exception as e:
+            logger.warning(f"Shared cache write failed ({self.name}): {e}")
+            self._record("shared", "error")
+
+    def _local_get_many(self, keys: list):
+        """The values of `keys` found in the in-process tier, and the keys that were not."""
+        found, missing = {}, []
+        for key in keys:
+            hit, value = self._local_get(self._key(key))
+            if hit:
+                found[key] = value
+            else:
+                missing.append(key)
+        return found, missing
+
+    def get_many(self, keys: list) -> dict:
+        """The cached values of `keys`, by key; keys that are not cached are left out. One shared tier read for all of them."""
+        if not SETTINGS.enabled:
+            return {}
+        found, missing = self._local_get_many(keys)
+        store = shared_store()
+        if missing and store is not None:
+            found.update(self._shared_get_many(store, missing))
+        return found
+
+    async def aget_many(self, keys: list) -> dict:
+        if not SETTINGS.enabled:
+            return {}
+        found, missing = self._local_get_many(keys)
+        store = shared_store()
+        if missing and store is not None:
+            found.update(await asyncio.to_thread(self._shared_get_many, store, missing))
+        return found
+
+    def set_many(self, values: dict):
+        """Caches several values at once, with one shared tier write."""
+        if not SETTINGS.enabled or not values:
+            return
+        for key, value in values.items():
+            self.local.set(self._key(key), value)
+        store = shared_store()
+        if store is not None:
+            self._shared_set_many(store, values)
+
+    async def aset_many(self, values: dict):
+        if not SETTINGS.enabled or not values:
+            return
+        for key, value in values.items():
+            self.local.set(self._key(key), value)
+        store = shared_store()
+        if store is not None:
+            await asyncio.to_thread(self._shared_set_many, store, values)
+
+    def get_or_load(self, key: str, loader, stage: str = None):
+        """
+        The cached value of `key`, or loader()'s. A miss while another thread loads the key waits
+        for that load, for at most what the current deadline leaves `stage`; DeadlineExceeded then.
+        """
+        if not SETTINGS.enabled or key is None:
+            return loader()
+        full_key = self._key(key)
+        found, value = self._local_get(full_key)
+        if found:
+            return value
+        store = shared_store()
+        if store is not None:
+            found, value = self._shared_get(store, full_key)
+            if found:
+                return value
+
+        # One load per key in this worker; the others wait for it and take its result
+        while True:
+            with self._loads_lock:
+                load = self._loads.get(full_key)
+                owner = load is None
+                if owner:
+                    load = self._loads[full_key] = Load()
+            if owner:
+                break
+            if not load.done.wait(stage_timeout(stage)):
+                raise DeadlineExceeded(stage or "cache_wait")
+            if load.succeeded:
+                return load.value
+            # the load failed: load here
+
+        try:
+            found, value = self.local.get(full_key)
+            if found:
+                load.finish(value)
+                return value
+            lock_key = None
+            if store is not None:
+                lock_key = self._wait_for_other_worker(store, full_key, stage)
+                if lock_key is None:
+                    found, value = self.local.get(full_key)
+                    if found:
+                        load.finish(value)
+                        return value
+            try:
+                value = loader()
+                if value is not None:
+                    self._store(store, full_key, value)
+                load.finish(value)
+                return value
+            finally:
+                if lock_key:
+                    try:
+                        store.delete(lock_key)
+                    except Exception:
+                        pass
+        finally:
+            with self._loads_lock:
+                self._loads.pop(full_key, None)
+            load.done.set()
+
+    def _wait_for_other_worker(self, store, full_key: str, stage: str = None):
+        """Takes the cross-worker load lock, or waits for the holder's result. Returns the lock key if taken."""
+        lock_key = f"{full_key}:lock"
+        timeout = stage_timeout(stage)
+        wait_seconds = LOCK_WAIT_SECONDS if timeout is None else min(LOCK_WAIT_SECONDS, timeout)
+        try:
+            if store.set_if_absent(lock_key, b"1", LOCK_TTL_SECONDS):
+                return lock_key
+            deadline = time.monotonic() + wait_seconds
+            while time.monotonic() < deadline:
+                time.sleep(LOCK_POLL_SECONDS)
+                data = store.get(full_key)
+                if data is not None:
+                    self.local.set(full_key, self.codec.decode(data))
+                    return None
+        except Exception as e:
+            logger.warning(f"Shared cache lock failed ({self.name}): {e}")
+        return None  # the holder is slow or gone: load without the lock
+
+    async def aget_or_load(self, key: str, loader):
+        """Async get_or_load(): `loader` is a coroutine function, and the shared tier is read off the event loop."""
+        if not SETTINGS.enabled or key is None:
+            return await loader()
+        full_key = self._key(key)
+        found, value = self._local_get(full_key)
+        if found:
+            return value
+        inflight = self._inflight.get(full_key)
+        if inflight is not None and not inflight.done():
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                if not inflight.cancelled():
+                    raise  # this request was cancelled, not the load
+            # the load failed or was cancelled with its request: load here
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[full_key] = future
+        try:
+            store = shared_store()
+            if store is not None:
+                found, value = await asyncio.to_thread(self._shared_get, store, full_key)
+            if not found:
+                value = await loader()
+                if value is not None:
+                    if store is not None:
+                        await asyncio.to_thread(self._store, store, full_key, value)
+                    else:
+                        self.local.set(full_key, value)
+            future.set_result(value)
+            return value
+        except BaseException:
+            future.cancel()
+            raise
+        finally:
+            self._inflight.pop(full_key, None)
+
+CACHES = {}
+
+def two_level_cache(name: str, codec, local_entries: int, local_ttl: float = None, shared_ttl: int = None,
+                    local_max_bytes: int = None) -> TwoLevelCache:
+    return CACHES.setdefault(name, TwoLevelCache(name, codec, local_entries, local_ttl, shared_ttl, local_max_bytes))
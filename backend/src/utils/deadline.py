@@ -0,0 +1,260 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import socket
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Optional
+from pymongo.errors import ExecutionTimeout
+
+from src.utils.metrics import CHAT_ABANDONED
+
+logger = logging.getLogger(__name__)
+
+# --- Request deadlines ---
+# A chat turn gets a deadline when it arrives: the X-Request-Timeout header (seconds), else the
+# config's `deadline_seconds`, else CHAT_DEADLINE, never more than CHAT_MAX_DEADLINE. The deadline
+# is carried in a context variable, so the config lookup, query embedding, vector search, the
+# scheduler wait and the LLM call all see it without threading it through every signature.
+#
+# Each stage runs with the smaller of the time left and its own budget (CHAT_STAGE_BUDGETS), so a
+# slow stage fails the turn early instead of eating the time of the ones after it. Mongo reads get
+# the budget as maxTimeMS, provider calls as their request timeout, awaited stages are cancelled,
+# and the LLM stream is checked between chunks. Once the deadline passes or the client has gone
+# away the provider stream is closed, which drops the connection and stops the generation, and
+# nothing is written to the history.
+
+DEADLINE_HEADER = "X-Request-Timeout"
+DEFAULT_DEADLINE = float(os.getenv("CHAT_DEADLINE", 120))
+# Under the nginx proxy_read_timeout (300s), so a turn ends before the proxy gives up on it
+MAX_DEADLINE = float(os.getenv("CHAT_MAX_DEADLINE", 290))
+DEFAULT_STAGE_BUDGETS = {"config_lookup": 2.0, "embedding": 10.0, "vector_search": 5.0, "llm_first_token": 60.0}
+DISCONNECT_CHECK_INTERVAL = 0.5
+
+def load_stage_budgets() -> dict:
+    raw = os.getenv("CHAT_STAGE_BUDGETS")
+    if not raw:
+        return dict(DEFAULT_STAGE_BUDGETS)
+    try:
+        return {**DEFAULT_STAGE_BUDGETS, **{stage: float(seconds) for stage, seconds in json.loads(raw).items()}}
+    except (ValueError, AttributeError) as e:
+        raise ValueError(f"CHAT_STAGE_BUDGETS is not a JSON object of seconds per stage: {e}") from e
+
+STAGE_BUDGETS = load_stage_budgets()
+
+class RequestAbandoned(Exception):
+    """A chat turn stopped before it completed; `stage` is where it was stopped."""
+
+    reason = None
+    status = None
+
+    def __init__(self, stage: str):
+        super().__init__(f"{self.reason} during {stage}")
+        self.stage = stage
+
+class DeadlineExceeded(RequestAbandoned):
+    reason = "deadline"
+    status = 504
+
+class ClientDisconnected(RequestAbandoned):
+    reason = "disconnected"
+    # nginx's status for a request the client closed; nobody receives the response
+    status = 499
+
+def parse_seconds(value) -> Optional[float]:
+    """A timeout in seconds from a header or config value, capped at MAX_DEADLINE; None if unusable."""
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not seconds > 0:
+        return None
+    return min(seconds, MAX_DEADLINE)
+
+class Deadline:
+    """
+    The deadline of one request. `disconnected` (a function) or `adisconnected` (a coroutine
+    function) tells whether the client has gone away; cancel() marks it gone.
+    """
+
+    def __init__(self, seconds: float, source: str = "default", budgets: dict = None,
+                 disconnected: Callable[[], bool] = None, adisconnected: Callable[[], Awaitable[bool]] = None):
+        self.started = time.monotonic()
+        self.expires_at = self.started + seconds
+        self.source = source
+        self.budgets = STAGE_BUDGETS if budgets is None else budgets
+        self.disconnected = disconnected
+        self.adisconnected = adisconnected
+        self.cancelled = False
+        self._checked = 0.0
+
+    @staticmethod
+    def from_header(value, **kwargs) -> "Deadline":
+        seconds = parse_seconds(value)
+        if seconds is None:
+            return Deadline(DEFAULT_DEADLINE, "default", **kwargs)
+        return Deadline(seconds, "header", **kwargs)
+
+    def apply_config(self, config_document: dict):
+        """Uses the config's deadline_seconds, unless the client asked for its own deadline."""
+        seconds = parse_seconds(config_document.get("deadline_seconds"))
+        if seconds is not None and self.source == "default":
+            self.expires_at = self.started + seconds
+            self.source = "config"
+
+    def ignore_disconnect(self):
+        """Keeps the request running if its client goes away (e.g. its answer is kept for a retry)."""
+        self.disconnected = None
+        self.adisconnected = None
+
+    def remaining(self) -> float:
+        return self.expires_at - time.monotonic()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def client_gone(self) -> bool:
+        """Whether the client has gone away; polls `disconnected` at most every DISCONNECT_CHECK_INTERVAL."""
+        if not self.cancelled and self.disconnected is not None:
+            now = time.monotonic()
+            if now - self._checked >= DISCONNECT_CHECK_INTERVAL:
+                self._checked = now
+                self.cancelled = self.disconnected()
+        return self.cancelled
+
+    def check(self, stage: str):
+        if self.client_gone():
+            raise ClientDisconnected(stage)
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(stage)
+
+    def timeout(self, stage: str) -> float:
+        """Seconds `stage` may take: the time left, capped by the stage's budget."""
+        self.check(stage)
+        budget = self.budgets.get(stage)
+        return min(self.remaining(), budget) if budget else self.remaining()
+
+    async def _watch(self):
+        while not await self.adisconnected():
+            await asyncio.sleep(DISCONNECT_CHECK_INTERVAL)
+        self.cancel()
+
+    async def run(self, stage: str, awaitable):
+        """Awaits `awaitable` within the stage's time, cancelling it when the time is up or the client goes away."""
+        task = asyncio.ensure_future(awaitable)
+        try:
+            timeout = self.timeout(stage)
+        except RequestAbandoned:
+            task.cancel()
+            raise
+        watcher = asyncio.create_task(self._watch()) if self.adisconnected is not None else None
+        try:
+            done, _ = await asyncio.wait({task, watcher} - {None}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+        if task in done:
+            try:
+                return task.result()
+            except ExecutionTimeout:
+                raise DeadlineExceeded(stage)
+        task.cancel()
+        if self.cancelled:
+            raise ClientDisconnected(stage)
+        raise DeadlineExceeded(stage)
+
+# --- The current request's deadline ---
+
+deadline_var = contextvars.ContextVar("deadline", default=None)
+
+def set_deadline(deadline: Optional[Deadline]):
+    """Sets the deadline of the current request (thread or task); None clears it."""
+    deadline_var.set(deadline)
+
+def current_deadline() -> Optional[Deadline]:
+    return deadline_var.get()
+
+def check_deadline(stage: str):
+    deadline = current_deadline()
+    if deadline is not None:
+        deadline.check(stage)
+
+def stage_timeout(stage: str) -> Optional[float]:
+    """The seconds `stage` may take under the current deadline, or None without one."""
+    deadline = current_deadline()
+    return deadline.timeout(stage) if deadline is not None else None
+
+def mongo_max_time_ms(stage: str) -> Optional[int]:
+    """The max_time_ms of a Mongo query of `stage`, or None without a deadline."""
+    timeout = stage_timeout(stage)
+    return max(1, int(timeout * 1000)) if timeout is not None else None
+
+def mongo_time_limit(stage: str) -> dict:
+    """maxTimeMS for a Mongo command of `stage`, as keyword arguments ({} without a deadline)."""
+    max_time_ms = mongo_max_time_ms(stage)
+    return {"maxTimeMS": max_time_ms} if max_time_ms is not None else {}
+
+@contextmanager
+def deadline_stage(stage: str):
+    """
+    Runs a blocking stage that cannot be interrupted from the outside: fails before it starts if no
+    time is left, and after it returns if the deadline passed or the client went away meanwhile.
+    A Mongo query stopped by its maxTimeMS counts as the deadline passing.
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        yield
+        return
+    deadline.timeout(stage)
+    try:
+        yield
+    except ExecutionTimeout:
+        raise DeadlineExceeded(stage)
+    deadline.check(stage)
+
+async def within_deadline(stage: str, awaitable):
+    """Awaits `awaitable` under the current deadline (Deadline.run), or plainly without one."""
+    deadline = current_deadline()
+    if deadline is None:
+        return await awaitable
+    return await deadline.run(stage, awaitable)
+
+def wsgi_disconnected(environ) -> Callable[[], bool]:
+    """
+    A `disconnected` check for a WSGI request served by gunicorn: peeks at the client socket,
+    which reads as closed once the client (or nginx, on its proxy_read_timeout) has hung up.
+    Without access to the socket it always answers False.
+    """
+    sock = environ.get("gunicorn.socket")
+
+    def disconnected() -> bool:
+        if sock is None:
+            return False
+        try:
+            return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+        except (BlockingIOError, InterruptedError):
+            return False
+        except ValueError:
+            # TLS sockets do not support recv flags
+            return False
+        except OSError:
+            return True
+
+    return disconnected
+
+def record_abandoned(config_id: str, error: RequestAbandoned):
+    """Counts and logs a chat turn stopped by `error`."""
+    CHAT_ABANDONED.inc(config_id=config_id, reason=error.reason, stage=error.stage)
+    logger.warning(f"Chat turn for config {config_id} stopped: {error}")
+
+def abandoned_body(config_id: str, error: RequestAbandoned) -> dict:
+    """Records a chat turn stopped by `error` and returns the body of its response."""
+    record_abandoned(config_id, error)
+    if isinstance(error, ClientDisconnected):
+        return {"message": "The client disconnected.", "stage": error.stage}
+    return {"message": "The request did not complete within its deadline.", "stage": error.stage}
@@ -0,0 +1,172 @@
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import uuid
+from datetime import datetime, timezone
+
+# --- Logging setup ---
+# Request threads only put records on an in-memory queue. A QueueListener thread formats them
+# (JSON by default) and does the actual I/O, so a log call on the hot path costs microseconds
+# and never waits on the terminal or disk. When the queue is full, records are dropped, not waited on.
+#
+# Environment:
+#   LOG_LEVEL         root level (default INFO)
+#   LOG_FORMAT        'json' (default) or 'text'
+#   LOG_QUEUE_SIZE    maximum queued records (default 10000)
+#   LOG_SAMPLE_RATES  'logger=rate,...' enables DEBUG payload logging for these loggers, keeping
+#                     only that fraction of their DEBUG records, e.g. 'src.services.chat_service=0.01'
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+
+# Attributes every LogRecord has; anything else on a record came from `extra=` and is logged as a field
+STANDARD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "request_id"}
+
+def set_request_id(value: str = None) -> str:
+    """Sets the correlation id of the current request (thread or task) and returns it."""
+    request_id = value or uuid.uuid4().hex
+    request_id_var.set(request_id)
+    return request_id
+
+def get_request_id():
+    return request_id_var.get()
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: timestamp, level, logger, message, request_id, extra fields, exception."""
+
+    def format(self, record):
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s - %(levelname)s - [%(request_id)s] %(name)s - %(message)s')
+
+class RequestIdFilter(logging.Filter):
+    """Stamps records with the current request id. Runs in the caller's thread, where the request context lives."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a fraction of the DEBUG records of the configured loggers (and their children)."""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = rates
+
+    def rate_for(self, name: str):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition(".")[0]
+        return None
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        rate = self.rate_for(record.name)
+        return rate is None or random.random() < rate
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking or raising when the queue is full."""
+
+    dropped = 0
+
+    def prepare(self, record):
+        # Resolve the message and the traceback on the caller's side (the listener runs later, in
+        # another thread), but leave the formatting to the listener's handler.
+        record.message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.message
+        record.args = None
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            NonBlockingQueueHandler.dropped += 1
+
+def parse_sample_rates(value: str) -> dict:
+    rates = {}
+    for entry in filter(None, (part.strip() for part in value.split(","))):
+        name, _, rate = entry.partition("=")
+        rates[name.strip()] = float(rate) if rate else 1.0
+    return rates
+
+_queue_handler = None
+_queue_pid = None
+_listener = None
+
+def configure_logging():
+    """Routes all logging through the queue handler. Call start_log_listener() in every process that logs."""
+    global _queue_handler, _queue_pid
+    root = logging.getLogger()
+    root.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+
+    rates = parse_sample_rates(os.getenv("LOG_SAMPLE_RATES", ""))
+    for name in rates:
+        logging.getLogger(name).setLevel(logging.DEBUG)
+
+    if _queue_handler is None:
+        _queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=int(os.getenv("LOG_QUEUE_SIZE", 10000))))
+        _queue_pid = os.getpid()
+    _queue_handler.filters = [SamplingFilter(rates), RequestIdFilter()]
+
+    for handler in list(root.handlers):
+        if handler is not _queue_handler:
+            root.removeHandler(handler)
+    if _queue_handler not in root.handlers:
+        root.addHandler(_queue_handler)
+    return _queue_handler
+
+def start_log_listener():
+    """
+    Starts the thread that writes the queued records. Listener threads do not survive fork(), so
+    under gunicorn with preload_app this runs in every worker (src/backend/resources.py). A forked
+    worker gets a fresh queue, so records queued in the parent are not written once per worker.
+    """
+    global _listener, _queue_pid
+    handler = _queue_handler or configure_logging()
+    if _queue_pid != os.getpid():
+        handler.queue = queue.Queue(maxsize=handler.queue.maxsize)
+        _queue_pid = os.getpid()
+        _listener = None
+    if _listener is not None:
+        return _listener
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(TextFormatter() if os.getenv("LOG_FORMAT", "json") == "text" else JsonFormatter())
+    _listener = logging.handlers.QueueListener(handler.queue, output, respect_handler_level=False)
+    _listener.start()
+    atexit.register(stop_log_listener)
+    return _listener
+
+def stop_log_listener():
+    """Flushes the queued records and stops the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,304 @@
+import bisect
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# --- In-process metrics ---
+# Counters, gauges and histograms rendered in the Prometheus text format on /metrics (app.py).
+# Recording an observation is a bisect and a few additions under a per-metric lock, so the
+# instrumentation stays on permanently. Each worker process keeps its own registry, so a scrape
+# through a multi-worker gunicorn reports the worker that served it (see DEPLOYMENT.md).
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Label sets beyond this many per metric are folded into one "other" series, so per-config
+# labels cannot grow a worker's memory without bound.
+MAX_SERIES = 5000
+OVERFLOW_LABEL = "other"
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels.items()) + "}"
+
+class Metric:
+    TYPE = None
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict):
+        key = tuple(labels.get(name, "") for name in self.labelnames)
+        if key not in self._series and len(self._series) >= MAX_SERIES:
+            key = tuple(OVERFLOW_LABEL for _ in self.labelnames)
+        return key
+
+    def _labels(self, key, **extra) -> str:
+        return format_labels({**dict(zip(self.labelnames, key)), **extra})
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            series = list(self._series.items())
+        for key, value in series:
+            lines.extend(self._render_series(key, value))
+        return lines
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def _render_series(self, key, value):
+        return [f"{self.name}{self._labels(key)} {format_value(value)}"]
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def _render_series(self, key, value):
+        return [f"{self.name}{self._labels(key)} {format_value(value)}"]
+
+class Histogram(Metric):
+    TYPE = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(labels)
+            series = self._series.get(key)
+            if series is None:
+                # [per-bucket counts..., sum, count]
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def _render_series(self, key, value):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, value):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{self._labels(key, le=format_value(bound))} {cumulative}")
+        lines.append(f"{self.name}_sum{self._labels(key)} {format_value(value[-2])}")
+        lines.append(f"{self.name}_count{self._labels(key)} {value[-1]}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+def counter(name: str, documentation: str, labelnames=()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+def gauge(name: str, documentation: str, labelnames=()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+def histogram(name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+class StageTimer:
+    """
+    Collects the stage durations of one request and records them when the request finishes,
+    so every stage is tagged with the final labels (e.g. the model_name, known only after the
+    config lookup). Stages may overlap, as they do in the async chat pipeline.
+    `on_finish` functions are called with the timer and the status once it has finished.
+    """
+
+    def __init__(self, stage_histogram: Histogram, request_counter: Counter = None, **labels):
+        self.stage_histogram = stage_histogram
+        self.request_counter = request_counter
+        self.labels = labels
+        self.durations = {}
+        self.on_finish = []
+        self.started = time.perf_counter()
+
+    def observe(self, stage: str, seconds: float):
+        self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    async def measure(self, name: str, awaitable):
+        """Awaits `awaitable` and records its duration under `name`."""
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def since_start(self) -> float:
+        return time.perf_counter() - self.started
+
+    def finish(self, status: str = "ok"):
+        self.observe("total", self.since_start())
+        for stage, seconds in self.durations.items():
+            self.stage_histogram.observe(seconds, stage=stage, **self.labels)
+        if self.request_counter:
+            self.request_counter.inc(status=status, **self.labels)
+        for hook in self.on_finish:
+            try:
+                hook(self, status)
+            except Exception as e:
+                logger.error(f"Finishing a request's metrics failed: {e}", exc_info=True)
+
+# --- Application metrics ---
+
+CHAT_STAGE_SECONDS = histogram(
+    "rag_chat_stage_seconds",
+    "Time spent in each stage of a chat request.",
+    ("stage", "config_id", "model_name")
+)
+CHAT_REQUESTS = counter(
+    "rag_chat_requests_total",
+    "Chat requests by outcome.",
+    ("status", "config_id", "model_name")
+)
+INGEST_STAGE_SECONDS = histogram(
+    "rag_ingest_stage_seconds",
+    "Time spent in each stage of a document ingestion.",
+    ("stage", "config_id"),
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0)
+)
+INGEST_REQUESTS = counter(
+    "rag_ingest_requests_total",
+    "Document ingestions by outcome.",
+    ("status", "config_id")
+)
+INGEST_CHUNKS = counter(
+    "rag_ingest_chunks_total",
+    "Document chunks embedded and stored.",
+    ("config_id",)
+)
+REEMBED_CHUNKS = counter(
+    "rag_reembed_chunks_total",
+    "Chunks re-embedded by config embedding migrations.",
+    ("model",)
+)
+CACHE_REQUESTS = counter(
+    "rag_cache_requests_total",
+    "Cache lookups by cache, tier (local, shared) and result (hit, miss, stale, error).",
+    ("cache", "tier", "result")
+)
+HISTORY_CACHE_SESSIONS = gauge(
+    "rag_history_cache_sessions",
+    "Chat sessions whose history is held in the worker's history cache."
+)
+HISTORY_CACHE_BYTES = gauge(
+    "rag_history_cache_bytes",
+    "Approximate memory held by the worker's history cache."
+)
+ADMISSION_ACTIVE = gauge(
+    "rag_admission_active",
+    "Chat requests holding an admission slot."
+)
+ADMISSION_QUEUED = gauge(
+    "rag_admission_queued",
+    "Chat requests waiting for an admission slot."
+)
+ADMISSION_WAIT_SECONDS = histogram(
+    "rag_admission_wait_seconds",
+    "Time chat requests waited for an admission slot, by outcome (admitted, rejected, timeout).",
+    ("outcome",)
+)
+ADMISSION_REJECTED = counter(
+    "rag_admission_rejected_total",
+    "Chat requests turned away with a 429, by config and reason (queue_full, timeout).",
+    ("config_id", "reason")
+)
+LLM_SCHEDULER_QUEUED = gauge(
+    "rag_llm_scheduler_queued",
+    "Provider calls waiting for rate limit budget, by provider and priority.",
+    ("provider", "priority")
+)
+LLM_SCHEDULER_WAIT_SECONDS = histogram(
+    "rag_llm_scheduler_wait_seconds",
+    "Time provider calls waited for rate limit budget, by provider and priority.",
+    ("provider", "priority")
+)
+LLM_PROVIDER_RATE_LIMITED = counter(
+    "rag_llm_provider_rate_limited_total",
+    "Provider calls answered with a 429 despite the scheduler.",
+    ("provider",)
+)
+CHAT_ABANDONED = counter(
+    "rag_chat_abandoned_total",
+    "Chat turns stopped before completion, by reason (deadline, disconnected) and the stage they were stopped in.",
+    ("config_id", "reason", "stage")
+)
+LLM_TOKENS = counter(
+    "rag_llm_tokens_total",
+    "Provider tokens used by chat turns and ingestions, by model and type (input, output, embedding).",
+    ("model", "type")
+)
+USAGE_ROLLUP_FLUSHES = counter(
+    "rag_usage_rollup_flushes_total",
+    "Flushes of the usage rollups to MongoDB, by result (ok, error).",
+    ("result",)
+)
+IDEMPOTENT_REQUESTS = counter(
+    "rag_idempotent_requests_total",
+    "Chat submissions with an Idempotency-Key, by outcome (owner, replayed, attached, mismatch, in_progress).",
+    ("outcome",)
+)
+
+def chat_timer(config_id: str) -> StageTimer:
+    """StageTimer for a chat request; set timer.labels["model_name"] once the config is known."""
+    return StageTimer(CHAT_STAGE_SECONDS, CHAT_REQUESTS, config_id=config_id, model_name="")
+
+def ingest_timer(config_id: str) -> StageTimer:
+    return StageTimer(INGEST_STAGE_SECONDS, INGEST_REQUESTS, config_id=config_id)
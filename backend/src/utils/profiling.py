@@ -0,0 +1,206 @@
+import functools
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timezone
+from flask import Response, request
+from werkzeug.wsgi import ClosingIterator
+
+from src.utils.logging_setup import get_request_id
+
+logger = logging.getLogger(__name__)
+
+# --- On-demand request profiling ---
+# A request is profiled when it carries "X-Profile: <PROFILE_TOKEN>" or is picked by
+# PROFILE_SAMPLE_RATE. A sampler thread records the request thread's stack every
+# PROFILE_INTERVAL_MS (folded stacks, ready for flamegraph.pl or speedscope) and tracemalloc
+# reports the top allocations made meanwhile. Profiles are kept as JSON files in PROFILE_DIR,
+# at most PROFILE_MAX_FILES of them, and served by routes/profile_routes.py.
+#
+# A streamed response is profiled until the server closes its body, so the profile covers the
+# work done in its generator as well.
+#
+# With neither PROFILE_TOKEN nor PROFILE_SAMPLE_RATE set, the wrapper is a single attribute
+# check. At most PROFILE_MAX_CONCURRENT requests are profiled at a time; others run normally.
+
+PROFILE_HEADER = "X-Profile"
+TOP_ALLOCATIONS = 25
+
+class ProfilerSettings:
+    def __init__(self):
+        self.token = os.getenv("PROFILE_TOKEN")
+        self.sample_rate = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+        self.interval = float(os.getenv("PROFILE_INTERVAL_MS", 5)) / 1000
+        self.directory = os.getenv("PROFILE_DIR", "/tmp/rag_profiles")
+        self.max_files = int(os.getenv("PROFILE_MAX_FILES", 50))
+        self.enabled = bool(self.token) or self.sample_rate > 0
+        self.slots = threading.BoundedSemaphore(int(os.getenv("PROFILE_MAX_CONCURRENT", 2)))
+
+SETTINGS = ProfilerSettings()
+
+# tracemalloc is process-wide; it runs while at least one request is being profiled
+_tracemalloc_users = 0
+_tracemalloc_lock = threading.Lock()
+
+def acquire_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        if _tracemalloc_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracemalloc_users += 1
+
+def release_tracemalloc():
+    global _tracemalloc_users
+    with _tracemalloc_lock:
+        _tracemalloc_users -= 1
+        if _tracemalloc_users == 0:
+            tracemalloc.stop()
+
+def frame_label(frame) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+class StackSampler:
+    """Samples the stack of one thread from a background thread and counts the folded stacks."""
+
+    def __init__(self, thread_id: int, interval: float):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = {}
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(frame_label(frame))
+                frame = frame.f_back
+            stack = ";".join(reversed(labels))
+            self.stacks[stack] = self.stacks.get(stack, 0) + 1
+            self.samples += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+def should_profile() -> bool:
+    if SETTINGS.token and request.headers.get(PROFILE_HEADER) == SETTINGS.token:
+        return True
+    return SETTINGS.sample_rate > 0 and random.random() < SETTINGS.sample_rate
+
+def save_profile(profile: dict):
+    """Writes a profile and removes the oldest ones beyond PROFILE_MAX_FILES."""
+    os.makedirs(SETTINGS.directory, exist_ok=True)
+    path = os.path.join(SETTINGS.directory, f"{profile['id']}.json")
+    with open(path, "w") as f:
+        json.dump(profile, f)
+
+    files = sorted(
+        (os.path.join(SETTINGS.directory, name) for name in os.listdir(SETTINGS.directory) if name.endswith(".json")),
+        key=os.path.getmtime
+    )
+    for old in files[:-SETTINGS.max_files]:
+        try:
+            os.remove(old)
+        except OSError:
+            pass
+
+class RequestProfile:
+    """The stack sampler and allocation snapshots of one profiled request, from start() to finish()."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.method = request.method
+        self.path = request.path
+        self.request_id = get_request_id()
+        self.sampler = StackSampler(threading.get_ident(), SETTINGS.interval)
+
+    def start(self):
+        self.started_at = datetime.now(timezone.utc)
+        acquire_tracemalloc()
+        self.before = tracemalloc.take_snapshot()
+        self.sampler.start()
+        self.started = time.perf_counter()
+
+    def finish(self):
+        duration = time.perf_counter() - self.started
+        self.sampler.stop()
+        after = tracemalloc.take_snapshot()
+        release_tracemalloc()
+        try:
+            # Net allocations still alive at the end of the request. They are process-wide,
+            # so concurrent requests show up here as well.
+            own_frames = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+            allocations = after.filter_traces(own_frames).compare_to(self.before.filter_traces(own_frames), "lineno")[:TOP_ALLOCATIONS]
+            profile = {
+                "id": f"{self.started_at.strftime('%Y%m%dT%H%M%S')}-{self.name}-{uuid.uuid4().hex[:8]}",
+                "endpoint": self.name,
+                "method": self.method,
+                "path": self.path,
+                "request_id": self.request_id,
+                "started_at": self.started_at.isoformat(),
+                "duration_seconds": round(duration, 4),
+                "interval_seconds": SETTINGS.interval,
+                "samples": self.sampler.samples,
+                "folded_stacks": self.sampler.stacks,
+                "top_allocations": [
+                    {
+                        "location": str(stat.traceback),
+                        "size_diff_bytes": stat.size_diff,
+                        "count_diff": stat.count_diff,
+                        "size_bytes": stat.size
+                    } for stat in allocations
+                ],
+            }
+            save_profile(profile)
+            logger.info(f"Saved profile {profile['id']} ({duration:.3f}s, {self.sampler.samples} samples)")
+        except Exception as e:
+            logger.error(f"Could not save profile for {self.name}: {e}", exc_info=True)
+
+def run_profiled(name: str, view, args, kwargs, on_finish=None):
+    """
+    Runs a view under a RequestProfile. The profile of a streamed response ends when the server
+    closes the body; `on_finish` is called once it has been saved.
+    """
+    profile = RequestProfile(name)
+    callbacks = [profile.finish] + ([on_finish] if on_finish else [])
+    profile.start()
+    try:
+        response = view(*args, **kwargs)
+    except BaseException:
+        for callback in callbacks:
+            callback()
+        raise
+    if isinstance(response, Response) and response.is_streamed:
+        response.response = ClosingIterator(response.response, callbacks)
+        return response
+    for callback in callbacks:
+        callback()
+    return response
+
+def profiled(name: str):
+    """Decorator for Flask views that profiles the requests selected by the X-Profile header or the sample rate."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not SETTINGS.enabled or not should_profile():
+                return view(*args, **kwargs)
+            if not SETTINGS.slots.acquire(blocking=False):
+                return view(*args, **kwargs)
+            return run_profiled(name, view, args, kwargs, on_finish=SETTINGS.slots.release)
+        return wrapper
+    return decorator
@@ -0,0 +1,85 @@
+import contextvars
+import threading
+from typing import Optional
+
+from src.utils.metrics import LLM_TOKENS
+
+# --- Token usage of a request ---
+# A chat turn or an ingestion carries a UsageMeter in a context variable, like its deadline
+# (src/utils/deadline.py). The scheduled model and embeddings clients (src/backend/llm_scheduler.py)
+# add the usage of every provider call to it. The meter records the request into the usage rollups
+# (src/services/usage_service.py) when the request's StageTimer finishes.
+#
+# Chat models report their usage (usage_metadata, or Tongyi's token_usage). When a call does not,
+# its tokens are estimated from the characters and the call is counted as estimated. The embedding
+# clients do not report usage, so embedding tokens are always estimated.
+
+class UsageMeter:
+    """
+    The provider usage of one request. attribute() names the config, its owner and the model the
+    usage is booked to; a request that never gets that far (e.g. an unknown config) is not recorded.
+    """
+
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.config_id = None
+        self.owner_id = None
+        self.model = None
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.embedding_tokens = 0
+        self.llm_calls = 0
+        self.estimated_calls = 0
+        self.chunks = 0
+        self._lock = threading.Lock()
+
+    def attribute(self, config_id: str, owner_id, model: Optional[str]):
+        self.config_id = str(config_id)
+        self.owner_id = str(owner_id) if owner_id is not None else None
+        self.model = model or ""
+
+    def add_llm(self, model: str, input_tokens: int, output_tokens: int, estimated: bool):
+        with self._lock:
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+            self.llm_calls += 1
+            self.estimated_calls += estimated
+        LLM_TOKENS.inc(input_tokens, model=model, type="input")
+        LLM_TOKENS.inc(output_tokens, model=model, type="output")
+
+    def add_embedding(self, model: str, tokens: int):
+        with self._lock:
+            self.embedding_tokens += tokens
+        LLM_TOKENS.inc(tokens, model=model, type="embedding")
+
+    def finish(self, timer, status: str):
+        """StageTimer.on_finish hook: books the request into the worker's usage rollups."""
+        if self.config_id is None:
+            return
+        from src.services.usage_service import usage_recorder
+        usage_recorder().add(self, timer.durations, status)
+
+usage_var = contextvars.ContextVar("usage_meter", default=None)
+
+def start_usage_meter(kind: str, timer) -> UsageMeter:
+    """Starts metering the current request (thread or task); it is recorded when `timer` finishes."""
+    meter = UsageMeter(kind)
+    timer.on_finish.append(meter.finish)
+    usage_var.set(meter)
+    return meter
+
+def stop_usage_meter():
+    usage_var.set(None)
+
+def current_usage_meter() -> Optional[UsageMeter]:
+    return usage_var.get()
+
+def record_llm_usage(model: str, input_tokens: int, output_tokens: int, estimated: bool = False):
+    meter = current_usage_meter()
+    if meter is not None:
+        meter.add_llm(model, input_tokens, output_tokens, estimated)
+
+def record_embedding_usage(model: str, tokens: int):
+    meter = current_usage_meter()
+    if meter is not None:
+        meter.add_embedding(model, tokens)
@@ -3,10 +3,18 @@ import shutil
 from flask import current_app
 from langchain_community.document_loaders import Docx2txtLoader, PyPDFLoader, TextLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_openai import OpenAIEmbeddings
 
 import time
 from langchain_mongodb.vectorstores import MongoDBAtlasVectorSearch
+from src.utils.cache import bump_content_version
+from src.utils.metrics import ingest_timer, INGEST_CHUNKS
+from src.utils.usage import start_usage_meter, stop_usage_meter
+from src.backend.embedding_factory import EMBEDDING_FIELDS, get_embeddings, vector_index_for
+from src.backend.llm_scheduler import INGEST
+
+# Splitter settings used when a caller does not pass its own (see benchmarks/bench_retrieval.py)
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_CHUNK_OVERLAP = 20
 
 def get_document_loader(file_path):
     """
@@ -48,7 +56,9 @@ def handle_cleanup_error(func, path, exc_info):
     """
     current_app.logger.error(f"Error during cleanup of {path}: {exc_info}")
 
-def process_files_and_create_vector_store(temp_file_paths, user_id, collection_name, config_id):
+def process_files_and_create_vector_store(temp_file_paths, user_id, collection_name, config_id,
+                                          chunk_size=DEFAULT_CHUNK_SIZE, chunk_overlap=DEFAULT_CHUNK_OVERLAP, embedding_model=None,
+                                          embedding_field=EMBEDDING_FIELDS[0]):
     """
     Processes multiple uploaded documents, combines their content, creates a single 
     Chroma vector store, uploads it to S3, and cleans up local files.
@@ -57,6 +67,10 @@ def process_files_and_create_vector_store(temp_file_paths, user_id, collection_n
         temp_file_paths (list): A list of paths to the temporary uploaded files.
         user_id (str): The ID of the user.
         collection_name (str): The name for the ChromaDB collection.
+        chunk_size (int): Maximum characters per chunk.
+        chunk_overlap (int): Characters shared by consecutive chunks.
+        embedding_model (str): Embedding model id recorded on the config; defaults to the deployment's.
+        embedding_field (str): Chunk field the config's vectors are read from (see src/services/reembed_service.py).
 
     Returns:
         str: The S3 path to the created vector store, or None if an error occurs.
@@ -64,6 +78,12 @@ def process_files_and_create_vector_store(temp_file_paths, user_id, collection_n
     
     
     all_splits = []
+    embedding_model = embedding_model or current_app.config['EMBEDDING_MODEL']
+    timer = ingest_timer(str(config_id))
+    # The embedding calls are booked to the config (src/utils/usage.py)
+    meter = start_usage_meter("ingest", timer)
+    meter.attribute(config_id, user_id, embedding_model)
+    status = "error"
 
     try:
         db = current_app.config['MONGO_DB']
@@ -77,7 +97,8 @@ def process_files_and_create_vector_store(temp_file_paths, user_id, collection_n
 
             current_app.logger.info(f"Loading document: {temp_file_path}")
             try:
-                pages = loader.load()
+                with timer.stage("load"):
+                    pages = loader.load()
                 current_app.logger.info(f"Successfully loaded {len(pages)} pages from {temp_file_path}")
             except Exception as e:
                 current_app.logger.error(f"Error loading document {temp_file_path}: {str(e)}")
@@ -85,33 +106,45 @@ def process_files_and_create_vector_store(temp_file_paths, user_id, collection_n
 
 
             # Split the document and add its chunks to the master list
-            recursive_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=20)
-            splits = recursive_splitter.split_documents(pages)
+            with timer.stage("split"):
+                recursive_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+                splits = recursive_splitter.split_documents(pages)
             for split in splits:
                 split.metadata['user_id'] = user_id
                 split.metadata['config_id'] = str(config_id) # Link chunk to the config
                 split.metadata['collection_name'] = collection_name
                 split.metadata['original_file'] = os.path.basename(temp_file_path)
+                split.metadata['embedding_model'] = embedding_model # Detects chunks of mixed models
 
             
             all_splits.extend(splits)
-            current_app.logger.info(f"Processed {len(splits)} chunks from {os.path.basename(temp_file_path)}. First chunk content: {splits[0].page_content[:100] if splits else 'No chunks'}")
+            current_app.logger.info(f"Processed {len(splits)} chunks from {os.path.basename(temp_file_path)}")
 
         if not all_splits:
             current_app.logger.error("No documents could be processed from the provided files.")
+            status = "empty"
             return None
 
         # --- 2. Create a Single Vector Store from All Combined Splits ---
         current_app.logger.info(f"Inserting {len(all_splits)} document chunks into Atlas for collection '{collection_name}'")
         # Note: Ensure you have your OpenAI API key set in your environment for this to work
-        embeddings = current_app.config['EMBEDDINGS']
-        
-        MongoDBAtlasVectorSearch.from_documents(
-            documents=all_splits,
-            embedding=embeddings,
-            collection=mongo_collection,
-            index_name="vector"
-        )
+        embeddings = get_embeddings(embedding_model, current_app.config, priority=INGEST)
+
+        with timer.stage("embed_and_insert"):
+            try:
+                MongoDBAtlasVectorSearch.from_documents(
+                    documents=all_splits,
+                    embedding=embeddings,
+                    collection=mongo_collection,
+                    index_name=vector_index_for(embedding_model, embedding_field),
+                    embedding_key=embedding_field
+                )
+            finally:
+                # Cached retrievals of the config miss the new chunks; also after a failure part way, which may have stored some
+                bump_content_version(config_id)
+        INGEST_CHUNKS.inc(len(all_splits), config_id=str(config_id))
+        meter.chunks = len(all_splits)
+        status = "ok"
         current_app.logger.info("Successfully inserted vectors into MongoDB Atlas.")
        
         # --- 3. Upload the Entire Vector Store Directory to S3 ---
@@ -122,6 +155,8 @@ def process_files_and_create_vector_store(temp_file_paths, user_id, collection_n
         return None
         
     finally:
+        timer.finish(status=status)
+        stop_usage_meter()
         for temp_file_path in temp_file_paths:
             if os.path.exists(temp_file_path):
                 os.remove(temp_file_path)
@@ -27,7 +27,9 @@ export const ChatSidebar = ({
   onClose, 
   onToggle,
   onNewChat,
-  isPublic
+  isPublic,
+  hasMoreSessions = false,
+  onLoadMoreSessions
 }) => {
   const { chatId: activeChatId } = useParams();
   const navigate = useNavigate();
@@ -68,8 +70,16 @@ export const ChatSidebar = ({
 
   const handleDownloadChat = async (sessionId, title) => {
     try {
-      const response = await apiClient.get(`/history/${sessionId}`);
-      const chatHistory = response.data.history;
+      // History is paged newest-first, so walk back until there are no older pages
+      let chatHistory = [];
+      let before = null;
+      do {
+        const response = await apiClient.get(`/history/${sessionId}`, {
+          params: { before: before || undefined, limit: 500 },
+        });
+        chatHistory = [...response.data.history, ...chatHistory];
+        before = response.data.next_cursor;
+      } while (before);
       //change
       let textContent = `Chat History: ${title || 'New Chat'}\n`;
       textContent += `Downloaded on: ${new Date().toLocaleString()}\n`;
@@ -280,6 +290,15 @@ export const ChatSidebar = ({
                   </div>
                 )}
               </div>
+
+              {!sessionsLoading && hasMoreSessions && (
+                <button
+                  onClick={onLoadMoreSessions}
+                  className="w-full mt-2 px-4 py-2 text-xs text-gray-400 hover:text-gray-300 hover:bg-gray-700/30 rounded-xl transition-colors"
+                >
+                  Load older chats
+                </button>
+              )}
             </div>
           </div>
         )}
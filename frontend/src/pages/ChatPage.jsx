@@ -1,5 +1,5 @@
 import { FiAlertTriangle, FiChevronRight, FiLoader, FiSend } from 'react-icons/fi';
-import React, { useEffect, useRef, useState } from 'react';
+import React, { useEffect, useLayoutEffect, useRef, useState } from 'react';
 import { RiRobot2Line, RiUser3Line } from 'react-icons/ri';
 import { useNavigate, useParams } from 'react-router-dom';
 
@@ -67,16 +67,23 @@ const ChatPage = () => {
   const [isSidebarCollapsed, setIsSidebarCollapsed] = useState(false);
   const [sessions, setSessions] = useState([]);
   const [sessionsLoading, setSessionsLoading] = useState(true);
+  const [sessionsCursor, setSessionsCursor] = useState(null);
   const [userInfo, setUserInfo] = useState(null);
   const [userInfoLoaded, setUserInfoLoaded] = useState(false);
   const [isInitializing, setIsInitializing] = useState(true);
+  const [historyCursor, setHistoryCursor] = useState(null);
+  const [isLoadingOlder, setIsLoadingOlder] = useState(false);
   const messagesEndRef = useRef(null);
+  const scrollContainerRef = useRef(null);
+  // Scroll height captured before older messages are prepended, so the view can stay in place
+  const prependScrollHeightRef = useRef(null);
   const inputRef = useRef(null);
   const isAuthenticated = !!localStorage.getItem('jwtToken');
 
   const handleNewChat = () => {
     setIsInitializing(true);
     setMessages([]);
+    setHistoryCursor(null);
     setInput('');
     setError(null);
     setTimeout(() => setIsInitializing(false), 300);
@@ -121,19 +128,46 @@ const ChatPage = () => {
     fetchConfigDetails();
   }, [configId]);
 
+  const formatHistory = (history) => history.map(item => ({
+    sender: item.type === 'human' ? 'user' : 'ai',
+    text: item.data?.content || '',
+    sources: item.data?.sources || []
+  }));
+
+  const loadOlderMessages = async () => {
+    if (!chatId || !historyCursor || isLoadingOlder) return;
+
+    setIsLoadingOlder(true);
+    try {
+      const response = await apiClient.get(`/history/${chatId}`, {
+        params: { before: historyCursor },
+      });
+      prependScrollHeightRef.current = scrollContainerRef.current?.scrollHeight ?? null;
+      setMessages(prev => [...formatHistory(response.data.history), ...prev]);
+      setHistoryCursor(response.data.next_cursor || null);
+    } catch (error) {
+      console.error("Failed to fetch older messages:", error);
+    } finally {
+      setIsLoadingOlder(false);
+    }
+  };
+
+  const handleMessagesScroll = (e) => {
+    if (e.currentTarget.scrollTop < 80) {
+      loadOlderMessages();
+    }
+  };
+
   useEffect(() => {
     const fetchChatHistory = async () => {
       if (!chatId) return;
       
       setIsInitializing(true);
       try {
+        // Only the latest page is loaded up front; older pages are fetched on scroll
         const response = await apiClient.get(`/history/${chatId}`);
-        const formattedMessages = response.data.history.map(item => ({
-          sender: item.type === 'human' ? 'user' : 'ai',
-          text: item.data?.content || '',
-          sources: item.data?.sources || []
-        }));
-        setMessages(formattedMessages);
+        setMessages(formatHistory(response.data.history));
+        setHistoryCursor(response.data.next_cursor || null);
       } catch (error) {
         console.error("Failed to fetch history:", error);
         setError("Failed to load chat history");
@@ -157,6 +191,7 @@ const ChatPage = () => {
       try {
         const response = await apiClient.get(`/chat/list/${configId}`);
         setSessions(response.data.sessions);
+        setSessionsCursor(response.data.next_cursor || null);
       } catch (error) {
         console.error("Failed to fetch sessions:", error);
       } finally {
@@ -166,6 +201,19 @@ const ChatPage = () => {
     fetchSessions();
   }, [configId, messages, isAuthenticated]);
 
+  const handleLoadMoreSessions = async () => {
+    if (!sessionsCursor) return;
+    try {
+      const response = await apiClient.get(`/chat/list/${configId}`, {
+        params: { before: sessionsCursor },
+      });
+      setSessions(prev => [...prev, ...response.data.sessions]);
+      setSessionsCursor(response.data.next_cursor || null);
+    } catch (error) {
+      console.error("Failed to fetch more sessions:", error);
+    }
+  };
+
   useEffect(() => {
     // Only fetch user info if user is authenticated
     if (!isAuthenticated) {
@@ -186,7 +234,14 @@ const ChatPage = () => {
     fetchUserInfo();
   }, [isAuthenticated]);
 
-  useEffect(() => {
+  useLayoutEffect(() => {
+    const container = scrollContainerRef.current;
+    if (prependScrollHeightRef.current !== null && container) {
+      // Older messages were prepended: keep the same messages in view
+      container.scrollTop += container.scrollHeight - prependScrollHeightRef.current;
+      prependScrollHeightRef.current = null;
+      return;
+    }
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
   }, [messages]);
 
@@ -274,6 +329,8 @@ const ChatPage = () => {
           onClose={() => setShowSidebar(false)}
           onNewChat={handleNewChat}
           isPublic={config?.is_public}
+          hasMoreSessions={!!sessionsCursor}
+          onLoadMoreSessions={handleLoadMoreSessions}
         />
 	
       </div>
@@ -292,6 +349,8 @@ const ChatPage = () => {
               isCollapsed={false}
               onClose={() => setShowSidebar(false)}
               onNewChat={handleNewChat}
+              hasMoreSessions={!!sessionsCursor}
+              onLoadMoreSessions={handleLoadMoreSessions}
             />
           </div>
         </div>
@@ -322,8 +381,18 @@ const ChatPage = () => {
           </div>
         </header>
 
-        <main className="flex-1 overflow-y-auto p-4 sm:p-6 z-0">
+        <main
+          ref={scrollContainerRef}
+          onScroll={handleMessagesScroll}
+          className="flex-1 overflow-y-auto p-4 sm:p-6 z-0"
+        >
           <div className="container mx-auto max-w-4xl space-y-6">
+            {isLoadingOlder && (
+              <div className="flex justify-center">
+                <FaSpinner className="animate-spin text-indigo-400" />
+              </div>
+            )}
+
             {messages.length === 0 && !isLoading && !isInitializing && (
               <div className="flex flex-col items-center justify-center h-full text-center px-4 py-16 sm:py-20">
                 <div className="mb-6 flex flex-col items-center">